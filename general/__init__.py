@@ -1,10 +1,16 @@
+import hashlib
 import logging
+import os
+import threading
 import time
+from collections import OrderedDict
 from pathlib import Path
+from stat import S_ISDIR
 
 import magic
 from django.contrib import sitemaps
 from django.contrib.sitemaps.views import sitemap
+from django.core.cache import caches
 from django.http import HttpRequest, HttpResponse, HttpResponsePermanentRedirect, HttpResponseRedirect
 from django.shortcuts import render
 from django.urls import path
@@ -127,16 +133,136 @@ def overwrite_result(mapping):
     return wrapper
 
 
-@overwrite_result({"audio/x-hx-aac-adts": "audio/aac",
-                   "inode/x-empty": "text/plain",
-                   "text/html": "application/xml"})
-def get_mime_type(p: Path):
-    if p.is_dir():
-        return "inode/directory"
-
+class LRUCache:
+    """
+    A thread safe dictionary that forgets the least recently used entries beyond max_size
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class FileCache:
+    """
+    Values computed from files, cached by path, size and modification time: in memory, and if the setting
+    alias_setting names a cache (like a database cache), also there, so that they survive restarts.
+    None is not cached.
+    """
+    TIMEOUT = 60 * 60 * 24 * 30
+
+    def __init__(self, prefix: str, max_size: int, alias_setting: str):
+        self.prefix = prefix
+        self.memory = LRUCache(max_size)
+        self.alias_setting = alias_setting
+
+    def get(self, p: Path, stat: os.stat_result, compute):
+        """
+        The cached value for the file at stat, or compute(p) (which is cached then)
+        """
+        key = (str(p), stat.st_size, stat.st_mtime_ns)
+        if (value := self.memory.get(key)) is not None:
+            return value
+
+        alias = getattr(settings, self.alias_setting)
+        persistent = None if alias is None else caches[alias]
+        persistent_key = f"{self.prefix}:" + hashlib.sha256(repr(key).encode()).hexdigest()
+        if persistent is not None and (value := persistent.get(persistent_key)) is not None:
+            self.memory.put(key, value)
+            return value
+
+        if (value := compute(p)) is None:
+            return None
+
+        self.memory.put(key, value)
+        if persistent is not None:
+            persistent.set(persistent_key, value, timeout=self.TIMEOUT)
+        return value
+
+    def clear(self):
+        """
+        Forgets the values in memory
+        """
+        self.memory.clear()
+
+
+# Common types whose file extension can be trusted, so libmagic does not have to open the file
+fast_mime_types = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+    ".heic": "image/heic",
+    ".mp4": "video/mp4",
+    ".mov": "video/quicktime",
+    ".mkv": "video/x-matroska",
+    ".webm": "video/webm",
+    ".mp3": "audio/mpeg",
+    ".flac": "audio/flac",
+    ".ogg": "audio/ogg",
+    ".pdf": "application/pdf",
+    ".zip": "application/zip",
+}
+
+mime_cache = FileCache("mime", settings.FFS_MIME_CACHE_SIZE, "FFS_MIME_CACHE_ALIAS")
+
+
+def _sniff_mime_type(p: Path):
     try:
         return magic.from_file(p, mime=True)
     except Exception as e:
         # Sometimes the function just fails
         log.error(f"Could not determine mime type of {p}; reason: {e}")
-        return "text/plain;charset=utf-8"
+        return None
+
+
+@overwrite_result({"audio/x-hx-aac-adts": "audio/aac",
+                   "inode/x-empty": "text/plain",
+                   "text/html": "application/xml"})
+def get_mime_type(p: Path, stat: os.stat_result = None):
+    """
+    The mime type of the file, cached by path, size and modification time.
+    Pass the stat() of the file if it is known anyway.
+    """
+    if stat is None:
+        try:
+            stat = os.stat(p)
+        except OSError:
+            return _sniff_mime_type(p) or "text/plain;charset=utf-8"
+
+    if S_ISDIR(stat.st_mode):
+        return "inode/directory"
+    if stat.st_size == 0:
+        return "inode/x-empty"
+    if (mime := fast_mime_types.get(p.suffix.lower())) is not None:
+        return mime
+
+    # Failed sniffs are not cached, they may work the next time
+    return mime_cache.get(p, stat, _sniff_mime_type) or "text/plain;charset=utf-8"
@@ -198,3 +198,59 @@ PASSWORD_CHANGE_DONE_URL = "/change-password/done"
 SITE_ID = 2
 
 FFS_NET_BLOCK_SIZE = 7 * 2 ** 17
+# Other processes check for changed permission rules (one small query) at most this often, in seconds
+FFS_PERMISSIONS_CACHE_SECONDS = 1
+
+# Hand file transfers to the front proxy: None, "X-Accel-Redirect" (nginx) or "X-Sendfile" (Apache, lighttpd)
+FFS_ACCEL_HEADER = myenv.get("FFS_ACCEL_HEADER")
+# For X-Accel-Redirect: internal location for each of the directories, e.g. {"FFS_FS_ROOT": "/internal/ffs/"}
+FFS_ACCEL_LOCATIONS = myenv.get("FFS_ACCEL_LOCATIONS", {})
+
+# Threads used to hash the blocks of one file
+FFS_HASH_WORKERS = min(16, os.cpu_count() or 1)
+
+# File packets that were not used for this many hours are deleted
+FFS_FILE_PACKET_MAX_AGE = 48
+# Packet uploads start a cleanup of old packets at most this often (seconds), which runs for at most the time slice
+FFS_FILE_PACKET_GC_INTERVAL = 15 * 60
+FFS_FILE_PACKET_GC_TIME_SLICE = 5
+
+# Keep files assembled from packets reflinked to their packets (see private/dedup.py)
+FFS_DEDUP_STORAGE = myenv.get("FFS_DEDUP_STORAGE", False)
+
+# Mime types of this many files are kept in memory; with an alias from CACHES they are also stored there
+FFS_MIME_CACHE_SIZE = 100 * 1000
+FFS_MIME_CACHE_ALIAS = myenv.get("FFS_MIME_CACHE_ALIAS")
+
+# Answer listings and searches from the FsEntry index (see private/fs_index.py and manage.py ffs_index)
+FFS_FS_INDEX = myenv.get("FFS_FS_INDEX", False)
+
+# Icons of images fit into squares of these sizes, the first one is the default
+FFS_ICON_SIZES = [32, 128, 256]
+FFS_ICON_FORMAT = "webp"
+FFS_ICON_QUALITY = 80
+# Icons are rendered in this many processes; 0 renders them in the requesting thread
+FFS_ICON_WORKERS = min(4, os.cpu_count() or 1)
+# Render the icons of uploaded and unzipped images right away instead of on the first request
+FFS_ICON_PREGENERATE = myenv.get("FFS_ICON_PREGENERATE", False)
+# Least recently ("lru") or least frequently ("lfu") used icons are deleted when they take up more than this
+FFS_ICON_BUDGET_BYTES = myenv.get("FFS_ICON_BUDGET_BYTES", 2 * 2 ** 30)
+FFS_ICON_EVICTION = myenv.get("FFS_ICON_EVICTION", "lru")
+# Sprites are deleted when they were not used for this long (seconds), and the least recently used ones
+# when all of them take up more than this
+FFS_SPRITE_MAX_AGE_SECONDS = myenv.get("FFS_SPRITE_MAX_AGE_SECONDS", 7 * 24 * 60 * 60)
+FFS_SPRITE_BUDGET_BYTES = myenv.get("FFS_SPRITE_BUDGET_BYTES", 256 * 2 ** 20)
+
+# Zip files that are kept are compressed in this many processes, holding at most about this many bytes
+FFS_ZIP_WORKERS = os.cpu_count() or 1
+FFS_ZIP_MEMORY_BYTES = 256 * 2 ** 20
+
+# Requests with ?async=1 become jobs that run in this many threads of the process that queued them;
+# with 0 a separate manage.py ffs_worker runs them
+FFS_JOB_WORKERS = myenv.get("FFS_JOB_WORKERS", 2)
+# Zip members are extracted by this many threads
+FFS_EXTRACT_WORKERS = min(4, os.cpu_count() or 1)
+
+# EXIF data of this many images is kept in memory; with an alias from CACHES it is also stored there
+FFS_EXIF_CACHE_SIZE = 10 * 1000
+FFS_EXIF_CACHE_ALIAS = myenv.get("FFS_EXIF_CACHE_ALIAS")
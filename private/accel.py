@@ -0,0 +1,61 @@
+import logging
+from pathlib import Path
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import HttpResponse
+
+log = logging.getLogger("my")
+
+X_ACCEL_REDIRECT = "X-Accel-Redirect"
+X_SENDFILE = "X-Sendfile"
+
+
+def sendfile_safe(path: str) -> bool:
+    """
+    Whether the path can be put into X-Sendfile as it is. The header has no agreed encoding (mod_xsendfile decodes
+    %XX, lighttpd does not), so paths with other characters than printable ASCII or with % are sent by Django.
+    """
+    return path.isascii() and path.isprintable() and "%" not in path
+
+
+def internal_location(full_path: Path) -> str | None:
+    """
+    The internal location (of the front proxy) at which the file can be found,
+    according to FFS_ACCEL_LOCATIONS
+    """
+    for name, location in settings.FFS_ACCEL_LOCATIONS.items():
+        root = getattr(settings, name)
+        if full_path.is_relative_to(root):
+            relative = full_path.relative_to(root).as_posix()
+            return location.rstrip("/") + "/" + quote(relative)
+
+    return None
+
+
+def accel_response(full_path: Path, content_type: str, headers=None) -> HttpResponse | None:
+    """
+    Lets the front proxy send the file instead of this process, if that is configured.
+
+    Returns None if the file has to be sent by Django after all.
+    """
+    header = settings.FFS_ACCEL_HEADER
+    if header is None:
+        return None
+
+    if header == X_SENDFILE:
+        value = str(full_path)
+        if not sendfile_safe(value):
+            log.debug(f"Not using X-Sendfile for {full_path}")
+            return None
+    elif header == X_ACCEL_REDIRECT:
+        if (value := internal_location(full_path)) is None:
+            log.warning(f"No internal location is configured for {full_path}")
+            return None
+    else:
+        log.error(f"Unknown value for FFS_ACCEL_HEADER: {header}")
+        return None
+
+    response = HttpResponse(content_type=content_type, headers=headers)
+    response[header] = value
+    return response
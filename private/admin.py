@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from private.models import FilePacket, PermissionsRule
+from private.models import FilePacket, PermissionsRule, BlockHashIndex, PacketChain, FsEntry, ImageIcon, Job
 
 
 class FilePacketAdmin(admin.ModelAdmin):
@@ -11,5 +11,32 @@ class PermissionsRuleAdmin(admin.ModelAdmin):
     list_display = ("rule", "users", "is_template")
 
 
+class BlockHashIndexAdmin(admin.ModelAdmin):
+    list_display = ("path", "block_size", "size", "mtime_ns")
+
+
+class PacketChainAdmin(admin.ModelAdmin):
+    list_display = ("path", "size", "mtime_ns")
+
+
+class FsEntryAdmin(admin.ModelAdmin):
+    list_display = ("path", "is_dir", "size", "mime", "indexed_at")
+    search_fields = ("path",)
+
+
+class ImageIconAdmin(admin.ModelAdmin):
+    list_display = ("path", "size", "format", "bytes", "hits", "last_used")
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("kind", "user", "status", "files_done", "bytes_done", "created", "finished")
+    list_filter = ("status", "kind")
+
+
 admin.site.register(FilePacket, FilePacketAdmin)
-admin.site.register(PermissionsRule, PermissionsRuleAdmin)
\ No newline at end of file
+admin.site.register(PermissionsRule, PermissionsRuleAdmin)
+admin.site.register(BlockHashIndex, BlockHashIndexAdmin)
+admin.site.register(PacketChain, PacketChainAdmin)
+admin.site.register(FsEntry, FsEntryAdmin)
+admin.site.register(ImageIcon, ImageIconAdmin)
+admin.site.register(Job, JobAdmin)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class PrivateConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "private"
+
+    def ready(self):
+        # Connects the signal handlers and registers the kinds of jobs
+        from private import permissions, tasks
@@ -0,0 +1,350 @@
+import collections
+import multiprocessing
+import os
+import stat
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+from django.conf import settings
+
+from general import get_mime_type
+from private import zip_worker
+from private.atomic import replacing
+
+CHUNK_SIZE = 2 ** 20
+TAR_BLOCK = tarfile.BLOCKSIZE
+TAR_RECORD = tarfile.RECORDSIZE
+
+FORMATS = {"zip": "application/zip", "tar": "application/x-tar"}
+
+# Compressing these again costs a lot of time and saves (almost) nothing
+COMPRESSED_MIME_TYPES = {
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/heic", "image/heif", "image/avif", "image/jxl",
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2", "application/x-xz",
+    "application/x-7z-compressed", "application/x-rar", "application/vnd.rar", "application/zstd",
+    "application/x-lzma", "application/java-archive", "application/epub+zip", "application/pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "application/vnd.oasis.opendocument.text", "application/vnd.oasis.opendocument.spreadsheet",
+}
+# Uncompressed audio and video
+UNCOMPRESSED_MEDIA = {"audio/x-wav", "audio/wav", "audio/x-aiff", "video/x-msvideo"}
+
+
+def is_compressed(mime: str) -> bool:
+    if mime in UNCOMPRESSED_MEDIA:
+        return False
+    return mime in COMPRESSED_MIME_TYPES or mime.startswith("video/") or mime.startswith("audio/")
+
+
+def zip_compression(full_path: Path, st: os.stat_result) -> tuple[int, int | None]:
+    """
+    The compress_type and compress level for the file in a streamed zip: stored if it is compressed already,
+    otherwise deflate at the fastest level
+    """
+    if st.st_size == 0 or is_compressed(get_mime_type(full_path, st)):
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, 1
+
+# Text and documents shrink a lot more with LZMA than with deflate, which is worth it when the zip is kept
+LZMA_MIME_TYPES = {
+    "application/json", "application/xml", "application/javascript", "application/x-sh", "application/sql",
+    "application/rtf", "application/x-tex", "application/msword", "application/vnd.ms-excel",
+    "application/vnd.ms-powerpoint", "application/x-ndjson", "image/svg+xml", "image/bmp", "image/tiff",
+}
+
+
+def persisted_compression(full_path: Path, st: os.stat_result) -> tuple[int, int | None]:
+    """
+    The compress_type and compress level for the file in a zip file that is kept:
+    stored if it is compressed already, LZMA for text and documents, otherwise deflate
+    """
+    if st.st_size == 0:
+        return zipfile.ZIP_STORED, None
+    mime = get_mime_type(full_path, st)
+    if is_compressed(mime):
+        return zipfile.ZIP_STORED, None
+    if mime.startswith("text/") or mime in LZMA_MIME_TYPES:
+        return zipfile.ZIP_LZMA, None
+    return zipfile.ZIP_DEFLATED, 6
+
+
+class Member:
+    def __init__(self, name: str, full_path: Path, st: os.stat_result):
+        self.name = name
+        self.full_path = full_path
+        self.stat = st
+
+    @property
+    def is_dir(self) -> bool:
+        return stat.S_ISDIR(self.stat.st_mode)
+
+
+def members(full_paths: list[Path], allowed: Callable[[str], bool] = None) -> Iterator[Member]:
+    """
+    The files and directories to archive, named relative to the parent of each of the paths.
+    Symbolic links to directories are not followed, paths (relative to FFS_FS_ROOT) for which allowed()
+    is false are left out (with everything below them).
+    """
+    for full_path in full_paths:
+        stack = [(full_path.name, full_path)]
+        while len(stack) > 0:
+            name, path = stack.pop()
+            if allowed is not None and not allowed(str(path.relative_to(settings.FFS_FS_ROOT))):
+                continue
+            try:
+                st = os.stat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            if not (stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode)):
+                continue
+
+            yield Member(name, path, st)
+
+            if stat.S_ISDIR(st.st_mode) and not path.is_symlink():
+                try:
+                    with os.scandir(path) as it:
+                        children = sorted(e.name for e in it)
+                except (FileNotFoundError, PermissionError):
+                    continue
+                stack += [(f"{name}/{child}", path / child) for child in reversed(children)]
+
+
+def _read_chunks(full_path: Path, limit: int = None):
+    with open(full_path, "rb") as file:
+        remaining = limit
+        while remaining is None or remaining > 0:
+            data = file.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if len(data) == 0:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+
+class _Sink:
+    """
+    An unseekable file for zipfile that keeps what was written until it is taken
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _directory_info(member: Member) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo.from_file(member.full_path, member.name)
+    # from_file() leaves the CRC of directories unset, which mkdir() needs
+    info.CRC = 0
+    return info
+
+
+def stream_zip(items: Iterator[Member]) -> Iterator[bytes]:
+    """
+    A zip file with the members, produced while it is sent. Only one chunk of one file is in memory at a time.
+    Every member uses Zip64, so files of any size (even ones that grow while they are read) work.
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w") as archive:
+        for member in items:
+            try:
+                if member.is_dir:
+                    archive.mkdir(_directory_info(member))
+                else:
+                    info = zipfile.ZipInfo.from_file(member.full_path, member.name)
+                    # ZipInfo has no public compression level before Python 3.13 (compress_level), see below
+                    info.compress_type, info._compresslevel = zip_compression(member.full_path, member.stat)
+                    with archive.open(info, "w", force_zip64=True) as dst:
+                        for data in _read_chunks(member.full_path):
+                            dst.write(data)
+                            # Deflate keeps some data back, so there is not always something to send
+                            if data := sink.take():
+                                yield data
+            except FileNotFoundError:
+                continue
+            yield sink.take()
+    yield sink.take()
+
+
+def stream_tar(items: Iterator[Member]) -> Iterator[bytes]:
+    """
+    A (POSIX pax) tar file with the members, produced while it is sent.
+    The size in each header is the size when the file was listed; a file that changes meanwhile is cut or padded.
+    """
+    written = 0
+    for member in items:
+        info = tarfile.TarInfo(member.name)
+        info.mtime = member.stat.st_mtime
+        info.mode = stat.S_IMODE(member.stat.st_mode)
+        if member.is_dir:
+            info.type = tarfile.DIRTYPE
+        else:
+            info.size = member.stat.st_size
+
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        yield header
+        written += len(header)
+
+        if member.is_dir:
+            continue
+
+        size = 0
+        try:
+            for data in _read_chunks(member.full_path, info.size):
+                size += len(data)
+                yield data
+        except FileNotFoundError:
+            pass
+        padding = (info.size - size) + (-info.size % TAR_BLOCK)
+        if padding > 0:
+            yield b"\0" * padding
+        written += info.size + (-info.size % TAR_BLOCK)
+
+    end = 2 * TAR_BLOCK
+    end += -(written + end) % TAR_RECORD
+    yield b"\0" * end
+
+
+def stream(fmt: str, items: Iterator[Member]) -> Iterator[bytes]:
+    match fmt:
+        case "zip":
+            yield from stream_zip(items)
+        case "tar":
+            yield from stream_tar(items)
+
+
+@dataclass
+class ZipStats:
+    files: int = 0
+    directories: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    # Members per compress_type
+    methods: dict = field(default_factory=lambda: collections.Counter())
+
+    @property
+    def ratio(self) -> float:
+        return self.bytes_out / self.bytes_in if self.bytes_in > 0 else 1.0
+
+
+# zipfile has no public API for adding data that is compressed already, so _write_compressed() does what
+# ZipFile.write() does itself, and zip_worker uses zipfile._get_compressor(). This relies on the private
+# ZipFile._writecheck(), _didModify, start_dir, zipfile._MASK_COMPRESS_OPTION_1 and ZipInfo._compresslevel, which
+# behave the same in CPython 3.12 and 3.13; ArchiveTests.test_zipfile_internals round-trips every codec through
+# them, so check it on every Python upgrade.
+def _write_compressed(archive: zipfile.ZipFile, member: Member, compress_type: int, crc: int, size: int,
+                      data: bytes):
+    """
+    Adds a member whose data was compressed elsewhere, like ZipFile.write() would have written it
+    """
+    info = zipfile.ZipInfo.from_file(member.full_path, member.name)
+    info.compress_type = compress_type
+    info.CRC = crc
+    info.file_size = size
+    info.compress_size = len(data)
+    if compress_type == zipfile.ZIP_LZMA:
+        # The compressed data ends with an end-of-stream marker
+        info.flag_bits |= zipfile._MASK_COMPRESS_OPTION_1
+
+    archive.fp.seek(archive.start_dir)
+    info.header_offset = archive.fp.tell()
+    archive._writecheck(info)
+    archive._didModify = True
+    archive.fp.write(info.FileHeader())
+    archive.fp.write(data)
+    archive.filelist.append(info)
+    archive.NameToInfo[info.filename] = info
+    archive.start_dir = archive.fp.tell()
+
+
+def build_zip(dst: Path, items: Iterable[Member], workers: int = None, memory_limit: int = None,
+              progress: Callable[[Member], None] = None) -> ZipStats:
+    """
+    Writes a zip file with the members to dst, with the codec of persisted_compression() for each file.
+
+    Files are compressed in worker processes while the members before them are written, in order.
+    Compressed files that are being worked on or wait to be written take up to about memory_limit bytes;
+    files too large for that are compressed here, streaming, when it is their turn.
+    The zip file only appears at dst once it is complete. Calls progress with each member once it is written.
+    """
+    workers = workers or settings.FFS_ZIP_WORKERS
+    memory_limit = memory_limit or settings.FFS_ZIP_MEMORY_BYTES
+    # The worker holds the compressed data (at most about as large as the file) and then sends a copy of it
+    max_parallel_size = memory_limit // (2 * workers)
+    max_pending = 16 * workers
+
+    stats = ZipStats()
+    pool = None
+    if workers > 1:
+        # forkserver, like icons._make_pool()
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("forkserver"))
+    pending = collections.deque()
+    in_memory = 0
+
+    try:
+        with replacing(dst) as tmp, zipfile.ZipFile(tmp, "x") as archive:
+            def write_next():
+                nonlocal in_memory
+                member, compress_type, level, future = pending.popleft()
+
+                if member.is_dir:
+                    archive.mkdir(_directory_info(member))
+                    stats.directories += 1
+                    if progress is not None:
+                        progress(member)
+                    return
+
+                if future is not None:
+                    crc, size, data = future.result()
+                    in_memory -= member.stat.st_size
+                    _write_compressed(archive, member, compress_type, crc, size, data)
+                else:
+                    archive.write(member.full_path, member.name, compress_type, level)
+
+                info = archive.filelist[-1]
+                stats.files += 1
+                stats.bytes_in += info.file_size
+                stats.bytes_out += info.compress_size
+                stats.methods[compress_type] += 1
+                if progress is not None:
+                    progress(member)
+
+            for member in items:
+                compress_type = level = future = None
+
+                if not member.is_dir:
+                    compress_type, level = persisted_compression(member.full_path, member.stat)
+                    size = member.stat.st_size
+                    if pool is not None and compress_type != zipfile.ZIP_STORED and size <= max_parallel_size:
+                        while len(pending) > 0 and in_memory + size > memory_limit:
+                            write_next()
+                        future = pool.submit(zip_worker.compress, str(member.full_path), compress_type, level)
+                        in_memory += size
+
+                pending.append((member, compress_type, level, future))
+                while len(pending) > max_pending:
+                    write_next()
+
+            while len(pending) > 0:
+                write_next()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    return stats
@@ -0,0 +1,117 @@
+import logging
+import os
+import struct
+from pathlib import Path
+from typing import Callable
+
+from private.atomic import replacing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger("my")
+
+# From linux/fs.h: _IOW(0x94, 13, struct file_clone_range)
+FICLONERANGE = 0x4020940d
+
+CLONE = "clone"
+COPY_FILE_RANGE = "copy_file_range"
+BUFFERED = "buffered"
+
+BUFFER_SIZE = 2 ** 20
+
+
+def _clone(src_fd: int, dst_fd: int, dst_offset: int):
+    """
+    Shares the extents of the whole source file at dst_offset (a reflink) on file systems like btrfs and XFS
+    """
+    # struct file_clone_range { __s64 src_fd; __u64 src_offset; __u64 src_length; __u64 dest_offset; },
+    # a length of 0 means "until the end of the source"
+    fcntl.ioctl(dst_fd, FICLONERANGE, struct.pack("qQQQ", src_fd, 0, 0, dst_offset))
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, length: int, dst_offset: int, copied: int) -> int:
+    while copied < length:
+        n = os.copy_file_range(src_fd, dst_fd, length - copied, copied, dst_offset + copied)
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _copy_buffered(src_fd: int, dst_fd: int, length: int, dst_offset: int, copied: int) -> int:
+    while copied < length:
+        data = os.pread(src_fd, min(BUFFER_SIZE, length - copied), copied)
+        if len(data) == 0:
+            break
+        written = 0
+        while written < len(data):
+            written += os.pwrite(dst_fd, data[written:], dst_offset + copied + written)
+        copied += len(data)
+    return copied
+
+
+def assemble(dst: Path, parts: list[Path], clone: bool = True, copy_file_range: bool = True,
+             progress: Callable[[int], None] = None) -> dict:
+    """
+    Writes the concatenation of the parts to dst, without pulling the data through this process where possible.
+
+    For each part, the first of these that works is used:
+    reflinks (FICLONERANGE), os.copy_file_range (in-kernel copy) and a plain buffered copy.
+    The result is written to a temporary file and renamed to dst, so dst never contains a partial file.
+
+    Calls progress with the size of each part once it is copied.
+    Returns how many parts were copied with each method.
+    """
+    clone = clone and fcntl is not None
+    copy_file_range = copy_file_range and hasattr(os, "copy_file_range")
+    methods = {CLONE: 0, COPY_FILE_RANGE: 0, BUFFERED: 0}
+
+    with replacing(dst) as tmp:
+        dst_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            alignment = os.fstat(dst_fd).st_blksize
+            offset = 0
+
+            for part in parts:
+                src_fd = os.open(part, os.O_RDONLY)
+                try:
+                    length = os.fstat(src_fd).st_size
+                    copied = 0
+
+                    if clone and offset % alignment == 0 and length > 0:
+                        try:
+                            _clone(src_fd, dst_fd, offset)
+                            copied = length
+                            methods[CLONE] += 1
+                        except OSError as e:
+                            log.debug(f"Cannot clone {part} into {tmp}: {e}")
+                            clone = False
+
+                    if copied < length and copy_file_range:
+                        try:
+                            copied = _copy_file_range(src_fd, dst_fd, length, offset, copied)
+                            methods[COPY_FILE_RANGE] += 1
+                        except OSError as e:
+                            log.debug(f"Cannot use copy_file_range for {part} into {tmp}: {e}")
+                            copy_file_range = False
+
+                    if copied < length:
+                        copied = _copy_buffered(src_fd, dst_fd, length, offset, copied)
+                        methods[BUFFERED] += 1
+
+                    if copied != length:
+                        raise RuntimeError(f"Could only copy {copied} of {length} bytes from {part}")
+
+                    offset += length
+                    if progress is not None:
+                        progress(length)
+                finally:
+                    os.close(src_fd)
+        finally:
+            os.close(dst_fd)
+
+    log.debug(f"Assembled {dst} from {len(parts)} parts: {methods}")
+    return methods
@@ -0,0 +1,22 @@
+"""
+Writing files so that they only appear once they are complete. Used by the worker processes too, so it must not
+import Django.
+"""
+import os
+import secrets
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@contextmanager
+def replacing(dst: Path):
+    """
+    A temporary path next to dst to write to; it is renamed to dst when the block ends, or deleted if it raises
+    """
+    dst = Path(dst)
+    tmp = dst.parent / f".{dst.name}.{secrets.token_hex(4)}.tmp"
+    try:
+        yield tmp
+        os.replace(tmp, dst)
+    finally:
+        tmp.unlink(missing_ok=True)
@@ -0,0 +1,86 @@
+import logging
+import os
+from pathlib import Path
+
+from django.conf import settings
+
+from private.hashing import ParallelHasher
+from private.models import BlockHashIndex
+from private.paths import subtree_q
+
+log = logging.getLogger("my")
+
+
+def compute_block_hashes(full_path: Path, size: int, block_size: int) -> list[str]:
+    return ParallelHasher(full_path, block_size).hash_blocks(size)
+
+
+def block_hashes(full_path: Path, block_size: int = None, stat: os.stat_result = None) -> list[str]:
+    """
+    The hashes of all blocks of the file, only reading the file if they are not in the index yet
+    """
+    block_size = block_size or settings.FFS_NET_BLOCK_SIZE
+    stat = stat or full_path.stat()
+
+    entry = BlockHashIndex.objects.filter(path=str(full_path), block_size=block_size).first()
+    if entry is not None and entry.is_valid_for(stat):
+        return entry.hashes
+
+    hashes = compute_block_hashes(full_path, stat.st_size, block_size)
+
+    # Do not remember the hashes if the file changed while it was being read
+    after = full_path.stat()
+    if after.st_size == stat.st_size and after.st_mtime_ns == stat.st_mtime_ns:
+        store(full_path, hashes, block_size, stat)
+
+    return hashes
+
+
+def store(full_path: Path, hashes: list[str], block_size: int = None, stat: os.stat_result = None):
+    block_size = block_size or settings.FFS_NET_BLOCK_SIZE
+    stat = stat or full_path.stat()
+
+    BlockHashIndex.objects.update_or_create(path=str(full_path), block_size=block_size,
+                                            defaults={"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                                                      "hashes": hashes})
+
+
+def store_assembled(full_path: Path, hashes: list[str], parts: list[Path]):
+    """
+    Remembers the hashes of a file that was assembled from the given parts (with the given hashes),
+    if the parts are exactly the blocks of the file
+    """
+    block_size = settings.FFS_NET_BLOCK_SIZE
+    sizes = [p.stat().st_size for p in parts]
+
+    if len(sizes) == 0 or any(s != block_size for s in sizes[:-1]) or not 0 < sizes[-1] <= block_size:
+        return
+
+    store(full_path, hashes, block_size)
+
+
+def _subtree(full_path: Path):
+    path = str(full_path)
+    return BlockHashIndex.objects.filter(subtree_q(path))
+
+
+def invalidate(full_path: Path):
+    """
+    Forgets the hashes of the file, or of all files in the directory
+    """
+    _subtree(full_path).delete()
+
+
+def move(full_src: Path, full_dst: Path):
+    """
+    Moving does not change the contents, so the hashes are kept for the new location
+    """
+    src = str(full_src)
+    dst = str(full_dst)
+    entries = list(_subtree(full_src))
+    invalidate(full_dst)
+
+    for entry in entries:
+        entry.path = dst + entry.path[len(src):]
+
+    BlockHashIndex.objects.bulk_update(entries, ["path"])
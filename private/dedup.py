@@ -0,0 +1,83 @@
+import logging
+import os
+from pathlib import Path
+
+from django.conf import settings
+
+from private.assembly import assemble, CLONE
+from private.models import PacketChain, FilePacket
+from private.paths import subtree_q
+
+log = logging.getLogger("my")
+
+
+def assemble_deduplicated(full_path: Path, hashes: list[str], parts: list[Path], progress=None) -> bool:
+    """
+    Assembles the file from the packets. If all packets could be reflinked, the file shares its blocks
+    with the packets and the packets are kept (pinned) for as long as the file is unchanged,
+    so uploading the same content again needs no data transfer and costs no disk space.
+
+    Returns whether the file is deduplicated.
+    """
+    methods = assemble(full_path, parts, progress=progress)
+    non_empty = sum(1 for p in parts if p.stat().st_size > 0)
+
+    if methods[CLONE] < non_empty:
+        log.info(f"Could not deduplicate {full_path}, the file system does not support reflinks")
+        return False
+
+    pin(full_path, hashes)
+    return True
+
+
+def pin(full_path: Path, hashes: list[str], stat: os.stat_result = None):
+    stat = stat or full_path.stat()
+    chain, _ = PacketChain.objects.update_or_create(path=str(full_path),
+                                                    defaults={"size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+    chain.packets.set(FilePacket.objects.filter(hsh__in=set(hashes)))
+
+
+def _subtree(full_path: Path):
+    path = str(full_path)
+    return PacketChain.objects.filter(subtree_q(path))
+
+
+def release(full_path: Path):
+    """
+    The file (or the files in the directory) no longer share storage with their packets
+    """
+    _subtree(full_path).delete()
+
+
+def move(full_src: Path, full_dst: Path, renamed: bool = True):
+    """
+    Moves the chains along with their files. A move that copied the files (to another file system) ends the
+    sharing, so then the chains are released.
+    """
+    release(full_dst)
+    if not renamed:
+        release(full_src)
+        return
+
+    src = str(full_src)
+    dst = str(full_dst)
+    chains = list(_subtree(full_src))
+
+    for chain in chains:
+        chain.path = dst + chain.path[len(src):]
+
+    PacketChain.objects.bulk_update(chains, ["path"])
+
+
+def is_stale(chain: PacketChain) -> bool:
+    """
+    Whether the file of the chain was changed or deleted without this server noticing
+    """
+    try:
+        return not chain.is_valid_for(os.stat(chain.path))
+    except FileNotFoundError:
+        return True
+
+
+def enabled() -> bool:
+    return settings.FFS_DEDUP_STORAGE
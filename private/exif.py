@@ -0,0 +1,137 @@
+"""
+EXIF metadata of images. Only the headers of the files are read, and the results are cached like the mime types
+(see general.FileCache, with FFS_EXIF_CACHE_ALIAS).
+"""
+import logging
+import os
+import struct
+from pathlib import Path
+
+from PIL import Image, UnidentifiedImageError
+from PIL.ExifTags import TAGS, GPSTAGS, IFD
+from PIL.TiffImagePlugin import IFDRational
+from django.conf import settings
+
+from general import FileCache, get_mime_type
+
+log = logging.getLogger("my")
+
+# Binary values longer than this (like maker notes) are only described
+MAX_BYTES = 64
+
+# Cached for files that are not images or cannot be read
+NO_EXIF = "none"
+
+cache = FileCache("exif", settings.FFS_EXIF_CACHE_SIZE, "FFS_EXIF_CACHE_ALIAS")
+
+
+def tag_name(key: int, tags: dict = TAGS) -> str:
+    return tags.get(key, f"Tag 0x{key:04x}")
+
+
+def to_json(value):
+    """
+    The value as something that json.dumps() understands
+    """
+    if isinstance(value, IFDRational):
+        return float(value) if value.denominator != 0 else None
+    if isinstance(value, bytes):
+        value = value.rstrip(b"\0")
+        if len(value) > MAX_BYTES:
+            return f"({len(value)} bytes)"
+        try:
+            return value.decode("ascii")
+        except UnicodeDecodeError:
+            return value.hex()
+    if isinstance(value, str):
+        return value.rstrip("\0")
+    if isinstance(value, (tuple, list)):
+        return [to_json(v) for v in value]
+    if isinstance(value, (int, float)) or value is None:
+        return value
+    return str(value)
+
+
+def png_exif(full_path: Path) -> bytes | None:
+    """
+    The eXIf chunk of the PNG file. It may come after the image data, where Pillow would only find it by decoding
+    the image, so the chunks are skipped over instead.
+    """
+    with open(full_path, "rb") as file:
+        file.seek(8)
+        while len(header := file.read(8)) == 8:
+            length, chunk_type = struct.unpack(">I4s", header)
+            if chunk_type == b"eXIf":
+                return file.read(length)
+            if chunk_type == b"IEND":
+                return None
+            file.seek(length + 4, os.SEEK_CUR)
+    return None
+
+
+def _exif(img: Image.Image, full_path: Path) -> Image.Exif:
+    # PngImageFile.getexif() calls load() when the chunk is not before the image data
+    if img.format == "PNG" and "exif" not in img.info:
+        exif = Image.Exif()
+        if (data := png_exif(full_path)) is not None:
+            exif.load(data)
+        return exif
+    return img.getexif()
+
+
+def read(full_path: Path) -> dict | None:
+    """
+    The EXIF tags of the image by name, including those of the Exif and GPS IFDs; None if it is not an image
+    or cannot be read
+    """
+    try:
+        # Opening only parses the header; the pixels would be decoded by load()
+        with Image.open(full_path) as img:
+            exif = _exif(img, full_path)
+            data = {tag_name(key): to_json(value) for key, value in exif.items()
+                    if key not in (IFD.Exif, IFD.GPSInfo)}
+            data.update({tag_name(key): to_json(value) for key, value in exif.get_ifd(IFD.Exif).items()})
+            if gps := exif.get_ifd(IFD.GPSInfo):
+                data["GPSInfo"] = {tag_name(key, GPSTAGS): to_json(value) for key, value in gps.items()}
+    except UnidentifiedImageError as e:
+        log.debug(f"Could not read the EXIF data of {full_path}: {e!r}")
+        return None
+    except Exception as e:
+        # Broken files must not end the responses with the EXIF data of many files
+        log.warning(f"Could not read the EXIF data of {full_path}: {e!r}")
+        return None
+
+    data["Number of entries"] = len(data)
+    return data
+
+
+def _read_for_cache(full_path: Path):
+    return NO_EXIF if (data := read(full_path)) is None else data
+
+
+def get(full_path: Path, stat: os.stat_result = None) -> dict | None:
+    """
+    The cached EXIF tags of the image (see read). Pass the stat() of the file if it is known anyway.
+    """
+    data = cache.get(full_path, stat or os.stat(full_path), _read_for_cache)
+    return None if data == NO_EXIF else data
+
+
+def directory(full_path: Path, allowed=None):
+    """
+    The name and EXIF tags of every image in the directory that allowed(name) accepts, sorted by name
+    """
+    with os.scandir(full_path) as entries:
+        entries = sorted(entries, key=lambda e: e.name)
+
+    for entry in entries:
+        try:
+            stat = entry.stat()
+            if not entry.is_file() or not get_mime_type(Path(entry.path), stat).startswith("image/"):
+                continue
+        except OSError:
+            continue
+        if allowed is not None and not allowed(entry.name):
+            continue
+        if (data := get(Path(entry.path), stat)) is not None:
+            yield entry.name, data
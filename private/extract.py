@@ -0,0 +1,258 @@
+"""
+Extracting zip and tar archives into the FFS. The listing of an archive is checked and turned into a plan in one
+pass; then the directories are created once and the files are streamed to disk with fixed buffers, zip members by
+several threads at a time (zlib, bz2 and lzma decompress without the GIL).
+
+The plan only reads the headers of zip and plain tar files; extracting seeks straight to the data of each member.
+Compressed tar files are one stream, though: the plan decompresses all of it to see every header, and extracting
+decompresses it once more, as nothing may be written before all members were checked.
+"""
+import concurrent.futures
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path, PurePosixPath
+from typing import Callable
+
+from django.conf import settings
+
+log = logging.getLogger("my")
+
+# Every thread copies at most this much at a time
+BUFFER_SIZE = 2 ** 20
+
+
+@dataclass
+class Member:
+    name: PurePosixPath
+    size: int
+    info: zipfile.ZipInfo | tarfile.TarInfo
+
+
+@dataclass
+class Plan:
+    """
+    What extracting the archive at path into dst does; nothing may be extracted if there are errors
+    """
+    path: Path
+    dst: Path
+    is_zip: bool
+    files: list[Member] = field(default_factory=list)
+    # Links (tar only), created after the files
+    links: list[Member] = field(default_factory=list)
+    directories: set[PurePosixPath] = field(default_factory=set)
+    errors: list[str] = field(default_factory=list)
+
+    @property
+    def size(self) -> int:
+        return sum(member.size for member in self.files)
+
+    @property
+    def top_level(self) -> set[PurePosixPath]:
+        """
+        The files and directories that end up directly in dst
+        """
+        names = [member.name for member in self.files + self.links] + list(self.directories)
+        return {PurePosixPath(name.parts[0]) for name in names if name.parts}
+
+
+@dataclass
+class ExtractStats:
+    files: int = 0
+    bytes: int = 0
+    # Files that already existed; they are kept
+    skipped: int = 0
+
+
+def is_archive(path: Path) -> bool:
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+
+def name_errors(name: PurePosixPath) -> list[str]:
+    """
+    Reasons that a member name might be dangerous (extract to locations other than the destination)
+    """
+    reasons = []
+    if name.is_absolute(): reasons.append(f"File {name} is an absolute")
+    if any(part == ".." for part in name.parts): reasons.append(f"File {name} contains ..")
+    return reasons
+
+
+# The name of dst itself, like ./ in tar files made with -C dir .
+ROOT = PurePosixPath(".")
+
+
+def _add_parents(plan: Plan, name: PurePosixPath):
+    for parent in name.parents:
+        if parent == ROOT:
+            break
+        plan.directories.add(parent)
+
+
+def plan_zip(zip: zipfile.ZipFile, path: Path, dst: Path) -> Plan:
+    plan = Plan(path, dst, is_zip=True)
+
+    for info in zip.infolist():
+        name = PurePosixPath(info.filename)
+        if errors := name_errors(name):
+            plan.errors.extend(errors)
+        elif name == ROOT:
+            continue
+        elif info.is_dir():
+            plan.directories.add(name)
+        else:
+            plan.files.append(Member(name, info.file_size, info))
+            _add_parents(plan, name)
+
+    return plan
+
+
+def plan_tar(tar: tarfile.TarFile, path: Path, dst: Path) -> Plan:
+    """
+    Besides the names the members pass the "data" filter of tarfile: no links out of dst and no device files
+    """
+    plan = Plan(path, dst, is_zip=False)
+
+    for info in tar:
+        name = PurePosixPath(info.name)
+        if errors := name_errors(name):
+            plan.errors.extend(errors)
+            continue
+        try:
+            info = tarfile.data_filter(info, str(dst))
+        except tarfile.FilterError as e:
+            plan.errors.append(f"File {name}: {e}")
+            continue
+
+        if name == ROOT:
+            continue
+        if info.isdir():
+            plan.directories.add(name)
+        elif info.isfile():
+            plan.files.append(Member(name, info.size, info))
+        elif info.issym() or info.islnk():
+            plan.links.append(Member(name, 0, info))
+        _add_parents(plan, name)
+
+    return plan
+
+
+def plan(path: Path, dst: Path) -> Plan:
+    """
+    Reads the listing of the zip or tar (optionally compressed) file at path
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zip:
+            return plan_zip(zip, path, dst)
+    with tarfile.open(path) as tar:
+        return plan_tar(tar, path, dst)
+
+
+def _copy(src, target: Path) -> bool:
+    """
+    Streams src into the new file target; False if it already exists
+    """
+    try:
+        file = open(target, "xb")
+    except FileExistsError:
+        log.debug(f"Skipping file {target} as it already exists")
+        return False
+
+    try:
+        with file:
+            shutil.copyfileobj(src, file, BUFFER_SIZE)
+    except BaseException:
+        target.unlink(missing_ok=True)
+        raise
+    return True
+
+
+def _extract_zip(plan: Plan, workers: int, done: Callable[[Member, bool], None]):
+    # ZipFile objects serialize reads on their file, so every thread has its own
+    local = threading.local()
+    opened = []
+    lock = threading.Lock()
+
+    def extract_member(member: Member) -> bool:
+        if not hasattr(local, "zip"):
+            local.zip = zipfile.ZipFile(plan.path)
+            with lock:
+                opened.append(local.zip)
+        with local.zip.open(member.info) as src:
+            return _copy(src, plan.dst / member.name)
+
+    pending = {}
+    pool = ThreadPoolExecutor(workers, thread_name_prefix="ffs-extract")
+
+    def wait(return_when):
+        finished, _ = concurrent.futures.wait(pending.keys(), return_when=return_when)
+        for future in finished:
+            done(pending.pop(future), future.result())
+
+    try:
+        for member in plan.files:
+            pending[pool.submit(extract_member, member)] = member
+            if len(pending) >= 2 * workers:
+                wait(concurrent.futures.FIRST_COMPLETED)
+        wait(concurrent.futures.ALL_COMPLETED)
+    finally:
+        pool.shutdown(cancel_futures=True)
+        for zip in opened:
+            zip.close()
+
+
+def _extract_tar(plan: Plan, done: Callable[[Member, bool], None]):
+    # A compressed tar file is one stream, so it is read in order by this thread; the TarInfos of the plan let
+    # tarfile skip the headers (plain tar files) or seek forward (compressed ones) to the data
+    with tarfile.open(plan.path) as tar:
+        for member in plan.files:
+            with tar.extractfile(member.info) as src:
+                done(member, _copy(src, plan.dst / member.name))
+
+        for member in plan.links:
+            if os.path.lexists(plan.dst / member.name):
+                log.debug(f"Skipping link {member.name} as it already exists")
+                continue
+            tar.extract(member.info, plan.dst, set_attrs=False, filter="data")
+
+
+def extract(plan: Plan, workers: int = None, progress: Callable[[int], None] = None) -> ExtractStats:
+    """
+    Extracts the checked plan; existing files are kept. progress is called in this thread with the size of every
+    file once it is done (or skipped), and may raise to stop the extraction.
+    """
+    if plan.errors:
+        raise ValueError(f"{plan.path} is not safe to extract: {plan.errors}")
+
+    workers = workers or settings.FFS_EXTRACT_WORKERS
+    stats = ExtractStats()
+
+    # Parents come before their children, and deeper directories make their parents anyway
+    leaves = set(plan.directories)
+    for directory in plan.directories:
+        leaves.difference_update(directory.parents)
+    plan.dst.mkdir(parents=True, exist_ok=True)
+    for directory in sorted(leaves):
+        (plan.dst / directory).mkdir(parents=True, exist_ok=True)
+
+    def done(member: Member, extracted: bool):
+        if extracted:
+            stats.files += 1
+            stats.bytes += member.size
+        else:
+            stats.skipped += 1
+        if progress is not None:
+            progress(member.size)
+
+    if plan.is_zip:
+        _extract_zip(plan, workers, done)
+    else:
+        _extract_tar(plan, done)
+
+    log.debug(f"Extracted {plan.path} to {plan.dst}: {stats}")
+    return stats
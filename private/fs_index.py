@@ -0,0 +1,409 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import stat
+import struct
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from general import get_mime_type
+from private.models import FsEntry, BlockHashIndex
+from private.paths import subtree_q
+
+log = logging.getLogger("my")
+
+ROOT = "."
+
+
+def enabled() -> bool:
+    return settings.FFS_FS_INDEX
+
+
+def relative(path) -> str:
+    path = str(path)
+    return ROOT if path in ("", ".") else path
+
+
+def full_path_of(path: str) -> Path:
+    return settings.FFS_FS_ROOT if path == ROOT else settings.FFS_FS_ROOT / path
+
+
+def parent_of(path: str) -> str:
+    return "" if path == ROOT else relative(Path(path).parent)
+
+
+def subtree(path: str) -> Q:
+    if path == ROOT:
+        return Q()
+    return subtree_q(path)
+
+
+def make_entry(path: str, st: os.stat_result, now) -> FsEntry:
+    full_path = full_path_of(path)
+    return FsEntry(path=path, parent=parent_of(path), name=full_path.name, is_dir=stat.S_ISDIR(st.st_mode),
+                   size=st.st_size, mtime_ns=st.st_mtime_ns, mime=get_mime_type(full_path, st)[:128],
+                   indexed_at=now)
+
+
+def _link_block_indices(entries: list[FsEntry]):
+    paths = {str(full_path_of(e.path)): e for e in entries if not e.is_dir}
+    indices = BlockHashIndex.objects.filter(path__in=paths.keys(), block_size=settings.FFS_NET_BLOCK_SIZE)
+    for index in indices:
+        paths[index.path].block_index = index
+
+
+def _save(entries: list[FsEntry]):
+    _link_block_indices(entries)
+    FsEntry.objects.bulk_create(entries, update_conflicts=True, unique_fields=["path"],
+                                update_fields=["parent", "name", "is_dir", "size", "mtime_ns", "mime",
+                                               "block_index", "indexed_at"])
+
+
+def remove(path: str):
+    FsEntry.objects.filter(subtree(relative(path))).delete()
+
+
+def update(path: str):
+    """
+    Indexes the path itself (not its contents), or removes it from the index if it does not exist
+    """
+    path = relative(path)
+    try:
+        st = os.stat(full_path_of(path))
+    except (FileNotFoundError, NotADirectoryError):
+        remove(path)
+        return
+
+    _save([make_entry(path, st, timezone.now())])
+
+
+def rescan(path: str = ROOT, batch_size: int = 1000) -> int:
+    """
+    Indexes everything below the path and removes entries that no longer exist. Returns the number of entries.
+    """
+    path = relative(path)
+    start = timezone.now()
+    count = 0
+    batch = []
+
+    try:
+        root_stat = os.stat(full_path_of(path))
+    except FileNotFoundError:
+        remove(path)
+        return 0
+
+    batch.append(make_entry(path, root_stat, start))
+    directories = [path] if stat.S_ISDIR(root_stat.st_mode) else []
+
+    while len(directories) > 0:
+        directory = directories.pop()
+        try:
+            with os.scandir(full_path_of(directory)) as it:
+                children = list(it)
+        except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
+            log.warning(f"Cannot index {directory}: {e}")
+            continue
+
+        for child in children:
+            child_path = child.name if directory == ROOT else f"{directory}/{child.name}"
+            try:
+                st = child.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            batch.append(make_entry(child_path, st, start))
+            if stat.S_ISDIR(st.st_mode):
+                directories.append(child_path)
+
+            if len(batch) >= batch_size:
+                _save(batch)
+                count += len(batch)
+                batch = []
+
+    _save(batch)
+    count += len(batch)
+
+    FsEntry.objects.filter(subtree(path), indexed_at__lt=start).delete()
+    return count
+
+
+def _unindexed_top(path: str) -> str | None:
+    """
+    The path or its topmost ancestor whose parent is not indexed; None if the index was never built
+    """
+    while path != ROOT and not FsEntry.objects.filter(path=parent_of(path)).exists():
+        path = parent_of(path)
+
+    if path == ROOT and not FsEntry.objects.filter(path=ROOT).exists():
+        return None
+    return path
+
+
+def changed(path):
+    """
+    Brings the index up to date after the API changed the path (and maybe created its parents); everything below
+    the path is rescanned, so this is meant for files and new directories.
+    Does nothing if the index is disabled or was never built.
+    """
+    if not enabled():
+        return
+
+    if (top := _unindexed_top(relative(path))) is not None:
+        rescan(top)
+
+
+def written(directory, names, batch_size: int = 1000):
+    """
+    Indexes the entries that the API has just created in the directory, given by their paths relative to it
+    (like the members of an unzipped archive), without rescanning what was there before
+    """
+    if not enabled():
+        return
+
+    directory = relative(directory)
+    if (top := _unindexed_top(directory)) is None:
+        return
+    if top != directory or not FsEntry.objects.filter(path=directory).exists():
+        rescan(top)
+        return
+
+    update(directory)
+    now = timezone.now()
+    batch = []
+    for name in names:
+        path = str(name) if directory == ROOT else f"{directory}/{name}"
+        try:
+            st = os.lstat(full_path_of(path))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        batch.append(make_entry(path, st, now))
+        if len(batch) >= batch_size:
+            _save(batch)
+            batch = []
+    _save(batch)
+
+
+def move(src, dst, batch_size: int = 1000):
+    """
+    Moves the entries at or below src to dst, like the files were moved
+    """
+    if not enabled():
+        return
+
+    src = relative(src)
+    dst = relative(dst)
+    remove(dst)
+    if not FsEntry.objects.filter(path=parent_of(dst)).exists():
+        # The move created the parents of dst
+        remove(src)
+        changed(dst)
+        return
+
+    entries = list(FsEntry.objects.filter(subtree(src)))
+    for entry in entries:
+        entry.path = dst + entry.path[len(src):]
+        entry.parent = parent_of(entry.path)
+        entry.name = full_path_of(entry.path).name
+    FsEntry.objects.bulk_update(entries, ["path", "parent", "name"], batch_size=batch_size)
+
+    update(parent_of(src))
+    update(parent_of(dst))
+    update(dst)
+
+
+def get(path) -> FsEntry | None:
+    return FsEntry.objects.filter(path=relative(path)).first()
+
+
+def list_directory(path, prefix: str = None, offset: int = 0, limit: int = None) -> list[FsEntry] | None:
+    """
+    Like listing.list_directory, but from the index. None if the directory is not indexed.
+    """
+    path = relative(path)
+    if not FsEntry.objects.filter(path=path, is_dir=True).exists():
+        return None
+
+    # Directories first
+    entries = FsEntry.objects.filter(parent=path).order_by("-is_dir", "name")
+    if prefix:
+        entries = entries.filter(name__startswith=prefix)
+
+    if limit is None:
+        return list(entries[offset:])
+    return list(entries[offset:offset + limit])
+
+
+def info(path, level: int) -> dict | None:
+    """
+    Like the api_info response, but from the index. None if the path is not indexed.
+    """
+    if (root := get(path)) is None:
+        return None
+
+    entries = [root]
+    parents = [root.path] if root.is_dir else []
+
+    for _ in range(level):
+        if len(parents) == 0:
+            break
+        children = []
+        for i in range(0, len(parents), 500):
+            children += FsEntry.objects.filter(parent__in=parents[i:i + 500]).order_by("path")
+        entries += children
+        parents = [c.path for c in children if c.is_dir]
+
+    return {e.path: {"path": e.path, "name": e.name, "size": e.size, "mime": e.mime} for e in entries}
+
+
+def mime_for(path, st: os.stat_result) -> str | None:
+    """
+    The indexed mime type, if the index is up to date for the file
+    """
+    entry = get(path)
+    if entry is not None and entry.is_valid_for(st):
+        return entry.mime
+    return None
+
+
+def largest_files(under=ROOT, n: int = 100):
+    return FsEntry.objects.filter(subtree(relative(under)), is_dir=False).order_by("-size")[:n]
+
+
+def files_by_mime(mime: str, under=ROOT):
+    """
+    Files with the mime type, or the class of mime types (like "video")
+    """
+    query = Q(mime=mime) if "/" in mime else Q(mime__startswith=mime + "/")
+    return FsEntry.objects.filter(subtree(relative(under)), query, is_dir=False).order_by("path")
+
+
+# inotify(7)
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII")
+
+UPDATE = "update"
+REMOVE = "remove"
+RESCAN = "rescan"
+
+
+class InotifyWatcher:
+    """
+    Watches all directories of the FFS with inotify and turns the events into index updates
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.rm_watch = libc.inotify_rm_watch
+        self.rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+
+    def close(self):
+        os.close(self.fd)
+
+    def watch(self, path: str):
+        """
+        Watches the directory and all directories below it
+        """
+        stack = [path]
+        while len(stack) > 0:
+            directory = stack.pop()
+            wd = self.add_watch(self.fd, os.fsencode(full_path_of(directory)), WATCH_MASK)
+            if wd < 0:
+                log.error(f"Cannot watch {directory}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self.directories[wd] = directory
+
+            try:
+                with os.scandir(full_path_of(directory)) as it:
+                    for child in it:
+                        if child.is_dir(follow_symlinks=False):
+                            stack.append(child.name if directory == ROOT else f"{directory}/{child.name}")
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+    def unwatch(self, path: str):
+        for wd, directory in list(self.directories.items()):
+            if directory == path or directory.startswith(path + "/"):
+                self.rm_watch(self.fd, wd)
+                del self.directories[wd]
+
+    def poll(self, timeout: float = None) -> dict:
+        """
+        Waits for events and returns what needs to happen to the index, as a dictionary from paths to
+        UPDATE, REMOVE or RESCAN
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return {}
+
+        data = os.read(self.fd, 2 ** 16)
+        actions = {}
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                log.warning("The inotify queue overflowed, rescanning everything")
+                return {ROOT: RESCAN}
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            if (directory := self.directories.get(wd)) is None:
+                continue
+
+            path = directory if name == "" else (name if directory == ROOT else f"{directory}/{name}")
+
+            if mask & IN_DELETE_SELF:
+                actions[path] = REMOVE
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                actions[path] = REMOVE
+                if mask & IN_ISDIR:
+                    self.unwatch(path)
+            elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch(path)
+                actions[path] = RESCAN
+            elif actions.get(path) != RESCAN:
+                actions[path] = UPDATE
+
+        return actions
+
+    def run(self):
+        while True:
+            for path, action in self.poll().items():
+                try:
+                    match action:
+                        case "update":
+                            update(path)
+                        case "remove":
+                            remove(path)
+                        case "rescan":
+                            rescan(path)
+                except Exception as e:
+                    log.error(f"Could not {action} {path} in the index: {e}")
@@ -0,0 +1,116 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+
+
+class FileHasher:
+    def __init__(self, path: Path, buffer_size: int = 2 ** 16):
+        self.path = path
+        self.buffer_size = buffer_size
+
+    def __enter__(self):
+        self.buffer = bytearray(self.buffer_size)
+        self.memory_view = memoryview(self.buffer)
+        self.fp = open(self.path, "rb", buffering=0)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.fp.close()
+
+    def hash(self, start, length, debug=False):
+        if debug:
+            hsh = []
+        else:
+            hsh = hashlib.sha256()
+        self.fp.seek(start, os.SEEK_SET)
+
+        while length > 0 and (n := self.fp.readinto(self.memory_view[:min(length, self.buffer_size)])):
+            memory = self.memory_view[:n]
+            if debug:
+                hsh.append(memory.tobytes().decode())
+            else:
+                hsh.update(memory)
+            length -= n
+
+        if debug:
+            return hsh
+        else:
+            return hsh.hexdigest()
+
+
+def _read_into(fd: int, view: memoryview, offset: int) -> int:
+    """
+    Fills the view with the file contents at offset, returns how much could be read
+    """
+    total = 0
+    while total < len(view):
+        if hasattr(os, "preadv"):
+            n = os.preadv(fd, [view[total:]], offset + total)
+        else:
+            data = os.pread(fd, len(view) - total, offset + total)
+            n = len(data)
+            view[total:total + n] = data
+        if n == 0:
+            break
+        total += n
+    return total
+
+
+class ParallelHasher:
+    """
+    Hashes the blocks of a file on several threads.
+
+    Each thread hashes a contiguous range of blocks into its own preallocated buffer. hashlib releases
+    the GIL for larger updates, so this scales with the number of cores (and the speed of the disk).
+    """
+
+    def __init__(self, path: Path, block_size: int, workers: int = None, buffer_size: int = 2 ** 20):
+        self.path = path
+        self.block_size = block_size
+        self.workers = workers or settings.FFS_HASH_WORKERS
+        self.buffer_size = min(buffer_size, block_size)
+
+    def _hash_range(self, fd: int, size: int, first: int, last: int) -> list[str]:
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        hashes = []
+
+        for block in range(first, last):
+            hsh = hashlib.sha256()
+            offset = block * self.block_size
+            end = min(offset + self.block_size, size)
+
+            while offset < end:
+                n = _read_into(fd, view[:min(self.buffer_size, end - offset)], offset)
+                if n == 0:
+                    break
+                hsh.update(view[:n])
+                offset += n
+
+            hashes.append(hsh.hexdigest())
+
+        return hashes
+
+    def hash_blocks(self, size: int = None) -> list[str]:
+        """
+        The hashes of all blocks of the file, in order
+        """
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            if size is None:
+                size = os.fstat(fd).st_size
+            blocks = (size + self.block_size - 1) // self.block_size
+            workers = max(1, min(self.workers, blocks))
+
+            if workers == 1:
+                return self._hash_range(fd, size, 0, blocks)
+
+            bounds = [blocks * i // workers for i in range(workers + 1)]
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hasher") as executor:
+                parts = executor.map(lambda i: self._hash_range(fd, size, bounds[i], bounds[i + 1]), range(workers))
+                return [hsh for part in parts for hsh in part]
+        finally:
+            os.close(fd)
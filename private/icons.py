@@ -1,43 +1,522 @@
+import concurrent.futures
+import hashlib
+import json
 import logging
-import subprocess
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from typing import Callable
 
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from general import UserError, get_mime_type
+from private import thumbnail_worker, listing
+from private.atomic import replacing
+from private.models import ImageIcon
+from private.paths import subtree_q
 
 log = logging.getLogger("my")
 
 fs_root = settings.FFS_FS_ROOT
 img_icon_root = settings.FFS_IMAGE_ICONS
+sprite_root = img_icon_root / "sprites"
+
+CONTENT_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg"}
+SPRITE_COLUMNS = 16
+EVICTION_ORDER = {"lru": ["last_used"], "lfu": ["hits", "last_used"]}
+# Eviction goes below the budget by this factor, so that not every new icon causes another eviction
+EVICTION_TARGET = 0.9
+# The icons are only summed up (and maybe evicted) after this many new ones
+EVICT_EVERY = 50
+# Hits are counted in memory and written at most this often (seconds), so that viewing icons does not write
+HIT_FLUSH_INTERVAL = 60
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+# Files that are being rendered right now, so that concurrent requests for one file render it only once
+_in_flight: dict[Path, Future] = {}
+_in_flight_lock = threading.Lock()
+_rendered = 0
+_hits: dict[int, int] = {}
+_hits_flushed = time.monotonic()
+_counters_lock = threading.Lock()
+
+
+def parse_size(size: str | None) -> int:
+    if size is None:
+        return settings.FFS_ICON_SIZES[0]
+    if not size.isdigit() or int(size) not in settings.FFS_ICON_SIZES:
+        raise UserError(f"Invalid icon size {size}, the only options are {settings.FFS_ICON_SIZES}")
+    return int(size)
+
+
+def parse_format(fmt: str | None) -> str:
+    if fmt is None:
+        return settings.FFS_ICON_FORMAT
+    if fmt not in CONTENT_TYPES:
+        raise UserError(f"Invalid icon format {fmt}, the only options are {list(CONTENT_TYPES)}")
+    return fmt
+
+
+def get_icon_file(path: Path, size: int, fmt: str) -> Path:
+    return img_icon_root / str(size) / f"{path}.{fmt}"
+
+
+def is_image(full_path: Path, stat: os.stat_result = None) -> bool:
+    return get_mime_type(full_path, stat).startswith("image/")
+
+
+def _make_pool(workers: int) -> ProcessPoolExecutor:
+    # forkserver: the workers neither inherit the threads nor the database connections of this process
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("forkserver"))
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _make_pool(settings.FFS_ICON_WORKERS)
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+
+def _submit(fn, *args) -> Future:
+    """
+    Runs the function of thumbnail_worker in the process pool (or right here, without workers)
+    """
+    if settings.FFS_ICON_WORKERS > 0:
+        return _get_pool().submit(fn, *args)
+
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def _run(fn, *args):
+    try:
+        return _submit(fn, *args).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. killed because a huge image used too much memory); the next request gets a new pool
+        _reset_pool()
+        raise
+
+
+def _coalesced(file: Path, create):
+    """
+    Calls create() to make the file, or waits for the call that another thread started already
+    """
+    with _in_flight_lock:
+        future = _in_flight.get(file)
+        owner = future is None
+        if owner:
+            future = _in_flight[file] = Future()
+
+    if not owner:
+        return future.result()
+
+    try:
+        future.set_result(create())
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with _in_flight_lock:
+            del _in_flight[file]
+
+    return future.result()
+
+
+def _subtree(path) -> Q:
+    return subtree_q(str(path))
+
+
+def valid_icon(path: Path, size: int, fmt: str, stat: os.stat_result) -> ImageIcon | None:
+    icon = ImageIcon.objects.filter(path=str(path), size=size, format=fmt).first()
+    if icon is None or not icon.is_valid_for(stat) or not get_icon_file(path, size, fmt).exists():
+        return None
+    return icon
+
+
+def _record(path: Path, size: int, fmt: str, stat: os.stat_result):
+    """
+    Remembers that the icon was made from the image as it was at stat
+    """
+    ImageIcon.objects.update_or_create(path=str(path), size=size, format=fmt, defaults={
+        "src_size": stat.st_size,
+        "src_mtime_ns": stat.st_mtime_ns,
+        "bytes": get_icon_file(path, size, fmt).stat().st_size,
+        "last_used": timezone.now(),
+    })
+
+
+def count_hits(pks: list[int]):
+    """
+    Counts a use of the icons; the counts are written by flush_hits()
+    """
+    with _counters_lock:
+        for pk in pks:
+            _hits[pk] = _hits.get(pk, 0) + 1
+        if time.monotonic() - _hits_flushed < HIT_FLUSH_INTERVAL:
+            return
+    flush_hits()
+
+
+def flush_hits():
+    """
+    Writes the counted hits; icons with the same number of hits share an UPDATE
+    """
+    global _hits, _hits_flushed
+    with _counters_lock:
+        hits, _hits = _hits, {}
+        _hits_flushed = time.monotonic()
+    if len(hits) == 0:
+        return
+
+    by_count = defaultdict(list)
+    for pk, count in hits.items():
+        by_count[count].append(pk)
+    now = timezone.now()
+    with transaction.atomic():
+        for count, pks in by_count.items():
+            for i in range(0, len(pks), 500):
+                ImageIcon.objects.filter(pk__in=pks[i:i + 500]).update(hits=F("hits") + count, last_used=now)
+
+
+def _count_rendered(count: int = 1):
+    """
+    Evicts after every EVICT_EVERY new icons, instead of summing all icons up after each one
+    """
+    global _rendered
+    with _counters_lock:
+        _rendered += count
+        if _rendered < EVICT_EVERY:
+            return
+        _rendered = 0
+    evict()
 
 
-def get_icon_file(path: Path):
-    return img_icon_root / f"{path}.jpg"
+def _touch_sprite(map_file: Path):
+    """
+    Marks the sprite as used (by the modification time of its map), at most once per HIT_FLUSH_INTERVAL
+    """
+    try:
+        if time.time() - map_file.stat().st_mtime > HIT_FLUSH_INTERVAL:
+            os.utime(map_file)
+    except FileNotFoundError:
+        pass
 
 
-def create_icon(path: Path):
+def evict_sprites(budget: int = None, max_age: float = None) -> tuple[int, int]:
+    """
+    Deletes the sprites that were not used for max_age seconds, and then the least recently used ones while all
+    of them together are larger than the budget. Returns the number of deleted sprites and their size.
+    """
+    budget = settings.FFS_SPRITE_BUDGET_BYTES if budget is None else budget
+    max_age = settings.FFS_SPRITE_MAX_AGE_SECONDS if max_age is None else max_age
+
+    # The sprite and the map of a page version share their stem; the map tells when it was used last
+    sprites = defaultdict(lambda: {"bytes": 0, "last_used": 0.0, "files": []})
+    for directory, _, names in os.walk(sprite_root):
+        for name in names:
+            if name.startswith("."):
+                continue
+            file = Path(directory) / name
+            try:
+                st = file.stat()
+            except FileNotFoundError:
+                continue
+            sprite = sprites[file.with_suffix("")]
+            sprite["bytes"] += st.st_size
+            sprite["last_used"] = max(sprite["last_used"], st.st_mtime)
+            sprite["files"].append(file)
+
+    total = sum(sprite["bytes"] for sprite in sprites.values())
+    expired = time.time() - max_age
+    over_budget = total > budget
+    deleted = freed = 0
+    for sprite in sorted(sprites.values(), key=lambda s: s["last_used"]):
+        if sprite["last_used"] >= expired and not (over_budget and total > budget * EVICTION_TARGET):
+            break
+        # Maps first, like in sprite_files()
+        for file in sorted(sprite["files"], key=lambda f: f.suffix != ".json"):
+            file.unlink(missing_ok=True)
+        total -= sprite["bytes"]
+        freed += sprite["bytes"]
+        deleted += 1
+
+    if deleted > 0:
+        log.info(f"Evicted {deleted} sprites ({freed} bytes)")
+    return deleted, freed
+
+
+def evict(budget: int = None) -> tuple[int, int]:
+    """
+    Deletes icons in FFS_ICON_EVICTION order while all icons together are larger than the budget, and the sprites
+    as evict_sprites() does. Returns the number of deleted icons and their size.
+    """
+    budget = settings.FFS_ICON_BUDGET_BYTES if budget is None else budget
+    evict_sprites()
+    flush_hits()
+    total = ImageIcon.objects.aggregate(total=Sum("bytes"))["total"] or 0
+    if total <= budget:
+        return 0, 0
+
+    target = budget * EVICTION_TARGET
+    deleted = freed = 0
+    order = EVICTION_ORDER[settings.FFS_ICON_EVICTION]
+
+    while total > target:
+        batch = list(ImageIcon.objects.order_by(*order)[:500])
+        if len(batch) == 0:
+            break
+        evicted = []
+        for icon in batch:
+            if total <= target:
+                break
+            get_icon_file(Path(icon.path), icon.size, icon.format).unlink(missing_ok=True)
+            evicted.append(icon.pk)
+            total -= icon.bytes
+            freed += icon.bytes
+        ImageIcon.objects.filter(pk__in=evicted).delete()
+        deleted += len(evicted)
+
+    log.info(f"Evicted {deleted} image icons ({freed} bytes)")
+    return deleted, freed
+
+
+def create_icon(path: Path, size: int, fmt: str, stat: os.stat_result) -> Path:
+    icon_file = get_icon_file(path, size, fmt)
+
+    def create():
+        try:
+            _run(thumbnail_worker.render, str(fs_root / path), str(icon_file), size, fmt, settings.FFS_ICON_QUALITY)
+        except Exception as e:
+            msg = (f"Could not create image icon:\n"
+                   f"Image path: {fs_root / path}\n"
+                   f"Icon path: {icon_file}\n"
+                   f"Error: {e!r}")
+            log.error(msg)
+            raise RuntimeError(msg)
+        _record(path, size, fmt, stat)
+        _count_rendered()
+        return icon_file
+
+    return _coalesced(icon_file, create)
+
+
+def img_file_icon(path: Path, size: int = None, fmt: str = None, stat: os.stat_result = None) -> Path:
+    """
+    The icon of the image, rendered again if the image changed since the icon was made
+    """
+    size = size or settings.FFS_ICON_SIZES[0]
+    fmt = fmt or settings.FFS_ICON_FORMAT
+    stat = stat or os.stat(fs_root / path)
+
+    if (icon := valid_icon(path, size, fmt, stat)) is not None:
+        count_hits([icon.pk])
+        return get_icon_file(path, size, fmt)
+
+    return create_icon(path, size, fmt, stat)
+
+
+def move(src: Path, dst: Path):
+    """
+    Moves the icons (and forgets the sprites) of everything at or below src to dst
+    """
+    remove(dst)
+    src = str(src)
+    dst = str(dst)
+    icons = list(ImageIcon.objects.filter(_subtree(src)))
+
+    for icon in icons:
+        old_file = get_icon_file(Path(icon.path), icon.size, icon.format)
+        icon.path = dst + icon.path[len(src):]
+        new_file = get_icon_file(Path(icon.path), icon.size, icon.format)
+        try:
+            new_file.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(old_file, new_file)
+        except FileNotFoundError:
+            pass
+
+    ImageIcon.objects.bulk_update(icons, ["path"])
+    shutil.rmtree(sprite_root / src, ignore_errors=True)
+
+
+def remove(path: Path):
+    """
+    Deletes the icons and sprites of everything at or below the path
+    """
+    icons = ImageIcon.objects.filter(_subtree(path))
+    for icon in icons:
+        get_icon_file(Path(icon.path), icon.size, icon.format).unlink(missing_ok=True)
+    icons.delete()
+    shutil.rmtree(sprite_root / path, ignore_errors=True)
+
+
+def image_files(path: Path):
+    """
+    The paths of all images at or below the path
+    """
     full_path = fs_root / path
-    icon_file = get_icon_file(path)
-    icon_file.parent.mkdir(parents=True, exist_ok=True)
-    cmd = f'convert -resize 32x32! "{full_path}" "{icon_file}"'
-    output = subprocess.run(cmd,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    if full_path.is_file():
+        if is_image(full_path):
+            yield Path(path)
+        return
+
+    for directory, _, files in os.walk(full_path):
+        for name in files:
+            file = Path(directory) / name
+            try:
+                if is_image(file):
+                    yield file.relative_to(fs_root)
+            except OSError:
+                continue
+
+
+def generate(path: Path, sizes: list[int] = None, fmt: str = None, workers: int = None) -> tuple[int, int]:
+    """
+    Renders the missing icons of all images at or below the path, workers at a time.
+    Returns how many icons were created and how many failed.
+    """
+    sizes = sizes or settings.FFS_ICON_SIZES
+    fmt = fmt or settings.FFS_ICON_FORMAT
+    if not workers and settings.FFS_ICON_WORKERS == 0:
+        workers = os.cpu_count() or 1
+    pool = _make_pool(workers) if workers else _get_pool()
+    max_pending = 2 * (workers or settings.FFS_ICON_WORKERS or 1)
+    pending = {}
+    created = failed = 0
+
+    def wait(return_when):
+        nonlocal created, failed
+        done, _ = concurrent.futures.wait(pending.keys(), return_when=return_when)
+        for future in done:
+            image, size, stat = pending.pop(future)
+            if future.exception() is None:
+                _record(image, size, fmt, stat)
+                created += 1
+            else:
+                failed += 1
+                log.warning(f"Could not create the icon of {image}: {future.exception()!r}")
+
+    try:
+        for image in image_files(path):
+            stat = os.stat(fs_root / image)
+            for size in sizes:
+                if valid_icon(image, size, fmt, stat) is not None:
+                    continue
+                future = pool.submit(thumbnail_worker.render, str(fs_root / image),
+                                     str(get_icon_file(image, size, fmt)), size, fmt, settings.FFS_ICON_QUALITY)
+                pending[future] = (image, size, stat)
+                if len(pending) >= max_pending:
+                    wait(concurrent.futures.FIRST_COMPLETED)
+        wait(concurrent.futures.ALL_COMPLETED)
+    finally:
+        if workers:
+            pool.shutdown()
+
+    evict()
+    return created, failed
+
+
+def _generate_thread(paths: list[Path]):
+    for path in paths:
+        try:
+            generate(path)
+        except Exception as e:
+            log.error(f"Could not create the image icons for {path}: {e!r}")
+    connection.close()
+
+
+def generate_in_background(*paths: Path):
+    """
+    Renders the icons for new files ahead of time, if FFS_ICON_PREGENERATE is set
+    """
+    if settings.FFS_ICON_PREGENERATE and settings.FFS_ICON_WORKERS > 0:
+        threading.Thread(target=_generate_thread, args=(paths,), name="icons", daemon=True).start()
+
+
+def sprite_files(path: Path, size: int, fmt: str, offset: int = 0, limit: int = None,
+                 columns: int = SPRITE_COLUMNS, allowed: Callable[[Path], bool] = None,
+                 user: str = "") -> tuple[Path, Path]:
+    """
+    One image with the icons of all images among the (offset, limit) page of the directory listing that
+    allowed(path) accepts, and a JSON file with the position of each icon in it. Both are cached until one of
+    the images changes; the sprites of different users are kept apart.
+    """
+    images = {}
+    for entry in listing.list_directory(fs_root / path, None, offset, limit):
+        if not entry.is_file():
+            continue
+        if allowed is not None and not allowed(path / entry.name):
+            continue
+        st = entry.stat()
+        if is_image(Path(entry.path), st):
+            images[entry.name] = st
+
+    key = hashlib.sha256(json.dumps([[(name, st.st_size, st.st_mtime_ns) for name, st in images.items()],
+                                     size, fmt, columns]).encode()).hexdigest()
+    # The prefix identifies the page, so that older versions of it can be deleted
+    prefix = f"{offset}-{limit}-{size}-{columns}-{fmt}-{hashlib.sha256(user.encode()).hexdigest()[:16]}-"
+    sprite_file = sprite_root / path / f"{prefix}{key}.{fmt}"
+    map_file = sprite_root / path / f"{prefix}{key}.json"
+
+    def create():
+        valid = {name: valid_icon(path / name, size, fmt, st) for name, st in images.items()}
+        count_hits([icon.pk for icon in valid.values() if icon is not None])
+
+        missing = [name for name, icon in valid.items() if icon is None]
+        futures = {name: _submit(thumbnail_worker.render, str(fs_root / path / name),
+                                 str(get_icon_file(path / name, size, fmt)), size, fmt, settings.FFS_ICON_QUALITY)
+                   for name in missing}
 
-    if not icon_file.exists():
-        msg = (f"Could not create image icon:\n"
-               f"Image path: {full_path}\n"
-               f"Icon path: {icon_file}\n"
-               f"Stdout:\n{output.stdout.decode()}\n"
-               f"Stderr:\n{output.stderr.decode()}\n"
-               f"Full command: {cmd}")
+        broken = set()
+        for name, future in futures.items():
+            if future.exception() is None:
+                _record(path / name, size, fmt, images[name])
+            else:
+                # Broken images are left out
+                log.warning(f"Could not create the icon of {path / name}: {future.exception()!r}")
+                broken.add(name)
 
-        log.error(msg)
-        raise RuntimeError(msg)
+        names = [name for name in images if name not in broken]
+        boxes = _run(thumbnail_worker.render_sprite, [str(get_icon_file(path / name, size, fmt)) for name in names],
+                     str(sprite_file), size, columns, fmt, settings.FFS_ICON_QUALITY)
+        # The map comes last, as it tells that the sprite is complete
+        with replacing(map_file) as tmp:
+            tmp.write_text(json.dumps({
+                "size": size,
+                "columns": columns,
+                "icons": dict(zip(names, boxes)),
+            }))
 
+        # Maps first, so that no map is left without its sprite
+        for old in sorted(map_file.parent.glob(f"{prefix}*"), key=lambda f: f.suffix != ".json"):
+            if old not in (sprite_file, map_file):
+                old.unlink(missing_ok=True)
 
-def img_file_icon(path: Path) -> Path:
-    icon_file = get_icon_file(path)
+        # The new sprite counts like an icon
+        _count_rendered(len(missing) + 1)
 
-    if not icon_file.exists():
-        create_icon(path)
+    if map_file.exists():
+        _touch_sprite(map_file)
+    else:
+        _coalesced(map_file, create)
 
-    return icon_file
+    return sprite_file, map_file
@@ -0,0 +1,284 @@
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Callable
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.http import JsonResponse
+from django.urls import reverse
+from django.utils import timezone
+
+from private.models import Job
+
+log = logging.getLogger("my")
+
+# Progress is written to the database at most this often
+PROGRESS_INTERVAL = 0.5
+# Runners renew the heartbeats of their jobs this often (seconds) and look for queued jobs at least this often
+HEARTBEAT_INTERVAL = 10
+# Running jobs whose heartbeat is older than this (seconds) have lost their process and are failed
+STALE_AFTER = 6 * HEARTBEAT_INTERVAL
+# Runners in the web server processes look less and less often while there is nothing to do, down to this often
+IDLE_INTERVAL = 5 * 60
+
+_kinds: dict[str, Callable] = {}
+_runner: "Runner | None" = None
+_runner_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobFailed(Exception):
+    """
+    Ends the job as FAILED with the result, for failures that the client should be able to look at
+    """
+
+    def __init__(self, message: str, result: dict = None):
+        super().__init__(message)
+        self.result = result
+
+
+def kind(name: str):
+    """
+    Registers the function as the job kind; it is called with a JobContext and the arguments of the job
+    """
+
+    def decorator(func):
+        _kinds[name] = func
+        return func
+
+    return decorator
+
+
+class JobContext:
+    """
+    Lets a job report its progress and notice that it was cancelled. Without a job (when the work is done
+    in the request) all of this does nothing.
+    """
+
+    def __init__(self, job: Job | None):
+        self.job = job
+        self.last_flush = 0.0
+
+    def set_total(self, files: int = None, size: int = None):
+        if self.job is None:
+            return
+        self.job.files_total = files
+        self.job.bytes_total = size
+        self.flush(force=True)
+
+    def progress(self, files: int = 0, size: int = 0):
+        """
+        Adds to what is done; raises JobCancelled if the job should stop
+        """
+        if self.job is None:
+            return
+        self.job.files_done += files
+        self.job.bytes_done += size
+        self.flush()
+
+    def flush(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last_flush < PROGRESS_INTERVAL:
+            return
+        self.last_flush = now
+
+        Job.objects.filter(pk=self.job.pk).update(files_done=self.job.files_done, files_total=self.job.files_total,
+                                                  bytes_done=self.job.bytes_done, bytes_total=self.job.bytes_total)
+        if Job.objects.filter(pk=self.job.pk, cancel_requested=True).exists():
+            raise JobCancelled()
+
+
+NO_JOB = JobContext(None)
+
+
+def claim(pk: int = None) -> Job | None:
+    """
+    Marks the queued job (or the oldest one) as running in this process; None if there is none (anymore)
+    """
+    while True:
+        queued = Job.objects.filter(status=Job.QUEUED)
+        if pk is None:
+            candidate = queued.order_by("created").values_list("pk", flat=True).first()
+            if candidate is None:
+                return None
+        else:
+            candidate = pk
+
+        now = timezone.now()
+        if queued.filter(pk=candidate).update(status=Job.RUNNING, started=now, heartbeat=now) == 1:
+            return Job.objects.get(pk=candidate)
+        if pk is not None:
+            return None
+        # Another process was faster
+
+
+def execute(job: Job) -> Job:
+    """
+    Runs the claimed job and records how it ended
+    """
+    context = JobContext(job)
+
+    try:
+        # The progress is saved below; a cancel that comes after the work is done does not undo it
+        result = _kinds[job.kind](context, **job.args)
+        job.status = Job.DONE
+        job.result = result
+    except JobCancelled:
+        job.status = Job.CANCELLED
+    except JobFailed as e:
+        job.status = Job.FAILED
+        job.result = e.result
+        job.error = str(e)
+    except Exception as e:
+        log.error(f"Job {job} failed: {traceback.format_exc()}")
+        job.status = Job.FAILED
+        job.error = str(e) or repr(e)
+
+    job.finished = timezone.now()
+    job.save(update_fields=["status", "result", "error", "finished", "files_done", "files_total", "bytes_done",
+                            "bytes_total"])
+    return job
+
+
+def run_job(pk: int) -> Job | None:
+    """
+    Runs the queued job here and now; returns None if it is not queued (anymore)
+    """
+    if (job := claim(pk)) is None:
+        return None
+    return execute(job)
+
+
+def fail_stale() -> int:
+    """
+    Fails the running jobs whose process has stopped (without renewing their heartbeat). They are not run again,
+    as they might have done part of their work, like a move that was copying.
+    """
+    stale = timezone.now() - timedelta(seconds=STALE_AFTER)
+    return Job.objects.filter(Q(heartbeat__lt=stale) | Q(heartbeat=None, started__lt=stale), status=Job.RUNNING) \
+        .update(status=Job.FAILED, error="The process running the job stopped", finished=timezone.now())
+
+
+class Runner:
+    """
+    Claims queued jobs and runs up to workers of them at a time, keeping up their heartbeats.
+    Any number of runners in any number of processes can work on the same queue.
+    """
+
+    def __init__(self, workers: int, poll_interval: float = HEARTBEAT_INTERVAL, idle_interval: float = None):
+        self.workers = workers
+        self.poll_interval = min(poll_interval, HEARTBEAT_INTERVAL)
+        # Waits twice as long after every look that found nothing to do, up to this; wakeup.set() ends a wait
+        self.idle_interval = max(self.poll_interval, idle_interval or self.poll_interval)
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="ffs-job")
+        self.running: set[int] = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def _execute(self, job: Job):
+        try:
+            execute(job)
+        except Exception as e:
+            log.error(f"Could not run job {job}: {e!r}")
+        finally:
+            connection.close()
+            with self.lock:
+                self.running.discard(job.pk)
+            self.wakeup.set()
+
+    def step(self) -> bool:
+        """
+        Renews the heartbeats and starts queued jobs while workers are free; False if there is nothing to do
+        """
+        with self.lock:
+            running = list(self.running)
+        if running:
+            Job.objects.filter(pk__in=running, status=Job.RUNNING).update(heartbeat=timezone.now())
+        if (stale := fail_stale()) > 0:
+            log.warning(f"Failed {stale} jobs whose process stopped")
+
+        while len(running) < self.workers and (job := claim()) is not None:
+            with self.lock:
+                self.running.add(job.pk)
+            running.append(job.pk)
+            self.pool.submit(self._execute, job)
+
+        return len(running) > 0
+
+    def run(self, once: bool = False):
+        """
+        Works on the queue forever, or until it is empty with once
+        """
+        interval = self.poll_interval
+        try:
+            while True:
+                # Cleared before looking, so that jobs queued while looking are not missed
+                self.wakeup.clear()
+                try:
+                    busy = self.step()
+                    if not busy and once:
+                        return
+                    interval = self.poll_interval if busy else min(2 * interval, self.idle_interval)
+                except Exception as e:
+                    # Like a locked database; the next step tries again
+                    log.error(f"Could not look after the jobs: {e!r}")
+                    connection.close()
+                self.wakeup.wait(interval)
+        finally:
+            self.pool.shutdown()
+            connection.close()
+
+
+def start_runner() -> Runner | None:
+    """
+    Starts running jobs in threads of this process, if FFS_JOB_WORKERS says so. Only processes that queue a job
+    start one; it also picks up the jobs that were left queued, like before a restart.
+    """
+    global _runner
+    if settings.FFS_JOB_WORKERS <= 0:
+        return None
+    with _runner_lock:
+        if _runner is None:
+            _runner = Runner(settings.FFS_JOB_WORKERS, idle_interval=IDLE_INTERVAL)
+            threading.Thread(target=_runner.run, name="ffs-job-runner", daemon=True).start()
+        return _runner
+
+
+def enqueue(kind_name: str, user, **args) -> Job:
+    """
+    Queues the job. Once the transaction commits, a thread of this process runs it, unless
+    FFS_JOB_WORKERS is 0; then a separate manage.py ffs_worker process picks it up.
+    """
+    if kind_name not in _kinds:
+        raise ValueError(f"Unknown job kind {kind_name}")
+
+    job = Job.objects.create(kind=kind_name, user=str(user), args=args)
+    if (runner := start_runner()) is not None:
+        transaction.on_commit(runner.wakeup.set)
+    return job
+
+
+def cancel(job: Job):
+    """
+    Queued jobs are cancelled right away, running ones stop the next time they report progress
+    """
+    if Job.objects.filter(pk=job.pk, status=Job.QUEUED).update(status=Job.CANCELLED, cancel_requested=True,
+                                                               finished=timezone.now()) == 0:
+        Job.objects.filter(pk=job.pk).update(cancel_requested=True)
+    job.refresh_from_db()
+
+
+def accepted(job: Job) -> JsonResponse:
+    """
+    The response for a request whose work was turned into the job
+    """
+    url = reverse("private:job", kwargs={"job_id": job.pk})
+    return JsonResponse({"job": job.pk, "url": url}, status=202, headers={"Location": url})
@@ -0,0 +1,191 @@
+import base64
+import heapq
+import json
+import os
+import stat
+from pathlib import Path
+from typing import Callable
+
+from general import UserError, get_mime_type
+
+ALL_FIELDS = ["path", "name", "type", "size", "mtime", "mime"]
+DEFAULT_FIELDS = ["path", "name", "size", "mime"]
+SORT_KEYS = ["name", "size", "mtime"]
+
+
+def encode_cursor(components: list[str]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(components).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list[str]:
+    try:
+        components = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise UserError(f"Invalid cursor: {cursor}")
+    if not isinstance(components, list) or not all(isinstance(c, str) for c in components):
+        raise UserError(f"Invalid cursor: {cursor}")
+    return components
+
+
+def parse_count(params, key: str, default: int | None = None) -> int | None:
+    """
+    The non-negative integer parameter (like offset or limit) of the request
+    """
+    if (value := params.get(key)) in (None, ""):
+        return default
+    try:
+        count = int(value)
+    except ValueError:
+        raise UserError(f"{key} must be an integer, not {value}")
+    if count < 0:
+        raise UserError(f"{key} must not be negative, not {count}")
+    return count
+
+
+def parse_fields(fields: str | None) -> list[str]:
+    if fields is None:
+        return DEFAULT_FIELDS
+    fields = [f.strip() for f in fields.split(",") if f.strip() != ""]
+    if unknown := [f for f in fields if f not in ALL_FIELDS]:
+        raise UserError(f"Unknown fields {unknown}, the only options are {ALL_FIELDS}")
+    return fields
+
+
+def parse_sort(sort: str | None) -> tuple[str, bool]:
+    """
+    The key to sort by and whether to sort in descending order (like "-size")
+    """
+    sort = sort or "name"
+    descending = sort.startswith("-")
+    key = sort.removeprefix("-")
+    if key not in SORT_KEYS:
+        raise UserError(f"Cannot sort by {key}, the only options are {SORT_KEYS}")
+    return key, descending
+
+
+def entry_stat(entry: os.DirEntry) -> os.stat_result:
+    try:
+        return entry.stat()
+    except OSError:
+        # Broken symbolic link
+        return entry.stat(follow_symlinks=False)
+
+
+def join(parent: str, name: str) -> str:
+    return name if parent in ("", ".") else f"{parent}/{name}"
+
+
+class Walker:
+    """
+    Walks a directory tree with os.scandir and yields one dictionary per entry (in pre-order),
+    with only the requested fields. Entries are only stat()-ed if a field or the sort order needs it.
+    """
+
+    def __init__(self, fields: list[str], sort: str = "name", descending: bool = False,
+                 allowed: Callable[[str], bool] = lambda path: True):
+        self.fields = fields
+        self.sort = sort
+        self.descending = descending
+        self.allowed = allowed
+        self.needs_stat = sort != "name" or any(f in fields for f in ["size", "mtime", "mime"])
+
+    def info(self, path: str, name: str, full_path: str, is_dir: bool, st: os.stat_result | None) -> dict:
+        info = {}
+        for field in self.fields:
+            match field:
+                case "path":
+                    info["path"] = path
+                case "name":
+                    info["name"] = name
+                case "type":
+                    info["type"] = "directory" if is_dir else "file"
+                case "size":
+                    info["size"] = st.st_size
+                case "mtime":
+                    info["mtime"] = st.st_mtime
+                case "mime":
+                    info["mime"] = get_mime_type(Path(full_path), st)
+        return info
+
+    def sort_key(self, entry: os.DirEntry):
+        match self.sort:
+            case "size":
+                return entry_stat(entry).st_size, entry.name
+            case "mtime":
+                return entry_stat(entry).st_mtime_ns, entry.name
+            case _:
+                return entry.name
+
+    def entries(self, full_dir: str) -> list[os.DirEntry]:
+        try:
+            with os.scandir(full_dir) as it:
+                entries = list(it)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return []
+        entries.sort(key=self.sort_key, reverse=self.descending)
+        return entries
+
+    def walk_children(self, full_dir: str, rel_dir: str, components: list[str], level: int,
+                      cursor: list[str] | None):
+        entries = self.entries(full_dir)
+        start = 0
+
+        if cursor:
+            names = [e.name for e in entries]
+            if cursor[0] not in names:
+                raise UserError("The cursor is no longer valid, the directory has changed")
+            start = names.index(cursor[0])
+            entry = entries[start]
+            start += 1
+            # The entry itself was already returned, but not (all of) its children
+            if level > 1 and entry.is_dir():
+                yield from self.walk_children(entry.path, join(rel_dir, entry.name), [*components, entry.name],
+                                              level - 1, cursor[1:] or None)
+
+        for entry in entries[start:]:
+            path = join(rel_dir, entry.name)
+            if not self.allowed(path):
+                continue
+
+            is_dir = entry.is_dir()
+            st = entry_stat(entry) if self.needs_stat else None
+            yield [*components, entry.name], self.info(path, entry.name, entry.path, is_dir, st)
+
+            if level > 1 and is_dir:
+                yield from self.walk_children(entry.path, path, [*components, entry.name], level - 1, None)
+
+    def walk(self, full_path: Path, path: str, st: os.stat_result, level: int, cursor: list[str] | None = None):
+        """
+        Yields (cursor, info) pairs for the path and its descendants up to the given level;
+        continues after the given cursor
+        """
+        is_dir = stat.S_ISDIR(st.st_mode)
+
+        if cursor is None:
+            yield [], self.info(path, full_path.name, str(full_path), is_dir, st)
+
+        if level > 0 and is_dir:
+            yield from self.walk_children(str(full_path), path, [], level, cursor)
+
+
+def _directories_first(entry: os.DirEntry):
+    # is_file() uses the file type that the directory listing already contains, so this costs no stat()
+    return entry.is_file(), entry.name
+
+
+def list_directory(full_dir: Path, prefix: str = None, offset: int = 0, limit: int = None) -> list[os.DirEntry]:
+    """
+    The entries of the directory, everything that is not a file first, then by name.
+    With a limit, only that many entries (after skipping offset entries) are sorted.
+    """
+    with os.scandir(full_dir) as it:
+        if prefix:
+            entries = [e for e in it if e.name.startswith(prefix)]
+        else:
+            entries = list(it)
+
+    if limit is None:
+        entries.sort(key=_directories_first)
+        return entries[offset:]
+
+    return heapq.nsmallest(offset + limit, entries, key=_directories_first)[offset:]
@@ -0,0 +1,56 @@
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from private.hashing import FileHasher, ParallelHasher
+
+
+class Command(BaseCommand):
+    help = "Compares the serial FileHasher with the ParallelHasher on a file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", nargs="?", type=Path,
+                            help="File to hash; a temporary file with random content if not given")
+        parser.add_argument("--size", type=int, default=1024, help="Size of the temporary file in MiB")
+        parser.add_argument("--block-size", type=int, default=settings.FFS_NET_BLOCK_SIZE)
+        parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+
+    def report(self, name, seconds, size):
+        self.stdout.write(f"{name:>20}: {seconds:7.3f} s, {size / seconds / 2 ** 20:8.1f} MiB/s")
+
+    def handle(self, *args, **options):
+        block_size = options["block_size"]
+
+        if options["file"] is None:
+            fd, name = tempfile.mkstemp()
+            path = Path(name)
+            with os.fdopen(fd, "wb") as fp:
+                for _ in range(options["size"]):
+                    fp.write(random.randbytes(2 ** 20))
+        else:
+            path = options["file"]
+
+        try:
+            size = path.stat().st_size
+            self.stdout.write(f"Hashing {path} ({size / 2 ** 20:.1f} MiB) in blocks of {block_size} bytes")
+
+            start = time.perf_counter()
+            with FileHasher(path) as hasher:
+                expected = [hasher.hash(offset, block_size) for offset in range(0, size, block_size)]
+            self.report("serial", time.perf_counter() - start, size)
+
+            for workers in options["workers"]:
+                start = time.perf_counter()
+                hashes = ParallelHasher(path, block_size, workers).hash_blocks()
+                self.report(f"{workers} workers", time.perf_counter() - start, size)
+
+                if hashes != expected:
+                    self.stderr.write(f"The hashes with {workers} workers differ from the serial hashes")
+        finally:
+            if options["file"] is None:
+                path.unlink()
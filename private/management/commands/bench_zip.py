@@ -0,0 +1,80 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+from PIL import Image
+from django.core.management.base import BaseCommand
+
+from private import archive
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "holiday", "beach", "invoice", "total", "date", "photo", "file"]
+
+
+def make_tree(root: Path, photos: int, documents: int):
+    """
+    A tree like a typical upload: JPEG photos, text documents, CSV/JSON data and some binaries
+    """
+    rng = random.Random(0)
+    (root / "photos").mkdir()
+    (root / "documents").mkdir()
+    (root / "data").mkdir()
+
+    for i in range(photos):
+        # Noise does not compress, just like real photos
+        Image.frombytes("RGB", (1024, 768), rng.randbytes(1024 * 768 * 3)).save(root / "photos" / f"IMG_{i}.jpg",
+                                                                                  quality=90)
+    for i in range(documents):
+        text = "\n".join(" ".join(rng.choices(WORDS, k=12)) for _ in range(rng.randint(2000, 20000)))
+        (root / "documents" / f"document_{i}.txt").write_text(text)
+        rows = "\n".join(f"{j},{rng.random()},{rng.choice(WORDS)}" for j in range(rng.randint(1000, 50000)))
+        (root / "data" / f"table_{i}.csv").write_text(rows)
+        (root / "data" / f"blob_{i}.bin").write_bytes(rng.randbytes(2 ** 19) + bytes(2 ** 19))
+
+
+class Command(BaseCommand):
+    help = "Compares zipping with LZMA for every file (the old api_zip) with the parallel per-type builder"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", type=Path,
+                            help="Directory to zip; a temporary tree of photos and documents if not given")
+        parser.add_argument("--photos", type=int, default=40)
+        parser.add_argument("--documents", type=int, default=40)
+        parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+
+    def report(self, name, seconds, size_in, size_out):
+        self.stdout.write(f"{name:>20}: {seconds:7.3f} s, {size_in / seconds / 2 ** 20:8.1f} MiB/s, "
+                          f"ratio {size_out / size_in:.3f}")
+
+    def handle(self, *args, **options):
+        tmp = Path(tempfile.mkdtemp())
+        try:
+            root = options["path"]
+            if root is None:
+                root = tmp / "tree"
+                root.mkdir()
+                make_tree(root, options["photos"], options["documents"])
+
+            size = sum(f.stat().st_size for f in root.rglob("*") if f.is_file())
+            self.stdout.write(f"Zipping {root} ({size / 2 ** 20:.1f} MiB)")
+
+            dst = tmp / "lzma.zip"
+            start = time.perf_counter()
+            with zipfile.ZipFile(dst, "w") as zip:
+                for member in archive.members([root]):
+                    if not member.is_dir:
+                        zip.write(member.full_path, member.name, compress_type=zipfile.ZIP_LZMA)
+            self.report("serial LZMA", time.perf_counter() - start, size, dst.stat().st_size)
+
+            for workers in sorted(set(options["workers"])):
+                dst = tmp / f"{workers}.zip"
+                start = time.perf_counter()
+                stats = archive.build_zip(dst, archive.members([root]), workers=workers)
+                self.report(f"{workers} workers", time.perf_counter() - start, size, dst.stat().st_size)
+                methods = {zipfile.compressor_names[m]: n for m, n in stats.methods.items()}
+                self.stdout.write(f"{'':>20}  {methods}")
+        finally:
+            shutil.rmtree(tmp)
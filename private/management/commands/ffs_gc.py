@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from private import packet_gc
+
+
+class Command(BaseCommand):
+    help = "Deletes old file packets and cleans up the file packet cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-age", type=float, default=settings.FFS_FILE_PACKET_MAX_AGE,
+                            help="Delete packets unused for this many hours")
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--time-slice", type=float, default=None,
+                            help="Stop after this many seconds; the next run continues")
+        parser.add_argument("--orphans", action="store_true",
+                            help="Also delete packets without files and files without packets")
+        parser.add_argument("--grace", type=float, default=60 * 60,
+                            help="Keep orphaned files younger than this many seconds")
+
+    def handle(self, *args, **options):
+        stats = packet_gc.collect(max_age=options["max_age"], batch_size=options["batch_size"],
+                                  time_budget=options["time_slice"], orphans=options["orphans"],
+                                  grace=options["grace"])
+
+        self.stdout.write(f"packets_deleted={stats.packets_deleted} "
+                          f"bytes_reclaimed={stats.bytes_reclaimed} "
+                          f"missing_files={stats.missing_files} "
+                          f"orphan_files={stats.orphan_files} "
+                          f"chains_released={stats.chains_released} "
+                          f"complete={int(stats.complete)}")
@@ -0,0 +1,25 @@
+import os
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from private import icons
+
+
+class Command(BaseCommand):
+    help = "Renders the missing icons of all images below a path"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", default="", help="Relative to FFS_FS_ROOT")
+        parser.add_argument("--sizes", type=int, nargs="+", default=settings.FFS_ICON_SIZES,
+                            choices=settings.FFS_ICON_SIZES)
+        parser.add_argument("--format", default=settings.FFS_ICON_FORMAT, choices=list(icons.CONTENT_TYPES))
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        created, failed = icons.generate(Path(options["path"]), options["sizes"], options["format"],
+                                         options["workers"])
+        self.stdout.write(f"Created {created} icons in {time.monotonic() - start:.1f} s, {failed} failed")
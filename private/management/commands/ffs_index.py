@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from private import fs_index
+
+
+class Command(BaseCommand):
+    help = "Builds the file system index and keeps it up to date with inotify"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", default=fs_index.ROOT,
+                            help="Only rescan this path (relative to FFS_FS_ROOT)")
+        parser.add_argument("--watch", action="store_true",
+                            help="After the rescan, keep watching for changes until interrupted")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        watcher = None
+        if options["watch"]:
+            # Watch first, so that nothing that changes during the rescan is missed
+            watcher = fs_index.InotifyWatcher()
+            watcher.watch(fs_index.relative(options["path"]))
+            self.stdout.write(f"Watching {len(watcher.directories)} directories")
+
+        start = time.monotonic()
+        count = fs_index.rescan(options["path"], options["batch_size"])
+        self.stdout.write(f"Indexed {count} entries in {time.monotonic() - start:.1f} s")
+
+        if watcher is not None:
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                watcher.close()
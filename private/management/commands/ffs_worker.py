@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from private import jobs
+
+
+class Command(BaseCommand):
+    help = "Runs the queued jobs (for FFS_JOB_WORKERS = 0, where the web server does not run them itself)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1, help="Run this many jobs at a time")
+        parser.add_argument("--poll-interval", type=float, default=2.0,
+                            help="Look for new jobs this often (seconds)")
+        parser.add_argument("--once", action="store_true", help="Stop when no job is queued or running")
+
+    def handle(self, *args, **options):
+        jobs.Runner(options["workers"], options["poll_interval"]).run(once=options["once"])
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('private', '0019_permissionsrule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlockHashIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=700)),
+                ('block_size', models.IntegerField()),
+                ('size', models.BigIntegerField()),
+                ('mtime_ns', models.BigIntegerField()),
+                ('hashes', models.JSONField(default=list)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('path', 'block_size'), name='unique_block_hash_index')],
+            },
+        ),
+    ]
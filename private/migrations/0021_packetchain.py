@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('private', '0020_blockhashindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PacketChain',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=700, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('mtime_ns', models.BigIntegerField()),
+                ('packets', models.ManyToManyField(related_name='chains', to='private.filepacket')),
+            ],
+        ),
+    ]
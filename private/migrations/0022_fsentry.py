@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:41
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('private', '0021_packetchain'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FsEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=700, unique=True)),
+                ('parent', models.CharField(db_index=True, max_length=700)),
+                ('name', models.CharField(max_length=255)),
+                ('is_dir', models.BooleanField()),
+                ('size', models.BigIntegerField(db_index=True)),
+                ('mtime_ns', models.BigIntegerField(db_index=True)),
+                ('mime', models.CharField(db_index=True, max_length=128)),
+                ('indexed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('block_index', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='private.blockhashindex')),
+            ],
+        ),
+    ]
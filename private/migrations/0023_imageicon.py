@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:47
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('private', '0022_fsentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageIcon',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=700)),
+                ('size', models.IntegerField()),
+                ('format', models.CharField(max_length=8)),
+                ('src_size', models.BigIntegerField()),
+                ('src_mtime_ns', models.BigIntegerField()),
+                ('bytes', models.BigIntegerField()),
+                ('hits', models.BigIntegerField(default=0)),
+                ('last_used', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('path', 'size', 'format'), name='unique_image_icon')],
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:16
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('private', '0025_job_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='permissionsrule',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
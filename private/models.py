@@ -1,6 +1,8 @@
 import logging
+import os
 import re
-from pathlib import Path
+from functools import cached_property
+from pathlib import Path, PurePosixPath
 
 from django.db import models
 from django.utils import timezone
@@ -39,6 +41,9 @@ class FilePacket(models.Model):
         self.last_used = timezone.now()
         super().save(*args, **kwargs)
 
+    # Hashes per query, well below the limits on query parameters of all databases
+    BULK_CHUNK_SIZE = 500
+
     @classmethod
     def status_for(cls, hsh):
         try:
@@ -46,29 +51,61 @@ class FilePacket(models.Model):
         except cls.DoesNotExist:
             return FilePacket.PENDING
 
+    @classmethod
+    def _bulk_values(cls, hashes, field) -> dict:
+        hashes = list(dict.fromkeys(map(str, hashes)))
+        values = {}
+
+        for i in range(0, len(hashes), cls.BULK_CHUNK_SIZE):
+            chunk = hashes[i:i + cls.BULK_CHUNK_SIZE]
+            values.update(cls.objects.filter(hsh__in=chunk).values_list("hsh", field))
+
+        return values
+
+    @classmethod
+    def statuses_for(cls, hashes) -> dict:
+        """
+        Like status_for, but for many hashes with few queries; keeps the order of the hashes
+        """
+        statuses = cls._bulk_values(hashes, "status")
+        return {str(hsh): statuses.get(str(hsh), FilePacket.PENDING) for hsh in hashes}
+
+    @classmethod
+    def files_for(cls, hashes) -> dict:
+        return cls._bulk_values(hashes, "file")
+
 
 class PermissionsRule(models.Model):
     rule = models.CharField(max_length=128, primary_key=True)
     users = models.CharField(max_length=128)
     is_template = models.BooleanField(default=False)
+    # Lets every process notice changed rules (see permissions.get_engine)
+    updated = models.DateTimeField(auto_now=True)
 
-    def get_rule(self):
+    def get_rule(self, capture=True):
         if not self.is_template:
             return self.rule
 
-        return self.rule.replace("$USER", "(?P<user>$SEG)").replace("$SEG", "[a-zA-Z0-9._ -]*")
+        user_group = "(?P<user>$SEG)" if capture else "(?:$SEG)"
+        return self.rule.replace("$USER", user_group).replace("$SEG", "[a-zA-Z0-9._ -]*")
+
+    @cached_property
+    def regex(self):
+        return re.compile(self.get_rule())
 
     def matches(self, path: Path) -> bool:
-        regex = re.compile(self.get_rule())
-        return regex.match(str(path))
+        return self.regex.match(str(path))
 
     @staticmethod
     def normalise(path: Path):
-        path = str(path)
-        if "../" in path:
+        # Only whole ".." components; names like "backup.." are fine
+        parts = PurePosixPath(path).parts
+        if ".." in parts:
             raise UserError("Please don't have \"..\" in your paths")
-        path = path.replace("./", "")
-        return path
+        if not parts:
+            return str(path).replace("./", "")
+        normalised = str(PurePosixPath(*parts))
+        return normalised + "/" if str(path).endswith("/") else normalised
 
     def user_allowed(self, path: Path, username: str):
         path = self.normalise(path)
@@ -88,3 +125,140 @@ class PermissionsRule(models.Model):
 
     def __str__(self):
         return f"{self.rule}: {self.users}"
+
+
+class BlockHashIndex(models.Model):
+    """
+    The SHA-256 hashes of all blocks of a file, valid as long as size and modification time do not change
+    """
+    path = models.CharField(max_length=700)
+    block_size = models.IntegerField()
+    size = models.BigIntegerField()
+    mtime_ns = models.BigIntegerField()
+    hashes = models.JSONField(default=list)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["path", "block_size"], name="unique_block_hash_index")]
+
+    def is_valid_for(self, stat: os.stat_result) -> bool:
+        return self.size == stat.st_size and self.mtime_ns == stat.st_mtime_ns
+
+    def __str__(self):
+        return f"{self.path} ({len(self.hashes)} blocks of {self.block_size})"
+
+
+class PacketChain(models.Model):
+    """
+    A file that shares its storage with the file packets it was assembled from (see private/dedup.py).
+    Packets that belong to a chain are never deleted by the cleanup of old packets.
+    """
+    path = models.CharField(max_length=700, unique=True)
+    size = models.BigIntegerField()
+    mtime_ns = models.BigIntegerField()
+    packets = models.ManyToManyField(FilePacket, related_name="chains")
+
+    def is_valid_for(self, stat: os.stat_result) -> bool:
+        return self.size == stat.st_size and self.mtime_ns == stat.st_mtime_ns
+
+    def __str__(self):
+        return self.path
+
+
+class FsEntry(models.Model):
+    """
+    Metadata of a file or directory in the FFS, kept up to date by private/fs_index.py.
+    Paths are relative to FFS_FS_ROOT, the root itself is "."
+    """
+    path = models.CharField(max_length=700, unique=True)
+    parent = models.CharField(max_length=700, db_index=True)
+    name = models.CharField(max_length=255)
+    is_dir = models.BooleanField()
+    size = models.BigIntegerField(db_index=True)
+    mtime_ns = models.BigIntegerField(db_index=True)
+    mime = models.CharField(max_length=128, db_index=True)
+    block_index = models.ForeignKey(BlockHashIndex, null=True, blank=True, on_delete=models.SET_NULL)
+    indexed_at = models.DateTimeField(default=timezone.now)
+
+    def is_valid_for(self, stat: os.stat_result) -> bool:
+        return self.size == stat.st_size and self.mtime_ns == stat.st_mtime_ns
+
+    def __str__(self):
+        return self.path
+
+
+class ImageIcon(models.Model):
+    """
+    An icon in FFS_IMAGE_ICONS, valid as long as the size and modification time of its image do not change.
+    Paths are relative to FFS_FS_ROOT.
+    """
+    path = models.CharField(max_length=700)
+    size = models.IntegerField()
+    format = models.CharField(max_length=8)
+    src_size = models.BigIntegerField()
+    src_mtime_ns = models.BigIntegerField()
+    bytes = models.BigIntegerField()
+    hits = models.BigIntegerField(default=0)
+    last_used = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["path", "size", "format"], name="unique_image_icon")]
+
+    def is_valid_for(self, stat: os.stat_result) -> bool:
+        return self.src_size == stat.st_size and self.src_mtime_ns == stat.st_mtime_ns
+
+    def __str__(self):
+        return f"{self.path} ({self.size} px {self.format})"
+
+
+class Job(models.Model):
+    """
+    A long running FFS operation that runs outside the request (see private/jobs.py)
+    """
+    QUEUED = "QUEUED"
+    RUNNING = "RUNNING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+    CANCELLED = "CANCELLED"
+
+    kind = models.CharField(max_length=32)
+    user = models.CharField(max_length=150)
+    args = models.JSONField(default=dict)
+    status = models.CharField(choices={s: s for s in [QUEUED, RUNNING, DONE, FAILED, CANCELLED]}, max_length=20,
+                              default=QUEUED, db_index=True)
+    cancel_requested = models.BooleanField(default=False)
+    files_done = models.BigIntegerField(default=0)
+    files_total = models.BigIntegerField(null=True, blank=True)
+    bytes_done = models.BigIntegerField(default=0)
+    bytes_total = models.BigIntegerField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    created = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    # Renewed by the process running the job; running jobs without recent heartbeats have lost their process
+    heartbeat = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (Job.DONE, Job.FAILED, Job.CANCELLED)
+
+    def to_json(self) -> dict:
+        return {
+            "id": self.pk,
+            "kind": self.kind,
+            "args": self.args,
+            "status": self.status,
+            "cancel_requested": self.cancel_requested,
+            "files_done": self.files_done,
+            "files_total": self.files_total,
+            "bytes_done": self.bytes_done,
+            "bytes_total": self.bytes_total,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created.isoformat(),
+            "started": self.started.isoformat() if self.started else None,
+            "finished": self.finished.isoformat() if self.finished else None,
+        }
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
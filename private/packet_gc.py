@@ -0,0 +1,247 @@
+import datetime
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from private import dedup
+from private.models import FilePacket, PacketChain
+
+log = logging.getLogger("my")
+
+
+@dataclass
+class GcStats:
+    packets_deleted: int = 0
+    bytes_reclaimed: int = 0
+    # Rows without files
+    missing_files: int = 0
+    # Files without rows
+    orphan_files: int = 0
+    # Deduplicated files that were changed, so their packets are no longer pinned
+    chains_released: int = 0
+    # False if the time budget ran out before everything was collected
+    complete: bool = True
+
+    def __str__(self):
+        return (f"Deleted {self.packets_deleted} file packets and {self.orphan_files} orphaned files, "
+                f"reclaimed {self.bytes_reclaimed} bytes, "
+                f"removed {self.missing_files} packets without files, "
+                f"released {self.chains_released} changed deduplicated files"
+                f"{'' if self.complete else ' (time budget exhausted)'}")
+
+
+class _Deadline:
+    def __init__(self, seconds: float | None):
+        self.end = None if seconds is None else time.monotonic() + seconds
+
+    def passed(self):
+        return self.end is not None and time.monotonic() > self.end
+
+
+def _unlink(file: Path) -> int | None:
+    """
+    Deletes the file and returns its size, or None if it did not exist
+    """
+    try:
+        size = file.stat().st_size
+        file.unlink()
+        return size
+    except FileNotFoundError:
+        return None
+
+
+def collect_expired(stats: GcStats, deadline: _Deadline, max_age: float, batch_size: int):
+    cutoff = timezone.now() - datetime.timedelta(hours=max_age)
+    # Packets of deduplicated files are still in use. Exists() instead of chains__isnull, whose outer join
+    # cannot be locked FOR UPDATE on PostgreSQL.
+    pinned = PacketChain.packets.through.objects.filter(filepacket=OuterRef("pk"))
+    expired = FilePacket.objects.filter(~Exists(pinned), last_used__lt=cutoff)
+
+    while not deadline.passed():
+        # The files are deleted before the transaction ends, so an upload of the same packet cannot write its
+        # file in between: it waits for the rows locked by _expired_batch() (MySQL, PostgreSQL), or for the
+        # database lock that SQLite takes with the delete, which has no row locks.
+        with transaction.atomic():
+            batch = _expired_batch(expired, batch_size)
+            if len(batch) == 0:
+                return
+
+            hashes = [hsh for hsh, _, _ in batch]
+            expired.filter(hsh__in=hashes).delete()
+            # Packets used or pinned since they were selected are not expired anymore, so they were kept
+            kept = set(FilePacket.objects.filter(hsh__in=hashes).values_list("hsh", flat=True))
+
+            for hsh, file, status in batch:
+                if hsh in kept:
+                    continue
+                stats.packets_deleted += 1
+                if file is None:
+                    continue
+                size = _unlink(settings.FFS_FILE_PACKET_CACHE / file)
+                if size is not None:
+                    stats.bytes_reclaimed += size
+                elif status == FilePacket.STORED:
+                    log.error(f"File packet for hash {hsh} is missing during automatic cleanup")
+
+    stats.complete = False
+
+
+def _expired_batch(expired, batch_size: int) -> list[tuple[str, str | None, str]]:
+    return list(expired.select_for_update().values_list("hsh", "file", "status")[:batch_size])
+
+
+def collect_missing_files(stats: GcStats, deadline: _Deadline, batch_size: int):
+    """
+    Deletes stored packets whose file does not exist (anymore)
+    """
+    missing = []
+    stored = FilePacket.objects.filter(status=FilePacket.STORED).values_list("hsh", "file")
+
+    for hsh, file in stored.iterator(chunk_size=batch_size):
+        if deadline.passed():
+            stats.complete = False
+            break
+        if file is None or not (settings.FFS_FILE_PACKET_CACHE / file).is_file():
+            missing.append(hsh)
+
+    for i in range(0, len(missing), batch_size):
+        FilePacket.objects.filter(hsh__in=missing[i:i + batch_size], status=FilePacket.STORED).delete()
+
+    stats.missing_files += len(missing)
+
+
+# The chains up to this pk were checked; the next collection in this process continues after it
+_chains_checked = 0
+
+
+def collect_stale_chains(stats: GcStats, deadline: _Deadline, batch_size: int):
+    """
+    Unpins the packets of deduplicated files that were changed or deleted
+    """
+    global _chains_checked
+    chains = PacketChain.objects.filter(pk__gt=_chains_checked).order_by("pk")
+
+    for chain in chains.iterator(chunk_size=batch_size):
+        if deadline.passed():
+            stats.complete = False
+            return
+        if dedup.is_stale(chain):
+            chain.delete()
+            stats.chains_released += 1
+        _chains_checked = chain.pk
+
+    _chains_checked = 0
+
+
+def _cache_files():
+    root = settings.FFS_FILE_PACKET_CACHE
+    if not root.is_dir():
+        return
+
+    with os.scandir(root) as directories:
+        for directory in directories:
+            if not directory.is_dir(follow_symlinks=False):
+                continue
+            with os.scandir(directory.path) as files:
+                for file in files:
+                    if file.is_file(follow_symlinks=False):
+                        yield f"{directory.name}/{file.name}", file
+
+
+def collect_orphan_files(stats: GcStats, deadline: _Deadline, batch_size: int, grace: float):
+    """
+    Deletes files in the packet cache that no packet refers to.
+    Files younger than grace seconds are kept, they may belong to an upload that is still running.
+    """
+    cutoff = time.time() - grace
+
+    def handle(batch):
+        known = set(FilePacket.objects.filter(file__in=[name for name, _ in batch]).values_list("file", flat=True))
+        for name, entry in batch:
+            if name in known:
+                continue
+            try:
+                info = entry.stat(follow_symlinks=False)
+                if info.st_mtime > cutoff:
+                    continue
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+            stats.orphan_files += 1
+            stats.bytes_reclaimed += info.st_size
+
+    batch = []
+    for name, entry in _cache_files():
+        batch.append((name, entry))
+        if len(batch) >= batch_size:
+            handle(batch)
+            batch = []
+            if deadline.passed():
+                stats.complete = False
+                return
+
+    handle(batch)
+
+
+def collect(max_age: float = None, batch_size: int = 500, time_budget: float = None, orphans: bool = False,
+            grace: float = 60 * 60) -> GcStats:
+    """
+    Deletes file packets that have not been used for max_age hours, in bulk.
+
+    First unpins the packets of deduplicated files that were changed, so that they can expire as well.
+    Stops after time_budget seconds (if given), the next run continues where this one stopped.
+    With orphans, also removes packets without files and files without packets.
+    """
+    max_age = max_age if max_age is not None else settings.FFS_FILE_PACKET_MAX_AGE
+    stats = GcStats()
+    deadline = _Deadline(time_budget)
+
+    # At most half of the time, so that the expired packets are collected as well
+    collect_stale_chains(stats, _Deadline(None if time_budget is None else time_budget / 2), batch_size)
+    collect_expired(stats, deadline, max_age, batch_size)
+    if orphans:
+        collect_missing_files(stats, deadline, batch_size)
+        collect_orphan_files(stats, deadline, batch_size, grace)
+
+    if stats.packets_deleted + stats.orphan_files + stats.missing_files + stats.chains_released > 0:
+        log.info(str(stats))
+
+    return stats
+
+
+_last_run = None
+_running = threading.Lock()
+
+
+def _collect_thread():
+    try:
+        collect(time_budget=settings.FFS_FILE_PACKET_GC_TIME_SLICE)
+    except Exception as e:
+        log.error(f"Automatic cleanup of file packets failed: {e}")
+    finally:
+        connection.close()
+        _running.release()
+
+
+def collect_in_background():
+    """
+    Starts a time-limited collection on another thread, unless one ran recently
+    """
+    global _last_run
+
+    now = time.monotonic()
+    if _last_run is not None and now - _last_run < settings.FFS_FILE_PACKET_GC_INTERVAL:
+        return
+    if not _running.acquire(blocking=False):
+        return
+
+    _last_run = now
+    threading.Thread(target=_collect_thread, name="packet-gc", daemon=True).start()
@@ -0,0 +1,79 @@
+import datetime
+import os
+import stat
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import HttpRequest
+
+# The character after "/", so every string that starts with "dir/" sorts before "dir0"; ASCII, as MySQL
+# connections with the utf8 (utf8mb3) charset cannot hold 4-byte characters
+AFTER_SLASH = "0"
+
+
+def subtree_q(path: str, field: str = "path") -> Q:
+    """
+    The rows whose path is the path or lies below it. Only case-sensitive matches: __startswith is a LIKE, which
+    ignores the case on SQLite, and the range ignores it with case-insensitive MySQL collations; both together
+    are exact.
+    """
+    path = path.rstrip("/")
+    return Q(**{field: path}) | Q(**{f"{field}__startswith": path + "/", f"{field}__gte": path + "/",
+                                     f"{field}__lt": path + AFTER_SLASH})
+
+
+class ResolvedPath:
+    """
+    A path in the FFS together with a single stat() of it.
+
+    Permission checks, the conditional GET validators and the views all share this object, so a request
+    only asks the (possibly networked) file system about its path once.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.full_path = settings.FFS_FS_ROOT / self.path
+        self.refresh()
+
+    def refresh(self):
+        """
+        Call this after changing the file
+        """
+        try:
+            self.stat = os.stat(self.full_path)
+        except (FileNotFoundError, NotADirectoryError):
+            self.stat = None
+
+    @property
+    def exists(self) -> bool:
+        return self.stat is not None
+
+    @property
+    def is_file(self) -> bool:
+        return self.stat is not None and stat.S_ISREG(self.stat.st_mode)
+
+    @property
+    def is_dir(self) -> bool:
+        return self.stat is not None and stat.S_ISDIR(self.stat.st_mode)
+
+    @property
+    def size(self) -> int:
+        return self.stat.st_size
+
+    @property
+    def last_modified(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.stat.st_mtime)
+
+
+def resolve(request: HttpRequest, path: Path) -> ResolvedPath:
+    """
+    The ResolvedPath for the path, created once per request
+    """
+    paths = request.__dict__.setdefault("_ffs_paths", {})
+    key = str(path)
+
+    if key not in paths:
+        paths[key] = ResolvedPath(path)
+
+    return paths[key]
@@ -0,0 +1,124 @@
+import logging
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Iterable
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from private.models import PermissionsRule
+
+log = logging.getLogger("my")
+
+
+class PermissionEngine:
+    """
+    All permission rules compiled once.
+
+    Rules whose regex can be used without capture groups are combined into a single alternation,
+    so that the (common) case of a path that no rule talks about costs a single regex match.
+    Only if that prefilter matches are the rules evaluated one by one.
+    """
+
+    def __init__(self, rules: list[PermissionsRule]):
+        self.rules = rules
+        self.always_check = []
+        combinable = []
+
+        for rule in rules:
+            try:
+                rule.regex  # compile now instead of on the first request
+                pattern = rule.get_rule(capture=False)
+                groups = re.compile(pattern).groups
+            except re.error as e:
+                log.error(f"Permission rule {rule} is not a valid regex: {e}")
+                self.always_check.append(rule)
+                continue
+
+            # Capture groups (and with them back references) change their meaning inside an alternation
+            if groups == 0:
+                combinable.append(pattern)
+            else:
+                self.always_check.append(rule)
+
+        self.combined = None
+        if len(combinable) > 0:
+            try:
+                self.combined = re.compile("|".join(f"(?:{p})" for p in combinable))
+            except re.error:
+                # e.g. global flags in the middle of the pattern; every rule is checked on its own then
+                self.always_check = rules
+
+    def candidates(self, path: str) -> list[PermissionsRule]:
+        if self.combined is None or self.combined.match(path) is not None:
+            return self.rules
+        return self.always_check
+
+    def blocking_rule(self, path: Path, username: str) -> PermissionsRule | None:
+        path = PermissionsRule.normalise(path)
+
+        for rule in self.candidates(path):
+            if not rule.user_allowed(path, username):
+                return rule
+
+        return None
+
+    def filter_allowed(self, paths: Iterable, username: str):
+        """
+        Yields only those of the paths that the user may see
+        """
+        for path in paths:
+            if self.blocking_rule(path, username) is None:
+                yield path
+
+
+_engine: PermissionEngine | None = None
+_engine_version = None
+_engine_time = 0.0
+_engine_lock = threading.Lock()
+
+
+def rules_version() -> tuple:
+    """
+    Changes whenever a rule is saved (updated) or deleted (count)
+    """
+    version = PermissionsRule.objects.aggregate(count=Count("rule"), updated=Max("updated"))
+    return version["count"], version["updated"]
+
+
+def get_engine() -> PermissionEngine:
+    """
+    The process-wide permission engine. Saving or deleting a rule invalidates it immediately in this process;
+    other processes compare the version of the rules in the database, at most every FFS_PERMISSIONS_CACHE_SECONDS,
+    and only build a new engine if it changed.
+    """
+    global _engine, _engine_version, _engine_time
+
+    engine = _engine
+    if engine is not None and time.monotonic() - _engine_time < settings.FFS_PERMISSIONS_CACHE_SECONDS:
+        return engine
+
+    with _engine_lock:
+        if _engine is None or time.monotonic() - _engine_time >= settings.FFS_PERMISSIONS_CACHE_SECONDS:
+            version = rules_version()
+            if _engine is None or version != _engine_version:
+                _engine = PermissionEngine(list(PermissionsRule.objects.all()))
+                _engine_version = version
+            _engine_time = time.monotonic()
+        return _engine
+
+
+def invalidate():
+    global _engine, _engine_version
+    _engine = None
+    _engine_version = None
+
+
+@receiver(post_save, sender=PermissionsRule)
+@receiver(post_delete, sender=PermissionsRule)
+def _rules_changed(sender, **kwargs):
+    invalidate()
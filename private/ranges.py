@@ -0,0 +1,170 @@
+import datetime
+import os
+import re
+import secrets
+from calendar import timegm
+from pathlib import Path
+
+from django.http import HttpRequest, HttpResponse, FileResponse, StreamingHttpResponse
+from django.utils.http import parse_http_date_safe, quote_etag
+
+# More ranges than this are almost certainly an attempt at making the server do silly amounts of work
+MAX_RANGES = 64
+CHUNK_SIZE = 2 ** 16
+
+range_re = re.compile(r"bytes=(.*)", re.IGNORECASE)
+range_spec_re = re.compile(r"(\d*)-(\d*)")
+
+
+def parse_range(header: str, size: int) -> list[tuple[int, int]] | None:
+    """
+    Parses a Range header into a sorted list of non-overlapping (start, end) pairs, where end is inclusive.
+
+    Returns None if the header should be ignored (invalid or too many ranges) and an empty list
+    if none of the ranges can be satisfied.
+    """
+    match = range_re.fullmatch(header.strip())
+    if match is None:
+        return None
+
+    specs = [s.strip() for s in match.group(1).split(",") if s.strip() != ""]
+    if len(specs) == 0 or len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        if (m := range_spec_re.fullmatch(spec)) is None:
+            return None
+        first, last = m.groups()
+
+        if first == "":
+            if last == "":
+                return None
+            # Suffix range: the last n bytes
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(0, size - length), size - 1))
+            continue
+
+        start = int(first)
+        if last != "" and int(last) < start:
+            return None
+        end = size - 1 if last == "" else int(last)
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if len(merged) > 0 and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def if_range_matches(request: HttpRequest, etag: str | None, last_modified: datetime.datetime | None) -> bool:
+    """
+    Whether a Range request may be answered partially (RFC 9110, 13.1.5)
+    """
+    header = request.META.get("HTTP_IF_RANGE")
+    if header is None:
+        return True
+
+    header = header.strip()
+    if header.startswith('"') or header.startswith("W/"):
+        # Only strong comparison is allowed here
+        return etag is not None and header == quote_etag(etag)
+
+    date = parse_http_date_safe(header)
+    if date is None or last_modified is None:
+        return False
+    return date == timegm(last_modified.utctimetuple())
+
+
+class RangeFile:
+    """
+    File like object that reads only the given byte range of a file.
+
+    The underlying file descriptor is positioned at the start of the range, so servers
+    that use sendfile() for wsgi.file_wrapper (together with the Content-Length) send the range without
+    copying it through Python.
+    """
+
+    def __init__(self, fp, start: int, length: int):
+        self.fp = fp
+        self.remaining = length
+        fp.seek(start, os.SEEK_SET)
+
+    def read(self, n=-1):
+        if self.remaining <= 0:
+            return b""
+        if n is None or n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.fp.read(n)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def close(self):
+        self.fp.close()
+
+
+def _multipart_body(full_path: Path, ranges, boundary: str, part_headers: list[bytes]):
+    with open(full_path, "rb") as fp:
+        for (start, end), headers in zip(ranges, part_headers):
+            yield headers
+            fp.seek(start, os.SEEK_SET)
+            remaining = end - start + 1
+            while remaining > 0 and (data := fp.read(min(CHUNK_SIZE, remaining))):
+                remaining -= len(data)
+                yield data
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+
+def range_response(request: HttpRequest, full_path: Path, size: int, content_type: str,
+                   etag: str | None, last_modified: datetime.datetime | None) -> HttpResponse:
+    """
+    Responds with the file (of the given size), or the parts of it that were requested with a Range header
+    """
+    header = request.META.get("HTTP_RANGE")
+
+    ranges = None
+    if header is not None and request.method == "GET" and if_range_matches(request, etag, last_modified):
+        ranges = parse_range(header, size)
+
+    if ranges is None:
+        response = FileResponse(open(full_path, "rb"), content_type=content_type)
+        response["Accept-Ranges"] = "bytes"
+        return response
+
+    if len(ranges) == 0:
+        return HttpResponse(status=416, headers={"Content-Range": f"bytes */{size}", "Accept-Ranges": "bytes"})
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = FileResponse(RangeFile(open(full_path, "rb"), start, end - start + 1),
+                                status=206, content_type=content_type, filename=full_path.name)
+        response["Content-Length"] = str(end - start + 1)
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Accept-Ranges"] = "bytes"
+        return response
+
+    boundary = secrets.token_hex(16)
+    part_headers = [(f"--{boundary}\r\n"
+                     f"Content-Type: {content_type}\r\n"
+                     f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+                    for start, end in ranges]
+    length = (sum(len(h) for h in part_headers)
+              + sum(end - start + 1 + 2 for start, end in ranges)
+              + len(f"--{boundary}--\r\n"))
+
+    response = StreamingHttpResponse(_multipart_body(full_path, ranges, boundary, part_headers), status=206,
+                                     content_type=f"multipart/byteranges; boundary={boundary}")
+    response["Content-Length"] = str(length)
+    response["Accept-Ranges"] = "bytes"
+    return response
@@ -0,0 +1,153 @@
+import datetime
+import fnmatch
+import re
+from dataclasses import dataclass
+
+from django.db.models import Q
+from django.http import QueryDict
+from django.utils import timezone
+
+from general import UserError
+from private import fs_index, listing
+from private.models import FsEntry
+
+DEFAULT_LIMIT = 1000
+CHUNK_SIZE = 2000
+# Bracket expressions as a whole (their content is not literal), wildcards and stray brackets
+glob_special = re.compile(r"\[[^\]]*\]|[*?\[\]]")
+
+
+@dataclass
+class SearchQuery:
+    # Case-insensitive substring of the name
+    name: str | None = None
+    # Shell-style pattern for the name, like "*.jpg"
+    glob: str | None = None
+    # Regular expression that is searched for in the path
+    regex: re.Pattern | None = None
+    # A mime type ("image/png") or a class of mime types ("image")
+    mime: str | None = None
+    min_size: int | None = None
+    max_size: int | None = None
+    after: datetime.datetime | None = None
+    before: datetime.datetime | None = None
+    type: str | None = None
+    sort: str | None = None
+    descending: bool = False
+    limit: int = DEFAULT_LIMIT
+
+
+def _int(params: QueryDict, key: str) -> int | None:
+    if (value := params.get(key)) in (None, ""):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise UserError(f"{key} must be an integer, not {value}")
+
+
+def _date(params: QueryDict, key: str) -> datetime.datetime | None:
+    if (value := params.get(key)) in (None, ""):
+        return None
+    try:
+        date = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise UserError(f"{key} must be an ISO 8601 date, not {value}")
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return date
+
+
+def parse_query(params: QueryDict) -> SearchQuery:
+    query = SearchQuery(name=params.get("name") or None, glob=params.get("glob") or None,
+                        mime=params.get("mime") or None, min_size=_int(params, "min_size"),
+                        max_size=_int(params, "max_size"), after=_date(params, "after"),
+                        before=_date(params, "before"), type=params.get("type") or None)
+
+    if regex := params.get("regex"):
+        try:
+            query.regex = re.compile(regex)
+        except re.error as e:
+            raise UserError(f"Invalid regex {regex}: {e}")
+
+    if query.type not in (None, "file", "directory"):
+        raise UserError(f"Unknown type {query.type}, the only options are ['file', 'directory']")
+
+    if "sort" in params:
+        query.sort, query.descending = listing.parse_sort(params["sort"])
+
+    query.limit = listing.parse_count(params, "limit", DEFAULT_LIMIT)
+
+    return query
+
+
+def _glob_literal(glob: str) -> str:
+    """
+    The longest part of the pattern without wildcards, which the database can look for
+    """
+    return max(glob_special.split(glob), key=len)
+
+
+def search(under, query: SearchQuery):
+    """
+    Yields the indexed entries below the path that match the query.
+
+    Everything except glob and regex is answered by the database; these two are checked here,
+    after the database has narrowed the candidates down (with the literal part of the glob).
+    """
+    entries = FsEntry.objects.filter(fs_index.subtree(fs_index.relative(under)))
+
+    if query.name:
+        entries = entries.filter(name__icontains=query.name)
+    if query.glob and (literal := _glob_literal(query.glob)):
+        entries = entries.filter(name__contains=literal)
+    if query.mime:
+        entries = entries.filter(Q(mime=query.mime) if "/" in query.mime else Q(mime__startswith=query.mime + "/"))
+    if query.min_size is not None:
+        entries = entries.filter(size__gte=query.min_size)
+    if query.max_size is not None:
+        entries = entries.filter(size__lte=query.max_size)
+    if query.after is not None:
+        entries = entries.filter(mtime_ns__gte=int(query.after.timestamp() * 10 ** 9))
+    if query.before is not None:
+        entries = entries.filter(mtime_ns__lt=int(query.before.timestamp() * 10 ** 9))
+    if query.type is not None:
+        entries = entries.filter(is_dir=query.type == "directory")
+
+    match query.sort:
+        case "size":
+            order = ["size", "path"]
+        case "mtime":
+            order = ["mtime_ns", "path"]
+        case "name":
+            order = ["name", "path"]
+        case _:
+            order = ["path"]
+    if query.descending:
+        order = ["-" + o for o in order]
+
+    for entry in entries.order_by(*order).iterator(chunk_size=CHUNK_SIZE):
+        if query.glob and not fnmatch.fnmatchcase(entry.name, query.glob):
+            continue
+        if query.regex and query.regex.search(entry.path) is None:
+            continue
+        yield entry
+
+
+def entry_info(entry: FsEntry, fields: list[str]) -> dict:
+    info = {}
+    for field in fields:
+        match field:
+            case "path":
+                info["path"] = entry.path
+            case "name":
+                info["name"] = entry.name
+            case "type":
+                info["type"] = "directory" if entry.is_dir else "file"
+            case "size":
+                info["size"] = entry.size
+            case "mtime":
+                info["mtime"] = entry.mtime_ns / 10 ** 9
+            case "mime":
+                info["mime"] = entry.mime
+    return info
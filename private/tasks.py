@@ -0,0 +1,105 @@
+"""
+The operations that can run as jobs (see private/jobs.py). The views call them directly with jobs.NO_JOB
+when they run in the request.
+"""
+import itertools
+import os
+import shutil
+from pathlib import Path
+
+from django.conf import settings
+
+from private import archive, block_index, dedup, extract, fs_index, icons, permissions
+from private.assembly import assemble
+from private.jobs import JobContext, JobFailed, kind
+from private.models import FilePacket
+
+
+@kind("zip")
+def zip_files(context: JobContext, path: str, files: list[str], username: str) -> dict:
+    engine = permissions.get_engine()
+    members = archive.members([settings.FFS_FS_ROOT / file for file in files],
+                              allowed=lambda p: engine.blocking_rule(p, username) is None)
+    stats = archive.build_zip(settings.FFS_FS_ROOT / path, members,
+                              progress=lambda member: context.progress(1, 0 if member.is_dir else member.stat.st_size))
+    fs_index.changed(path)
+
+    return {"files": stats.files, "bytes_in": stats.bytes_in, "bytes_out": stats.bytes_out}
+
+
+@kind("unzip")
+def unzip(context: JobContext, path: str) -> dict:
+    """
+    Extracts the zip or tar file next to it; fails with the reasons not to if it is dangerous
+    """
+    path = Path(path)
+    plan = extract.plan(settings.FFS_FS_ROOT / path, settings.FFS_FS_ROOT / path.parent)
+    if len(plan.errors) > 0:
+        raise JobFailed(f"{path} is not safe to extract", {"errors": plan.errors})
+
+    context.set_total(len(plan.files), plan.size)
+    stats = extract.extract(plan, progress=lambda size: context.progress(1, size))
+
+    fs_index.written(path.parent, itertools.chain(plan.directories, (m.name for m in plan.files + plan.links)))
+    icons.generate_in_background(*(path.parent / name for name in plan.top_level))
+    return {"files": stats.files, "bytes": stats.bytes, "skipped": stats.skipped}
+
+
+@kind("move")
+def move(context: JobContext, src: str, dst: str) -> dict:
+    """
+    Moves the file or directory. Within a file system that is a rename, otherwise everything is copied,
+    which reports progress; a move that is cancelled then leaves the copied part at dst.
+    """
+    full_src = settings.FFS_FS_ROOT / src
+    full_dst = settings.FFS_FS_ROOT / dst
+    # The view checked this, but it may have appeared since; shutil.move() would move into such a directory
+    if os.path.lexists(full_dst):
+        raise JobFailed(f"The file at {dst} already exists")
+
+    def copy(file_src, file_dst):
+        shutil.copy2(file_src, file_dst)
+        context.progress(1, os.path.getsize(file_dst))
+
+    full_dst.parent.mkdir(parents=True, exist_ok=True)
+    src_stat = os.lstat(full_src)
+    shutil.move(full_src, full_dst, copy_function=copy)
+    # A rename keeps the inode, a copy to another file system does not
+    dst_stat = os.lstat(full_dst)
+    renamed = (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino)
+    block_index.move(full_src, full_dst)
+    dedup.move(full_src, full_dst, renamed)
+    icons.move(Path(src), Path(dst))
+    fs_index.move(src, dst)
+
+    return {"dst": dst}
+
+
+@kind("assemble")
+def assemble_file(context: JobContext, path: str, hashes: list[str]) -> dict:
+    """
+    Writes the file from the (stored) file packets
+    """
+    full_path = settings.FFS_FS_ROOT / path
+    statuses = FilePacket.statuses_for(hashes)
+    if missing := [hsh for hsh, status in statuses.items() if status != FilePacket.STORED]:
+        raise RuntimeError(f"The file packets {missing} are not stored (anymore)")
+
+    packet_files = FilePacket.files_for(hashes)
+    parts = [settings.FFS_FILE_PACKET_CACHE / packet_files[str(hsh)] for hsh in hashes]
+    context.set_total(len(parts), sum(part.stat().st_size for part in parts))
+
+    def progress(size):
+        context.progress(1, size)
+
+    if dedup.enabled():
+        dedup.assemble_deduplicated(full_path, hashes, parts, progress)
+    else:
+        assemble(full_path, parts, progress=progress)
+
+    block_index.invalidate(full_path)
+    block_index.store_assembled(full_path, hashes, parts)
+    fs_index.changed(path)
+    icons.generate_in_background(Path(path))
+
+    return {"size": full_path.stat().st_size}
@@ -1,18 +1,36 @@
 # Create your tests here.
+import datetime
+import errno
 import hashlib
+import io
+import json
 import os
 import random
+import shutil
+import tarfile
+import threading
+import zipfile
+import zlib
 from functools import reduce
 from pathlib import Path
-from unittest import skipUnless
+from unittest import skipUnless, mock
+from urllib.parse import quote
 
+from PIL import Image
 from django.conf import settings
 from django.contrib.auth.models import User, Permission
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django.utils import timezone
 
+import general
+from general import get_mime_type, UserError
 from guenthner_xyz import settings
-from private.models import FilePacket
+from private import permissions, packet_gc, dedup, fs_index, icons, archive, jobs, extract, exif, tasks, block_index, zip_worker
+from private.accel import accel_response
+from private.assembly import assemble, BUFFERED
+from private.hashing import FileHasher, ParallelHasher
+from private.paths import ResolvedPath
+from private.models import FilePacket, PermissionsRule, BlockHashIndex, FsEntry, ImageIcon, Job, PacketChain
 
 
 def test_file_packet_messages(self, messages):
@@ -36,6 +54,8 @@ def test_file_packet_messages(self, messages):
         self.assertEqual(reduce(lambda a, b: a + b, response.streaming_content), msg)
 
 
+# Job runner threads could not see the data of the tests
+@override_settings(FFS_JOB_WORKERS=0)
 class MyTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -45,6 +65,8 @@ class MyTestCase(TestCase):
     def setUp(self):
         self.client = Client()
         self.client.force_login(self.user)
+        # Rules from other tests are rolled back without a delete signal
+        permissions.invalidate()
         self.my_set_up()
 
     def my_set_up(self):
@@ -84,6 +106,34 @@ class FilePacketTests(MyTestCase):
     def test_super_long_msg(self):
         test_file_packet_messages(self, self.super_long_messages)
 
+    def test_batch_status(self):
+        stored = hashlib.sha256(b"stored").hexdigest()
+        self.assertSuccessful(self.client.post(f"/private/ffs/file-packet/{stored}", content_type="text/plain",
+                                               data=b"stored"))
+        unknown = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(FilePacket.BULK_CHUNK_SIZE * 2)]
+
+        with self.assertNumQueries(3):
+            statuses = FilePacket.statuses_for([stored, *unknown])
+        self.assertEqual(list(statuses.keys()), [stored, *unknown])
+
+        response = self.client.post("/private/ffs/file-packet-status/", content_type="application/json",
+                                    data={"hashes": [stored, unknown[0]]})
+        self.assertSuccessful(response)
+        self.assertEqual(response.json()["hashes"], {stored: FilePacket.STORED, unknown[0]: FilePacket.PENDING})
+
+        response = self.client.post("/private/ffs/file-packet-status/", content_type="application/json",
+                                    data={"hashes": "not a list"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_wrong_hash(self):
+        digest = hashlib.sha256(b"something else").hexdigest()
+        response = self.client.post(f"/private/ffs/file-packet/{digest}", content_type="text/plain", data=b"message")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("What you uploaded: message", response.content.decode())
+
+        directory = settings.FFS_FILE_PACKET_CACHE / digest[:2]
+        self.assertEqual([f for f in directory.iterdir() if digest[2:] in f.name], [])
+
 
 class FileLedgerTest(MyTestCase):
     def upload_test_frwk(self, file_name, test_data):
@@ -135,3 +185,1127 @@ class FileLedgerTest(MyTestCase):
         print()
 
         self.upload_test_frwk("large_upload_test", test_data)
+
+
+class PermissionsTests(MyTestCase):
+    def my_set_up(self):
+        (settings.FFS_FS_ROOT / "django-test" / "secret").mkdir(parents=True, exist_ok=True)
+        (settings.FFS_FS_ROOT / "django-test" / "mine").mkdir(parents=True, exist_ok=True)
+
+    def test_blocked(self):
+        PermissionsRule.objects.create(rule="django-test/secret", users="^Nobody$")
+        self.assertEqual(self.client.get("/private/ffs/info/django-test/secret").status_code, 403)
+        self.assertSuccessful(self.client.get("/private/ffs/info/django-test/mine"))
+
+    def test_invalidated_on_delete(self):
+        rule = PermissionsRule.objects.create(rule="django-test/secret", users="^Nobody$")
+        self.assertEqual(self.client.get("/private/ffs/info/django-test/secret").status_code, 403)
+        rule.delete()
+        self.assertSuccessful(self.client.get("/private/ffs/info/django-test/secret"))
+
+    @override_settings(FFS_PERMISSIONS_CACHE_SECONDS=0)
+    def test_changed_elsewhere(self):
+        engine = permissions.get_engine()
+        self.assertIs(permissions.get_engine(), engine)
+        # Like another process, without the signals
+        PermissionsRule.objects.bulk_create([PermissionsRule(rule="django-test/secret", users="^Nobody$")])
+        self.assertEqual(self.client.get("/private/ffs/info/django-test/secret").status_code, 403)
+        PermissionsRule.objects.filter(rule="django-test/secret").update(users="^Test$", updated=timezone.now())
+        self.assertSuccessful(self.client.get("/private/ffs/info/django-test/secret"))
+
+    def test_template(self):
+        PermissionsRule.objects.create(rule="django-test/$USER/", users="^$USER$", is_template=True)
+        engine = permissions.get_engine()
+        paths = ["django-test/Test/a", "django-test/Other/a", "django-test/mine"]
+        self.assertEqual(list(engine.filter_allowed(paths, "Test")), ["django-test/Test/a", "django-test/mine"])
+        self.assertEqual(list(engine.filter_allowed(paths, "Other")), ["django-test/Other/a", "django-test/mine"])
+
+    def test_capture_groups(self):
+        PermissionsRule.objects.create(rule="django-test/(a|b)\\1", users="^Nobody$")
+        engine = permissions.get_engine()
+        self.assertIsNotNone(engine.blocking_rule(Path("django-test/aa"), "Test"))
+        self.assertIsNone(engine.blocking_rule(Path("django-test/ab"), "Test"))
+
+
+class RangeTests(MyTestCase):
+    def my_set_up(self):
+        self.data = random.randbytes(10000)
+        self.path = Path("django-test") / "range_test"
+        (settings.FFS_FS_ROOT / self.path).parent.mkdir(parents=True, exist_ok=True)
+        (settings.FFS_FS_ROOT / self.path).write_bytes(self.data)
+        self.url = f"/private/ffs/raw/{self.path}"
+
+    def test_full(self):
+        response = self.client.get(self.url)
+        self.assertSuccessful(response)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+
+    def test_single_range(self):
+        response = self.client.get(self.url, headers={"Range": "bytes=100-199"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 100-199/10000")
+        self.assertEqual(b"".join(response.streaming_content), self.data[100:200])
+
+        response = self.client.get(self.url, headers={"Range": "bytes=-10"})
+        self.assertEqual(b"".join(response.streaming_content), self.data[-10:])
+
+    def test_multiple_ranges(self):
+        response = self.client.get(self.url, headers={"Range": "bytes=0-9, 50-59"})
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response["Content-Type"].startswith("multipart/byteranges"))
+        body = b"".join(response.streaming_content)
+        self.assertEqual(len(body), int(response["Content-Length"]))
+        self.assertIn(self.data[0:10], body)
+        self.assertIn(self.data[50:60], body)
+
+    def test_unsatisfiable(self):
+        response = self.client.get(self.url, headers={"Range": "bytes=20000-"})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */10000")
+
+    def test_if_range(self):
+        etag = self.client.head(self.url)["ETag"]
+        response = self.client.get(self.url, headers={"Range": "bytes=0-9", "If-Range": etag})
+        self.assertEqual(response.status_code, 206)
+        response = self.client.get(self.url, headers={"Range": "bytes=0-9", "If-Range": '"outdated"'})
+        self.assertSuccessful(response)
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+
+
+class AccelTests(MyTestCase):
+    def my_set_up(self):
+        self.path = Path("django-test") / "accel test"
+        (settings.FFS_FS_ROOT / self.path).parent.mkdir(parents=True, exist_ok=True)
+        (settings.FFS_FS_ROOT / self.path).write_bytes(b"accel")
+
+    def test_disabled(self):
+        response = self.client.get(f"/private/ffs/raw/{self.path}")
+        self.assertNotIn("X-Accel-Redirect", response)
+        self.assertEqual(b"".join(response.streaming_content), b"accel")
+
+    def test_accel_redirect(self):
+        with self.settings(FFS_ACCEL_HEADER="X-Accel-Redirect",
+                           FFS_ACCEL_LOCATIONS={"FFS_FS_ROOT": "/internal/ffs/"}):
+            response = self.client.get(f"/private/ffs/raw/{self.path}")
+        self.assertSuccessful(response)
+        self.assertEqual(response["X-Accel-Redirect"], "/internal/ffs/django-test/accel%20test")
+
+    def test_sendfile(self):
+        with self.settings(FFS_ACCEL_HEADER="X-Sendfile"):
+            response = self.client.get(f"/private/ffs/raw/{self.path}")
+        self.assertEqual(response["X-Sendfile"], str(settings.FFS_FS_ROOT / self.path))
+
+    def test_sendfile_unsafe(self):
+        for name in ["accel ü", "accel 100%"]:
+            path = self.path.parent / name
+            (settings.FFS_FS_ROOT / path).write_bytes(b"accel")
+            with self.settings(FFS_ACCEL_HEADER="X-Sendfile"):
+                response = self.client.get(f"/private/ffs/raw/{quote(str(path))}")
+            self.assertNotIn("X-Sendfile", response)
+            self.assertEqual(b"".join(response.streaming_content), b"accel")
+
+        with self.settings(FFS_ACCEL_HEADER="X-Sendfile"):
+            self.assertIsNone(accel_response(settings.FFS_FS_ROOT / "line\nbreak", "text/plain"))
+
+    def test_unmapped(self):
+        with self.settings(FFS_ACCEL_HEADER="X-Accel-Redirect", FFS_ACCEL_LOCATIONS={}):
+            response = self.client.get(f"/private/ffs/raw/{self.path}")
+        self.assertEqual(b"".join(response.streaming_content), b"accel")
+
+
+class BlockIndexTests(MyTestCase):
+    def my_set_up(self):
+        self.path = Path("django-test") / "block_index_test"
+        self.full_path = settings.FFS_FS_ROOT / self.path
+        self.full_path.parent.mkdir(parents=True, exist_ok=True)
+        self.blocks = [random.randbytes(settings.FFS_NET_BLOCK_SIZE), random.randbytes(1000)]
+        self.full_path.write_bytes(b"".join(self.blocks))
+
+    def ledger(self):
+        response = self.client.get(f"/private/ffs/file-ledger/{self.path}")
+        self.assertSuccessful(response)
+        return list(response.json()["hashes"].keys())
+
+    def test_cached(self):
+        expected = [hashlib.sha256(b).hexdigest() for b in self.blocks]
+        self.assertEqual(self.ledger(), expected)
+        self.assertEqual(BlockHashIndex.objects.get(path=str(self.full_path)).hashes, expected)
+        self.assertEqual(self.ledger(), expected)
+
+    def test_invalidated_on_write(self):
+        self.ledger()
+        response = self.client.post(f"/private/ffs/raw/{self.path}", content_type="text/plain", data=b"new")
+        self.assertSuccessful(response)
+        self.assertFalse(BlockHashIndex.objects.filter(path=str(self.full_path)).exists())
+        self.assertEqual(self.ledger(), [hashlib.sha256(b"new").hexdigest()])
+
+    def test_moved(self):
+        hashes = self.ledger()
+        new_path = Path("django-test") / "block_index_moved"
+        (settings.FFS_FS_ROOT / new_path).unlink(missing_ok=True)
+        response = self.client.post(f"/private/ffs/move/{self.path}", content_type="text/plain", data=str(new_path))
+        self.assertSuccessful(response)
+        self.assertEqual(BlockHashIndex.objects.get(path=str(settings.FFS_FS_ROOT / new_path)).hashes, hashes)
+
+    def test_case_sensitive(self):
+        for name in ["Foo", "foo"]:
+            BlockHashIndex.objects.create(path=f"/case/{name}/a", block_size=1, size=0, mtime_ns=0)
+            FsEntry.objects.create(path=f"case/{name}/a", parent=f"case/{name}", name="a", is_dir=False, size=0,
+                                   mtime_ns=0, mime="inode/x-empty")
+            ImageIcon.objects.create(path=f"case/{name}/a", size=32, format="webp", src_size=0, src_mtime_ns=0,
+                                     bytes=0)
+
+        block_index.invalidate(Path("/case/Foo"))
+        fs_index.remove("case/Foo")
+        icons.remove(Path("case/Foo"))
+        self.assertEqual(list(BlockHashIndex.objects.filter(path__startswith="/case/").values_list("path", flat=True)),
+                         ["/case/foo/a"])
+        self.assertEqual([e.path for e in FsEntry.objects.filter(path__startswith="case/")], ["case/foo/a"])
+        self.assertEqual([i.path for i in ImageIcon.objects.filter(path__startswith="case/")], ["case/foo/a"])
+
+
+class HashingTests(MyTestCase):
+    def test_parallel_matches_serial(self):
+        file = settings.FFS_FS_ROOT / "django-test" / "hashing_test"
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(random.randbytes(10 * 1000 + 123))
+        block_size = 1000
+
+        with FileHasher(file, buffer_size=300) as hasher:
+            expected = [hasher.hash(offset, block_size) for offset in range(0, file.stat().st_size, block_size)]
+
+        for workers in [1, 3, 20]:
+            self.assertEqual(ParallelHasher(file, block_size, workers, buffer_size=300).hash_blocks(), expected)
+
+
+class AssemblyTests(MyTestCase):
+    def my_set_up(self):
+        self.directory = settings.FFS_FS_ROOT / "django-test" / "assembly"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.data = [random.randbytes(size) for size in [4096, 10000, 0, 123]]
+        self.parts = []
+        for i, data in enumerate(self.data):
+            part = self.directory / f"part{i}"
+            part.write_bytes(data)
+            self.parts.append(part)
+        self.dst = self.directory / "assembled"
+        self.dst.unlink(missing_ok=True)
+
+    def test_assemble(self):
+        assemble(self.dst, self.parts)
+        self.assertEqual(self.dst.read_bytes(), b"".join(self.data))
+
+    def test_buffered_fallback(self):
+        methods = assemble(self.dst, self.parts, clone=False, copy_file_range=False)
+        self.assertEqual(methods[BUFFERED], len([d for d in self.data if len(d) > 0]))
+        self.assertEqual(self.dst.read_bytes(), b"".join(self.data))
+
+    def test_no_partial_file(self):
+        with self.assertRaises(FileNotFoundError):
+            assemble(self.dst, [*self.parts, self.directory / "does not exist"])
+        self.assertFalse(self.dst.exists())
+        self.assertEqual([f for f in self.directory.iterdir() if f.name.startswith(".")], [])
+
+
+class PacketGcTests(MyTestCase):
+    def upload(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        self.assertSuccessful(self.client.post(f"/private/ffs/file-packet/{digest}", content_type="text/plain",
+                                               data=data))
+        return digest
+
+    def test_expired(self):
+        old = self.upload(b"old packet")
+        new = self.upload(b"new packet")
+        FilePacket.objects.filter(hsh=old).update(last_used=timezone.now() - datetime.timedelta(days=10))
+
+        stats = packet_gc.collect()
+        self.assertEqual(stats.packets_deleted, 1)
+        self.assertEqual(stats.bytes_reclaimed, len(b"old packet"))
+        self.assertFalse(FilePacket.objects.filter(hsh=old).exists())
+        self.assertFalse((settings.FFS_FILE_PACKET_CACHE / old[:2] / old[2:]).exists())
+        self.assertEqual(FilePacket.status_for(new), FilePacket.STORED)
+
+    def test_refreshed(self):
+        packets = [self.upload(b"old packet"), self.upload(b"refreshed packet")]
+        FilePacket.objects.filter(hsh__in=packets).update(last_used=timezone.now() - datetime.timedelta(days=10))
+
+        def select_then_refresh(expired, batch_size):
+            batch = select(expired, batch_size)
+            # Like an upload between selecting and deleting the batch
+            FilePacket.objects.filter(hsh=packets[1]).update(last_used=timezone.now())
+            return batch
+
+        select = packet_gc._expired_batch
+        with mock.patch("private.packet_gc._expired_batch", side_effect=select_then_refresh):
+            stats = packet_gc.collect()
+
+        self.assertEqual(stats.packets_deleted, 1)
+        self.assertEqual(FilePacket.status_for(packets[1]), FilePacket.STORED)
+        self.assertTrue((settings.FFS_FILE_PACKET_CACHE / packets[1][:2] / packets[1][2:]).exists())
+
+    def test_orphans(self):
+        without_file = self.upload(b"packet without file")
+        (settings.FFS_FILE_PACKET_CACHE / without_file[:2] / without_file[2:]).unlink()
+
+        orphan = settings.FFS_FILE_PACKET_CACHE / "00" / "orphan"
+        orphan.parent.mkdir(parents=True, exist_ok=True)
+        orphan.write_bytes(b"orphan")
+        young_orphan = settings.FFS_FILE_PACKET_CACHE / "00" / "young orphan"
+        young_orphan.write_bytes(b"young")
+        os.utime(orphan, (0, 0))
+
+        stats = packet_gc.collect(orphans=True)
+        self.assertEqual(stats.missing_files, 1)
+        self.assertFalse(FilePacket.objects.filter(hsh=without_file).exists())
+        self.assertFalse(orphan.exists())
+        self.assertTrue(young_orphan.exists())
+        young_orphan.unlink()
+
+    def test_pinned(self):
+        hsh = self.upload(b"pinned packet")
+        file = settings.FFS_FS_ROOT / "django-test" / "deduplicated"
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(b"pinned packet")
+        dedup.pin(file, [hsh])
+        FilePacket.objects.filter(hsh=hsh).update(last_used=timezone.now() - datetime.timedelta(days=10))
+
+        self.assertEqual(packet_gc.collect().packets_deleted, 0)
+        self.assertEqual(FilePacket.status_for(hsh), FilePacket.STORED)
+
+        # Released by the background collection as well
+        file.write_bytes(b"changed")
+        stats = packet_gc.collect(time_budget=10)
+        self.assertEqual(stats.chains_released, 1)
+        self.assertEqual(stats.packets_deleted, 1)
+
+    def test_moved_to_other_file_system(self):
+        hsh = self.upload(b"pinned packet")
+        directory = settings.FFS_FS_ROOT / "django-test" / "dedup"
+        shutil.rmtree(directory, ignore_errors=True)
+        directory.mkdir(parents=True)
+        (directory / "src").write_bytes(b"pinned packet")
+        dedup.pin(directory / "src", [hsh])
+
+        with mock.patch("os.rename", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")):
+            tasks.move(jobs.NO_JOB, "django-test/dedup/src", "django-test/dedup/dst")
+        self.assertEqual((directory / "dst").read_bytes(), b"pinned packet")
+        self.assertFalse(PacketChain.objects.exists())
+
+    def test_time_budget(self):
+        for i in range(3):
+            self.upload(f"packet {i}".encode())
+        FilePacket.objects.update(last_used=timezone.now() - datetime.timedelta(days=10))
+
+        stats = packet_gc.collect(batch_size=1, time_budget=0)
+        self.assertFalse(stats.complete)
+        self.assertEqual(packet_gc.collect(batch_size=1).packets_deleted, 3)
+
+
+class ValidatorTests(MyTestCase):
+    def test_directory_etag(self):
+        directory = settings.FFS_FS_ROOT / "django-test" / "etag_test"
+        shutil.rmtree(directory, ignore_errors=True)
+        directory.mkdir(parents=True)
+        url = "/private/ffs/raw/django-test/etag_test"
+
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(self.client.get(url, headers={"If-None-Match": etag}).status_code, 304)
+
+        (directory / "new file").touch()
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertSuccessful(response)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_single_stat(self):
+        file = settings.FFS_FS_ROOT / "django-test" / "stat_test"
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(b"stat")
+
+        with mock.patch.object(ResolvedPath, "refresh", autospec=True, side_effect=ResolvedPath.refresh) as refresh:
+            self.assertSuccessful(self.client.get("/private/ffs/raw/django-test/stat_test"))
+        self.assertEqual(refresh.call_count, 1)
+
+
+class MimeCacheTests(MyTestCase):
+    def my_set_up(self):
+        general.mime_cache.clear()
+        self.directory = settings.FFS_FS_ROOT / "django-test" / "mime"
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def test_cached(self):
+        file = self.directory / "text"
+        file.write_text("Hello there")
+
+        with mock.patch("general.magic.from_file", wraps=general.magic.from_file) as from_file:
+            self.assertEqual(get_mime_type(file), "text/plain")
+            self.assertEqual(get_mime_type(file), "text/plain")
+            self.assertEqual(from_file.call_count, 1)
+
+            file.write_text("<html><body>Now it is different</body></html>")
+            self.assertEqual(get_mime_type(file), "application/xml")
+            self.assertEqual(from_file.call_count, 2)
+
+    def test_persistent(self):
+        file = self.directory / "persistent"
+        file.write_text("Hello there")
+        cache = general.FileCache("test", 10, "FFS_MIME_CACHE_ALIAS")
+        compute = mock.Mock(return_value="value")
+
+        with mock.patch.object(general.settings, "FFS_MIME_CACHE_ALIAS", "default"):
+            for _ in range(2):
+                self.assertEqual(cache.get(file, file.stat(), compute), "value")
+                cache.clear()
+        self.assertEqual(compute.call_count, 1)
+
+    def test_fast_path(self):
+        file = self.directory / "picture.JPG"
+        file.write_bytes(b"not sniffed")
+
+        with mock.patch("general.magic.from_file") as from_file:
+            self.assertEqual(get_mime_type(file), "image/jpeg")
+            self.assertEqual(get_mime_type(self.directory), "inode/directory")
+            from_file.assert_not_called()
+
+
+class InfoTests(MyTestCase):
+    def my_set_up(self):
+        self.root = settings.FFS_FS_ROOT / "django-test" / "info"
+        shutil.rmtree(self.root, ignore_errors=True)
+        (self.root / "a" / "deeper").mkdir(parents=True)
+        (self.root / "a" / "x").write_text("x")
+        (self.root / "a" / "y").write_text("yy")
+        (self.root / "b").write_text("bbb")
+        self.all_paths = ["django-test/info", "django-test/info/a", "django-test/info/a/deeper",
+                          "django-test/info/a/x", "django-test/info/a/y", "django-test/info/b"]
+
+    def stream(self, **params):
+        response = self.client.get("/private/ffs/info/django-test/info", {"format": "ndjson", **params})
+        self.assertSuccessful(response)
+        return [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+
+    def test_legacy(self):
+        response = self.client.get("/private/ffs/info/django-test/info", {"level": 1})
+        self.assertSuccessful(response)
+        self.assertEqual(response.json()["django-test/info/b"],
+                         {"path": "django-test/info/b", "name": "b", "size": 3, "mime": "text/plain"})
+
+    def test_stream(self):
+        entries = self.stream(level=2, fields="path")
+        self.assertEqual([e["path"] for e in entries], self.all_paths)
+
+    def test_pagination(self):
+        paths = []
+        cursor = None
+        while True:
+            params = {"level": 2, "limit": 2, "fields": "path"}
+            if cursor is not None:
+                params["cursor"] = cursor
+            entries = self.stream(**params)
+            cursor = entries[-1].get("cursor")
+            paths += [e["path"] for e in entries if "path" in e]
+            if cursor is None:
+                break
+        self.assertEqual(paths, self.all_paths)
+
+    def test_dots_in_name(self):
+        (self.root / "backup..").mkdir()
+        (self.root / "backup.." / "z").write_text("z")
+        entries = self.stream(level=2, fields="path")
+        self.assertIn("django-test/info/backup../z", [e.get("path") for e in entries])
+        self.assertIsNone(permissions.get_engine().blocking_rule(Path("django-test/backup../z"), "Test"))
+        with self.assertRaises(UserError):
+            permissions.get_engine().blocking_rule(Path("django-test/../z"), "Test")
+
+    def test_sort(self):
+        entries = self.stream(level=1, sort="-size", fields="name,size,type")
+        self.assertEqual([e["name"] for e in entries[1:]], ["a", "b"] if entries[1]["size"] > 3 else ["b", "a"])
+        self.assertEqual(set(entries[0].keys()), {"name", "size", "type"})
+
+
+class ListingTests(MyTestCase):
+    def my_set_up(self):
+        self.root = settings.FFS_FS_ROOT / "django-test" / "listing"
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.root.mkdir(parents=True)
+        for name in ["c", "a", "img_2", "img_1"]:
+            (self.root / name).touch()
+        for name in ["z", "b"]:
+            (self.root / name).mkdir()
+
+    def listing(self, **params):
+        response = self.client.get("/private/ffs/raw/django-test/listing", params)
+        self.assertSuccessful(response)
+        return response.json()
+
+    def test_order(self):
+        files = self.listing()
+        self.assertEqual(list(files.keys()), ["b", "z", "a", "c", "img_1", "img_2"])
+        self.assertEqual(files["a"], "django-test/listing/a")
+
+    def test_paging(self):
+        self.assertEqual(list(self.listing(offset=1, limit=2).keys()), ["z", "a"])
+        self.assertEqual(list(self.listing(prefix="img").keys()), ["img_1", "img_2"])
+
+    def test_invalid_counts(self):
+        for params in [{"offset": "x"}, {"limit": "-1"}]:
+            self.assertEqual(self.client.get("/private/ffs/raw/django-test/listing", params).status_code, 400)
+            self.assertEqual(self.client.get("/private/ffs/sprite/django-test/listing", params).status_code, 400)
+        for limit in ["x", "-1"]:
+            response = self.client.get("/private/ffs/info/django-test/listing", {"format": "ndjson", "limit": limit})
+            self.assertEqual(response.status_code, 400)
+
+
+class FsIndexTests(MyTestCase):
+    def my_set_up(self):
+        self.root = settings.FFS_FS_ROOT / "django-test" / "fs-index"
+        shutil.rmtree(self.root, ignore_errors=True)
+        (self.root / "sub").mkdir(parents=True)
+        (self.root / "a.txt").write_text("Some text")
+        (self.root / "sub" / "big.txt").write_text("b" * 100)
+        fs_index.rescan("django-test/fs-index")
+
+    def test_rescan(self):
+        self.assertEqual(FsEntry.objects.filter(path__startswith="django-test/fs-index").count(), 4)
+        self.assertEqual(fs_index.get("django-test/fs-index/sub/big.txt").mime, "text/plain")
+
+        (self.root / "a.txt").unlink()
+        (self.root / "new").touch()
+        fs_index.rescan("django-test/fs-index")
+        self.assertIsNone(fs_index.get("django-test/fs-index/a.txt"))
+        self.assertIsNotNone(fs_index.get("django-test/fs-index/new"))
+
+    def test_queries(self):
+        largest = fs_index.largest_files("django-test/fs-index", 1)
+        self.assertEqual([e.path for e in largest], ["django-test/fs-index/sub/big.txt"])
+        self.assertEqual(len(fs_index.files_by_mime("text", "django-test/fs-index")), 2)
+
+    def test_views(self):
+        with self.settings(FFS_FS_INDEX=True):
+            # Only in the index, so the response must come from it
+            FsEntry.objects.create(path="django-test/fs-index/ghost", parent="django-test/fs-index", name="ghost",
+                                   is_dir=False, size=0, mtime_ns=0, mime="inode/x-empty")
+            response = self.client.get("/private/ffs/raw/django-test/fs-index")
+            self.assertSuccessful(response)
+            self.assertEqual(list(response.json().keys()), ["sub", "a.txt", "ghost"])
+
+            response = self.client.get("/private/ffs/info/django-test/fs-index", {"level": 2})
+            self.assertSuccessful(response)
+            self.assertEqual(response.json()["django-test/fs-index/sub/big.txt"]["size"], 100)
+
+    def ghost(self, path):
+        # Only in the index, so it survives exactly as long as nothing rescans its directory
+        fs_index.update(fs_index.ROOT)
+        fs_index.update("django-test")
+        FsEntry.objects.create(path=path, parent=fs_index.parent_of(path), name=Path(path).name, is_dir=False,
+                               size=0, mtime_ns=0, mime="inode/x-empty")
+
+    def test_written(self):
+        self.ghost("django-test/fs-index/sub/ghost")
+        (self.root / "sub" / "new").mkdir()
+        (self.root / "sub" / "new" / "c.txt").write_text("c")
+
+        with self.settings(FFS_FS_INDEX=True):
+            fs_index.written("django-test/fs-index/sub", ["new", "new/c.txt"])
+        self.assertEqual(fs_index.get("django-test/fs-index/sub/new/c.txt").size, 1)
+        self.assertIsNotNone(fs_index.get("django-test/fs-index/sub/ghost"))
+
+    def test_move(self):
+        self.ghost("django-test/fs-index/sub/ghost")
+        with self.settings(FFS_FS_INDEX=True):
+            tasks.move(jobs.NO_JOB, "django-test/fs-index/sub", "django-test/fs-index/moved")
+
+        self.assertIsNone(fs_index.get("django-test/fs-index/sub/big.txt"))
+        moved = fs_index.get("django-test/fs-index/moved/big.txt")
+        self.assertEqual((moved.parent, moved.size), ("django-test/fs-index/moved", 100))
+        self.assertEqual(fs_index.get("django-test/fs-index/moved").name, "moved")
+        self.assertIsNotNone(fs_index.get("django-test/fs-index/moved/ghost"))
+
+    def test_watcher(self):
+        watcher = fs_index.InotifyWatcher()
+        try:
+            watcher.watch("django-test/fs-index")
+            (self.root / "sub" / "c.txt").write_text("c")
+            (self.root / "a.txt").unlink()
+            (self.root / "dir").mkdir()
+            actions = {}
+            while len(events := watcher.poll(timeout=1)) > 0:
+                actions.update(events)
+        finally:
+            watcher.close()
+
+        self.assertEqual(actions, {"django-test/fs-index/sub/c.txt": fs_index.UPDATE,
+                                   "django-test/fs-index/a.txt": fs_index.REMOVE,
+                                   "django-test/fs-index/dir": fs_index.RESCAN})
+
+
+class SearchTests(MyTestCase):
+    def my_set_up(self):
+        self.root = settings.FFS_FS_ROOT / "django-test" / "search"
+        shutil.rmtree(self.root, ignore_errors=True)
+        (self.root / "photos").mkdir(parents=True)
+        (self.root / "photos" / "IMG_1.jpg").write_bytes(b"\xff\xd8\xff\xe0" + b"\0" * 100)
+        (self.root / "photos" / "notes.txt").write_text("Some text about the photos")
+        (self.root / "secret.txt").write_text("Some secret text")
+        fs_index.rescan("django-test/search")
+
+    def search(self, **params):
+        with self.settings(FFS_FS_INDEX=True):
+            response = self.client.get("/private/ffs/search/django-test/search", {"fields": "path", **params})
+        self.assertSuccessful(response)
+        return [json.loads(line)["path"] for line in b"".join(response.streaming_content).decode().splitlines()]
+
+    def test_filters(self):
+        self.assertEqual(self.search(glob="*.txt"), ["django-test/search/photos/notes.txt",
+                                                     "django-test/search/secret.txt"])
+        self.assertEqual(self.search(name="img"), ["django-test/search/photos/IMG_1.jpg"])
+        self.assertEqual(self.search(glob="*.[jJ][pP][gG]"), ["django-test/search/photos/IMG_1.jpg"])
+        self.assertEqual(self.search(glob="IMG_[0-9].jpg"), ["django-test/search/photos/IMG_1.jpg"])
+        self.assertEqual(self.search(regex=r"photos/.*\.jpg$"), ["django-test/search/photos/IMG_1.jpg"])
+        self.assertEqual(self.search(mime="image"), ["django-test/search/photos/IMG_1.jpg"])
+        self.assertEqual(self.search(min_size=100, type="file"), ["django-test/search/photos/IMG_1.jpg"])
+        self.assertEqual(self.search(type="directory", sort="-name"), ["django-test/search",
+                                                                        "django-test/search/photos"])
+        self.assertEqual(self.search(before="2000-01-01"), [])
+        self.assertEqual(len(self.search(limit=2)), 2)
+
+    def test_permissions(self):
+        PermissionsRule.objects.create(rule="django-test/search/secret", users="^Nobody$")
+        self.assertEqual(self.search(glob="*.txt"), ["django-test/search/photos/notes.txt"])
+
+    def test_disabled(self):
+        response = self.client.get("/private/ffs/search/django-test/search", {"name": "x"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_limit(self):
+        with self.settings(FFS_FS_INDEX=True):
+            for limit in ["-1", "x"]:
+                response = self.client.get("/private/ffs/search/django-test/search", {"limit": limit})
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.search(limit=0), [])
+
+
+class IconTests(MyTestCase):
+    def my_set_up(self):
+        self.root = settings.FFS_FS_ROOT / "django-test" / "icons"
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.root.mkdir(parents=True)
+        Image.new("RGB", (400, 200), "red").save(self.root / "wide.jpg")
+        for size in settings.FFS_ICON_SIZES:
+            shutil.rmtree(settings.FFS_IMAGE_ICONS / str(size) / "django-test", ignore_errors=True)
+
+    def icon(self, **params):
+        response = self.client.get("/private/ffs/icon/django-test/icons/wide.jpg", params)
+        self.assertSuccessful(response)
+        return response["Content-Type"], Image.open(io.BytesIO(b"".join(response.streaming_content)))
+
+    def test_sizes(self):
+        content_type, img = self.icon()
+        self.assertEqual((content_type, img.format, img.size), ("image/webp", "WEBP", (32, 16)))
+
+        content_type, img = self.icon(size=128, format="jpeg")
+        self.assertEqual((content_type, img.format, img.size), ("image/jpeg", "JPEG", (128, 64)))
+
+        response = self.client.get("/private/ffs/icon/django-test/icons/wide.jpg", {"size": 100})
+        self.assertEqual(response.status_code, 400)
+
+    def test_in_process(self):
+        with self.settings(FFS_ICON_WORKERS=0):
+            self.assertEqual(self.icon(size=256)[1].size, (256, 128))
+
+    def test_coalescing(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_render(*args):
+            started.set()
+            release.wait(5)
+
+        # Other threads cannot see the test's database transaction
+        with self.settings(FFS_ICON_WORKERS=0), \
+                mock.patch("private.thumbnail_worker.render", side_effect=slow_render) as render, \
+                mock.patch("private.icons._record"), mock.patch("private.icons._count_rendered"):
+            path = Path("django-test/icons/wide.jpg")
+            stat = os.stat(settings.FFS_FS_ROOT / path)
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(icons.create_icon(path, 32, "webp", stat)))
+                       for _ in range(4)]
+            threads[0].start()
+            started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(len(results), 4)
+
+    def test_sprite(self):
+        Image.new("RGB", (100, 300), "blue").save(self.root / "tall.png")
+        (self.root / "notes.txt").write_text("Not an image")
+        shutil.rmtree(icons.sprite_root / "django-test", ignore_errors=True)
+
+        response = self.client.get("/private/ffs/sprite/django-test/icons", {"size": 128, "map": 1})
+        self.assertSuccessful(response)
+        sprite_map = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(sprite_map["icons"], {"tall.png": [42, 0, 43, 128], "wide.jpg": [128, 32, 128, 64]})
+
+        response = self.client.get("/private/ffs/sprite/django-test/icons", {"size": 128})
+        self.assertSuccessful(response)
+        img = Image.open(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(img.size, (128 * icons.SPRITE_COLUMNS, 128))
+
+        response = self.client.get("/private/ffs/sprite/django-test/icons", {"size": 128},
+                                   headers={"If-None-Match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+    def test_sprite_permissions(self):
+        Image.new("RGB", (100, 300), "blue").save(self.root / "tall.png")
+        shutil.rmtree(icons.sprite_root / "django-test", ignore_errors=True)
+        PermissionsRule.objects.create(rule="django-test/icons/tall.png", users="^Nobody$")
+
+        response = self.client.get("/private/ffs/sprite/django-test/icons", {"size": 32, "map": 1})
+        self.assertSuccessful(response)
+        self.assertEqual(list(json.loads(b"".join(response.streaming_content))["icons"]), ["wide.jpg"])
+
+        # Another user's version of the same page is a different file and does not replace this one
+        _, own_map = icons.sprite_files(Path("django-test/icons"), 32, "webp", user="Test",
+                                        allowed=lambda p: p.name != "tall.png")
+        _, other_map = icons.sprite_files(Path("django-test/icons"), 32, "webp", user="Nobody")
+        self.assertNotEqual(own_map, other_map)
+        self.assertTrue(own_map.exists())
+        self.assertEqual(list(json.loads(other_map.read_text())["icons"]), ["tall.png", "wide.jpg"])
+
+    def test_sprite_formats(self):
+        shutil.rmtree(icons.sprite_root / "django-test", ignore_errors=True)
+        webp, _ = icons.sprite_files(Path("django-test/icons"), 32, "webp")
+        jpeg, _ = icons.sprite_files(Path("django-test/icons"), 32, "jpeg")
+        self.assertTrue(webp.exists())
+        self.assertTrue(jpeg.exists())
+
+        # Deleted by a newer version of the page right after it was looked up
+        real = icons.sprite_files
+        gone = (icons.sprite_root / "gone.webp", icons.sprite_root / "gone.json")
+        with mock.patch.object(icons, "sprite_files", side_effect=[gone, real(Path("django-test/icons"), 32, "webp")]):
+            response = self.client.get("/private/ffs/sprite/django-test/icons", {"size": 32, "format": "webp"})
+        self.assertSuccessful(response)
+        self.assertEqual(b"".join(response.streaming_content), webp.read_bytes())
+
+    def test_generate(self):
+        with self.settings(FFS_ICON_WORKERS=0):
+            self.assertEqual(icons.generate(Path("django-test/icons"), [32, 128], "jpeg", workers=1), (2, 0))
+            self.assertEqual(icons.generate(Path("django-test/icons"), [32, 128], "jpeg", workers=1), (0, 0))
+        self.assertTrue(icons.get_icon_file(Path("django-test/icons/wide.jpg"), 128, "jpeg").is_file())
+
+    def test_invalidation(self):
+        path = Path("django-test/icons/wide.jpg")
+        self.assertEqual(self.icon(size=128)[1].size, (128, 64))
+
+        Image.new("RGB", (200, 400), "red").save(self.root / "wide.jpg")
+        self.assertEqual(self.icon(size=128)[1].size, (64, 128))
+        self.assertEqual(ImageIcon.objects.get(path=str(path), size=128).src_size,
+                         (self.root / "wide.jpg").stat().st_size)
+
+        response = self.client.post("/private/ffs/move/django-test/icons/wide.jpg", "django-test/icons/moved.jpg",
+                                    content_type="text/plain")
+        self.assertSuccessful(response)
+        self.assertTrue(icons.get_icon_file(Path("django-test/icons/moved.jpg"), 128, "webp").is_file())
+        self.assertFalse(icons.get_icon_file(path, 128, "webp").exists())
+        self.assertEqual(ImageIcon.objects.filter(path__startswith="django-test/icons/moved").count(), 1)
+
+    def test_counters(self):
+        icons.flush_hits()
+        with mock.patch("private.icons.HIT_FLUSH_INTERVAL", 60 * 60):
+            for _ in range(3):
+                self.icon()
+            icon = ImageIcon.objects.get(size=32)
+            self.assertEqual(icon.hits, 0)
+            icons.flush_hits()
+            icon.refresh_from_db()
+            self.assertEqual(icon.hits, 2)
+
+        with mock.patch("private.icons.EVICT_EVERY", 2), mock.patch("private.icons._rendered", 0), \
+                mock.patch("private.icons.evict") as evict:
+            for _ in range(3):
+                icons._count_rendered()
+            self.assertEqual(evict.call_count, 1)
+
+    @mock.patch.object(icons, "sprite_root", icons.img_icon_root / "django-test-sprites")
+    def test_sprite_eviction(self):
+        shutil.rmtree(icons.sprite_root, ignore_errors=True)
+        old, old_map = icons.sprite_files(Path("django-test/icons"), 32, "webp")
+        new, new_map = icons.sprite_files(Path("django-test/icons"), 32, "jpeg")
+        os.utime(old_map, (0, 0))
+        os.utime(old, (0, 0))
+
+        self.assertEqual(icons.evict_sprites(max_age=60 * 60)[0], 1)
+        self.assertFalse(old_map.exists() or old.exists())
+        self.assertTrue(new_map.exists())
+        self.assertEqual(icons.evict_sprites(budget=1)[0], 1)
+        self.assertFalse(new.exists())
+
+    def test_eviction(self):
+        for size in settings.FFS_ICON_SIZES:
+            self.icon(size=size)
+        ImageIcon.objects.filter(size=32).update(hits=10)
+
+        with self.settings(FFS_ICON_EVICTION="lfu"):
+            budget = int(ImageIcon.objects.get(size=32).bytes / icons.EVICTION_TARGET) + 1
+            deleted, _ = icons.evict(budget)
+
+        self.assertEqual(deleted, 2)
+        self.assertEqual(list(ImageIcon.objects.values_list("size", flat=True)), [32])
+        self.assertFalse(icons.get_icon_file(Path("django-test/icons/wide.jpg"), 256, "webp").exists())
+
+
+class ArchiveTests(MyTestCase):
+    def my_set_up(self):
+        self.root = settings.FFS_FS_ROOT / "django-test" / "archive"
+        shutil.rmtree(self.root, ignore_errors=True)
+        (self.root / "empty").mkdir(parents=True)
+        (self.root / "notes.txt").write_text("Compressible text " * 1000)
+        (self.root / "secret").write_text("secret")
+        Image.new("RGB", (64, 64), "red").save(self.root / "photo.jpg")
+
+    def download(self, **params):
+        response = self.client.get("/private/ffs/archive/django-test/archive", params)
+        self.assertSuccessful(response)
+        return io.BytesIO(b"".join(response.streaming_content))
+
+    def test_zip(self):
+        PermissionsRule.objects.create(rule="django-test/archive/secret", users="^Nobody$")
+        with zipfile.ZipFile(self.download()) as downloaded:
+            self.assertEqual(downloaded.testzip(), None)
+            self.assertEqual(sorted(downloaded.namelist()), ["archive/", "archive/empty/", "archive/notes.txt",
+                                                          "archive/photo.jpg"])
+            self.assertEqual(downloaded.read("archive/notes.txt"), (self.root / "notes.txt").read_bytes())
+            self.assertEqual(downloaded.getinfo("archive/notes.txt").compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(downloaded.getinfo("archive/photo.jpg").compress_type, zipfile.ZIP_STORED)
+
+    def test_filename(self):
+        directory = self.root.parent / 'Ferien "2024"\u00e4'
+        directory.mkdir(exist_ok=True)
+        response = self.client.get(f"/private/ffs/archive/{quote(str(directory.relative_to(settings.FFS_FS_ROOT)))}")
+        self.assertSuccessful(response)
+        self.assertEqual(response["Content-Disposition"],
+                         "attachment; filename*=utf-8''Ferien%20%222024%22%C3%A4.zip")
+        directory.rmdir()
+
+    def test_tar(self):
+        with tarfile.open(fileobj=self.download(format="tar")) as downloaded:
+            self.assertEqual(sorted(downloaded.getnames()), ["archive", "archive/empty", "archive/notes.txt",
+                                                          "archive/photo.jpg", "archive/secret"])
+            self.assertEqual(downloaded.extractfile("archive/secret").read(), b"secret")
+
+    def test_post(self):
+        response = self.client.post("/private/ffs/archive/", {"files": ["django-test/archive/notes.txt"]},
+                                    content_type="application/json")
+        self.assertSuccessful(response)
+        with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as downloaded:
+            self.assertEqual(downloaded.namelist(), ["notes.txt"])
+
+    def test_build_zip(self):
+        (self.root / "data.bin").write_bytes(bytes(range(256)) * 1000)
+        (self.root / "big.txt").write_text("Too large for memory " * 10000)
+
+        for workers in [1, 2]:
+            dst = self.root.parent / "built.zip"
+            dst.unlink(missing_ok=True)
+            # big.txt does not fit into the memory limit, so it is compressed in this process
+            stats = archive.build_zip(dst, archive.members([self.root]), workers=workers, memory_limit=2 ** 18)
+
+            with zipfile.ZipFile(dst) as built:
+                self.assertEqual(built.testzip(), None)
+                self.assertEqual(built.getinfo("archive/notes.txt").compress_type, zipfile.ZIP_LZMA)
+                self.assertEqual(built.getinfo("archive/big.txt").compress_type, zipfile.ZIP_LZMA)
+                self.assertEqual(built.getinfo("archive/data.bin").compress_type, zipfile.ZIP_DEFLATED)
+                self.assertEqual(built.getinfo("archive/photo.jpg").compress_type, zipfile.ZIP_STORED)
+                self.assertEqual(built.read("archive/data.bin"), (self.root / "data.bin").read_bytes())
+            self.assertEqual((stats.files, stats.directories), (5, 2))
+            self.assertLess(stats.ratio, 0.5)
+
+    def test_zipfile_internals(self):
+        # Pins the private zipfile API that build_zip and stream_zip use
+        codecs = [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA]
+        member = next(m for m in archive.members([self.root]) if m.name == "archive/notes.txt")
+        dst = self.root.parent / "codecs.zip"
+        with zipfile.ZipFile(dst, "w") as built:
+            for codec in codecs:
+                crc, size, data = zip_worker.compress(str(member.full_path), codec, None)
+                archive._write_compressed(built, archive.Member(f"{codec}.txt", member.full_path, member.stat),
+                                          codec, crc, size, data)
+
+        with zipfile.ZipFile(dst) as built:
+            self.assertEqual(built.testzip(), None)
+            for codec in codecs:
+                self.assertEqual(built.getinfo(f"{codec}.txt").compress_type, codec)
+                self.assertEqual(built.read(f"{codec}.txt"), member.full_path.read_bytes())
+
+        with zipfile.ZipFile(self.download()) as downloaded:
+            info = downloaded.getinfo("archive/notes.txt")
+            self.assertEqual(info.compress_size, len(zlib.compress((self.root / "notes.txt").read_bytes(), 1)) - 6)
+        dst.unlink()
+
+    def test_api_zip(self):
+        PermissionsRule.objects.create(rule="django-test/archive/secret", users="^Nobody$")
+        response = self.client.post("/private/ffs/zip/django-test/zipped.zip", {"files": ["django-test/archive"]},
+                                    content_type="application/json")
+        self.assertSuccessful(response)
+        with zipfile.ZipFile(settings.FFS_FS_ROOT / "django-test" / "zipped.zip") as built:
+            self.assertNotIn("archive/secret", built.namelist())
+            self.assertIn("archive/notes.txt", built.namelist())
+        (settings.FFS_FS_ROOT / "django-test" / "zipped.zip").unlink()
+
+
+class ExtractTests(MyTestCase):
+    def my_set_up(self):
+        self.root = settings.FFS_FS_ROOT / "django-test" / "extract"
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.root.mkdir(parents=True)
+
+    def test_zip(self):
+        with zipfile.ZipFile(self.root / "a.zip", "w", zipfile.ZIP_DEFLATED) as zip:
+            for i in range(20):
+                zip.writestr(f"a/{i % 3}/file_{i}.txt", f"File {i} " * 10000)
+            zip.writestr("a/empty/", "")
+        (self.root / "a" / "0").mkdir(parents=True)
+        (self.root / "a" / "0" / "file_0.txt").write_text("Kept")
+
+        plan = extract.plan(self.root / "a.zip", self.root)
+        self.assertEqual(plan.errors, [])
+        self.assertEqual(plan.top_level, {Path("a")})
+        sizes = []
+        stats = extract.extract(plan, workers=3, progress=sizes.append)
+
+        self.assertEqual((stats.files, stats.skipped), (19, 1))
+        self.assertEqual(sum(sizes), plan.size)
+        self.assertEqual((self.root / "a" / "0" / "file_0.txt").read_text(), "Kept")
+        self.assertEqual((self.root / "a" / "1" / "file_19.txt").read_text(), "File 19 " * 10000)
+        self.assertTrue((self.root / "a" / "empty").is_dir())
+
+    def test_tar(self):
+        (self.root / "src").mkdir()
+        (self.root / "src" / "notes.txt").write_text("Notes")
+        (self.root / "src" / "link").symlink_to("notes.txt")
+        with tarfile.open(self.root / "a.tar.gz", "w:gz") as tar:
+            tar.add(self.root / "src", "src")
+        shutil.rmtree(self.root / "src")
+
+        response = self.client.post("/private/ffs/unzip/django-test/extract/a.tar.gz")
+        self.assertSuccessful(response)
+        self.assertEqual((self.root / "src" / "notes.txt").read_text(), "Notes")
+        self.assertEqual(os.readlink(self.root / "src" / "link"), "notes.txt")
+
+    def test_dot_root(self):
+        (self.root / "src" / "sub").mkdir(parents=True)
+        (self.root / "src" / "sub" / "notes.txt").write_text("Notes")
+        # Like tar -cf dot.tar -C src .
+        with tarfile.open(self.root / "dot.tar", "w") as tar:
+            tar.add(self.root / "src", ".")
+        with zipfile.ZipFile(self.root / "dot.zip", "w") as zip:
+            zip.writestr("./", "")
+            zip.writestr("./top.txt", "Top")
+
+        for name in ["dot.tar", "dot.zip"]:
+            response = self.client.post(f"/private/ffs/unzip/django-test/extract/{name}")
+            self.assertSuccessful(response)
+        self.assertEqual((self.root / "sub" / "notes.txt").read_text(), "Notes")
+        self.assertEqual((self.root / "top.txt").read_text(), "Top")
+        self.assertEqual(extract.plan(self.root / "dot.tar", self.root).top_level, {Path("sub")})
+
+    def test_dangerous(self):
+        with tarfile.open(self.root / "bad.tar", "w") as tar:
+            link = tarfile.TarInfo("escape")
+            link.type = tarfile.SYMTYPE
+            link.linkname = "../../outside"
+            tar.addfile(link)
+        with zipfile.ZipFile(self.root / "bad.zip", "w") as zip:
+            zip.writestr("/absolute.txt", "text")
+            zip.writestr("ok.txt", "text")
+
+        for name in ["bad.tar", "bad.zip"]:
+            response = self.client.post(f"/private/ffs/unzip/django-test/extract/{name}")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(len(response.json()["errors"]), 1)
+        self.assertFalse((self.root / "ok.txt").exists())
+        self.assertFalse((self.root / "escape").exists())
+
+
+class ExifTests(MyTestCase):
+    def my_set_up(self):
+        self.root = settings.FFS_FS_ROOT / "django-test" / "exif"
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.root.mkdir(parents=True)
+        exif.cache.clear()
+
+        data = Image.Exif()
+        data[0x010f] = "Camera maker"
+        data[0xbeef] = 42
+        data.get_ifd(0x8769)[0x9003] = "2024:07:01 12:00:00"
+        for name in ["b.jpg", "a.jpg"]:
+            Image.new("RGB", (16, 16), "blue").save(self.root / name, exif=data)
+        Image.new("RGB", (16, 16), "blue").save(self.root / "plain.png")
+        (self.root / "notes.txt").write_text("Not an image at all")
+
+    def test_file(self):
+        response = self.client.get("/private/ffs/exif/django-test/exif/a.jpg")
+        self.assertSuccessful(response)
+        data = response.json()
+        self.assertEqual(data["Make"], "Camera maker")
+        self.assertEqual(data["DateTimeOriginal"], "2024:07:01 12:00:00")
+        self.assertEqual(data["Tag 0xbeef"], 42)
+
+        self.assertEqual(self.client.get("/private/ffs/exif/django-test/exif/notes.txt").status_code, 400)
+
+    def test_cached(self):
+        with mock.patch("private.exif.read", wraps=exif.read) as read:
+            for _ in range(2):
+                self.assertEqual(exif.get(self.root / "a.jpg")["Make"], "Camera maker")
+            self.assertEqual(read.call_count, 1)
+
+            (self.root / "a.jpg").write_bytes((self.root / "plain.png").read_bytes())
+            self.assertEqual(exif.get(self.root / "a.jpg"), {"Number of entries": 0})
+            self.assertEqual(read.call_count, 2)
+
+    def test_headers_only(self):
+        data = Image.Exif()
+        data[0x010f] = "PNG maker"
+        Image.new("RGB", (16, 16), "blue").save(self.root / "late.png")
+        # Put the eXIf chunk after the image data, where PngImageFile.getexif() would decode the image to find it
+        png = (self.root / "late.png").read_bytes()
+        chunk = data.tobytes()
+        chunk = len(chunk).to_bytes(4) + b"eXIf" + chunk + zlib.crc32(b"eXIf" + chunk).to_bytes(4)
+        (self.root / "late.png").write_bytes(png[:-12] + chunk + png[-12:])
+        (self.root / "broken.jpg").write_bytes((self.root / "a.jpg").read_bytes()[:40])
+
+        with mock.patch("PIL.ImageFile.ImageFile.load", side_effect=AssertionError("Pixels decoded")):
+            self.assertEqual(exif.read(self.root / "late.png")["Make"], "PNG maker")
+            self.assertEqual(exif.read(self.root / "plain.png"), {"Number of entries": 0})
+            self.assertEqual(exif.read(self.root / "a.jpg")["Make"], "Camera maker")
+        self.assertIsNone(exif.read(self.root / "broken.jpg"))
+
+    def test_directory(self):
+        PermissionsRule.objects.create(rule="django-test/exif/b.jpg", users="^Nobody$")
+        response = self.client.get("/private/ffs/exif/django-test/exif")
+        self.assertSuccessful(response)
+        lines = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual([line["path"] for line in lines], ["django-test/exif/a.jpg", "django-test/exif/plain.png"])
+        self.assertEqual(lines[0]["exif"]["DateTimeOriginal"], "2024:07:01 12:00:00")
+
+
+class JobTests(MyTestCase):
+    def my_set_up(self):
+        self.root = settings.FFS_FS_ROOT / "django-test" / "jobs"
+        shutil.rmtree(self.root, ignore_errors=True)
+        (self.root / "dir").mkdir(parents=True)
+        (self.root / "dir" / "notes.txt").write_text("Compressible text " * 1000)
+
+    def test_async_zip(self):
+        response = self.client.post("/private/ffs/zip/django-test/jobs/dir.zip?async=1",
+                                    {"files": ["django-test/jobs/dir"]}, content_type="application/json")
+        self.assertEqual(response.status_code, 202)
+        url = response.json()["url"]
+        self.assertEqual(response["Location"], url)
+        self.assertEqual(self.client.get(url).json()["status"], Job.QUEUED)
+
+        # Jobs are started once the transaction commits, which never happens in a test case
+        jobs.run_job(response.json()["job"])
+        status = self.client.get(url).json()
+        self.assertEqual(status["status"], Job.DONE)
+        self.assertEqual(status["files_done"], 2)
+        self.assertEqual(status["result"]["files"], 1)
+        with zipfile.ZipFile(self.root / "dir.zip") as built:
+            self.assertIn("dir/notes.txt", built.namelist())
+
+    def test_unzip_errors(self):
+        with zipfile.ZipFile(self.root / "bad.zip", "w") as zip:
+            zip.writestr("../outside.txt", "text")
+        job = jobs.enqueue("unzip", self.user, path="django-test/jobs/bad.zip")
+        job = jobs.run_job(job.pk)
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(len(job.result["errors"]), 1)
+        self.assertFalse((self.root.parent / "outside.txt").exists())
+
+    def runner(self):
+        runner = jobs.Runner(1)
+        runner.pool.shutdown()
+        # Runs the jobs in this thread, which alone sees the test's transaction
+        runner.pool = mock.Mock(submit=lambda func, *args: func(*args))
+        return runner
+
+    def test_runner(self):
+        # Queued before the process restarted, and running when another process died
+        queued = jobs.enqueue("move", self.user, src="django-test/jobs/dir", dst="django-test/jobs/moved")
+        stale = Job.objects.create(kind="move", user="Test", status=Job.RUNNING,
+                                   heartbeat=timezone.now() - datetime.timedelta(hours=1))
+        alive = Job.objects.create(kind="move", user="Test", status=Job.RUNNING, heartbeat=timezone.now())
+
+        with mock.patch("private.jobs.connection"):
+            self.runner().step()
+
+        queued.refresh_from_db()
+        stale.refresh_from_db()
+        alive.refresh_from_db()
+        self.assertEqual(queued.status, Job.DONE)
+        self.assertTrue((self.root / "moved").exists())
+        self.assertEqual(stale.status, Job.FAILED)
+        self.assertEqual(alive.status, Job.RUNNING)
+
+    def test_idle_backoff(self):
+        runner = jobs.Runner(1, poll_interval=1, idle_interval=4)
+        waits = []
+
+        def wait(interval):
+            waits.append(interval)
+            if len(waits) == 5:
+                raise KeyboardInterrupt()
+
+        with mock.patch.object(runner, "step", side_effect=[False, False, False, True, False]), \
+                mock.patch.object(runner.wakeup, "wait", wait), mock.patch("private.jobs.connection"):
+            with self.assertRaises(KeyboardInterrupt):
+                runner.run()
+        self.assertEqual(waits, [2, 4, 4, 1, 2])
+
+    def test_cancel(self):
+        job = jobs.enqueue("move", self.user, src="django-test/jobs/dir", dst="django-test/jobs/moved")
+        response = self.client.delete(f"/private/ffs/jobs/{job.pk}")
+        self.assertSuccessful(response)
+        self.assertEqual(response.json()["status"], Job.CANCELLED)
+        self.assertIsNone(jobs.run_job(job.pk))
+        self.assertTrue((self.root / "dir").exists())
+
+    def test_failed(self):
+        job = jobs.enqueue("move", self.user, src="django-test/jobs/missing", dst="django-test/jobs/moved")
+        job = jobs.run_job(job.pk)
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertNotEqual(job.error, "")
+
+    def test_cancelled_when_done(self):
+        def late(context):
+            context.progress(1, 1)
+            Job.objects.filter(pk=context.job.pk).update(cancel_requested=True)
+            return {"done": True}
+
+        with mock.patch.dict(jobs._kinds, {"late": late}):
+            job = jobs.run_job(Job.objects.create(kind="late", user="Test").pk)
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.result, {"done": True})
+        job.refresh_from_db()
+        self.assertEqual(job.files_done, 1)
+
+    def test_dst_appeared(self):
+        job = jobs.enqueue("move", self.user, src="django-test/jobs/dir", dst="django-test/jobs/moved")
+        (self.root / "moved").mkdir()
+        job = jobs.run_job(job.pk)
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertTrue((self.root / "dir").exists())
+        self.assertEqual(list((self.root / "moved").iterdir()), [])
+
+    def test_other_users(self):
+        job = jobs.enqueue("move", "Somebody", src="django-test/jobs/dir", dst="django-test/jobs/moved")
+        self.assertEqual(self.client.get(f"/private/ffs/jobs/{job.pk}").status_code, 404)
+        self.assertEqual(self.client.get("/private/ffs/jobs/").json()["jobs"], [])
+        for limit in ["x", "-1"]:
+            self.assertEqual(self.client.get("/private/ffs/jobs/", {"limit": limit}).status_code, 400)
@@ -0,0 +1,59 @@
+"""
+Renders thumbnails. Runs in the worker processes of private.icons, so it must not import Django.
+"""
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+from private.atomic import replacing
+
+# Pillow's save() format for each icon format
+SAVE_FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+
+
+def _save(img: Image.Image, dst: str, fmt: str, quality: int):
+    dst = Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    with replacing(dst) as tmp:
+        img.save(tmp, SAVE_FORMATS[fmt], quality=quality)
+
+
+def render(src: str, dst: str, size: int, fmt: str, quality: int) -> tuple[int, int]:
+    """
+    Writes a thumbnail of src that fits into size x size pixels (keeping the aspect ratio) to dst.
+    Returns the size of the thumbnail.
+    """
+    with Image.open(src) as img:
+        # Lets the JPEG decoder scale down by up to 8x while decoding, which is much faster than decoding everything
+        img.draft("RGB", (size, size))
+        img = ImageOps.exif_transpose(img)
+
+        if fmt == "jpeg" or img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if fmt != "jpeg" and img.has_transparency_data else "RGB")
+
+        # reducing_gap first shrinks by an integer factor with a cheap filter, then resamples the rest properly
+        img.thumbnail((size, size), Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+        _save(img, dst, fmt, quality)
+        return img.size
+
+
+def render_sprite(icons: list[str], dst: str, size: int, columns: int, fmt: str, quality: int) -> list[list[int]]:
+    """
+    Puts the icons into a grid of size x size cells (each centered in its cell) and writes it to dst.
+    Returns [x, y, width, height] of each icon in the sprite.
+    """
+    rows = max(1, -(-len(icons) // columns))
+    sprite = Image.new("RGB" if fmt == "jpeg" else "RGBA", (columns * size, rows * size), (255, 255, 255, 0))
+    boxes = []
+
+    for i, icon in enumerate(icons):
+        with Image.open(icon) as img:
+            img = img.convert(sprite.mode)
+            x = (i % columns) * size + (size - img.width) // 2
+            y = (i // columns) * size + (size - img.height) // 2
+            sprite.paste(img, (x, y))
+            boxes.append([x, y, img.width, img.height])
+
+    _save(sprite, dst, fmt, quality)
+    return boxes
@@ -7,6 +7,8 @@ app_name = "private"
 
 ffs_urls = [path("", views.view_index, name="ffs"),
             path("ffs-info", views.view_ffs_info, name="ffs-info"),
+            path("jobs/", views.view_jobs, name="jobs"),
+            path("jobs/<int:job_id>", views.view_job, name="job"),
             path("<str:api>/", views.view_api, name="api"),
             path("<str:api>/<path:path>", views.view_api, name="api"), ]
 
@@ -1,30 +1,33 @@
-import datetime
+import functools
 import hashlib
+import itertools
 import json
 import logging
 import os
 import re
 import shutil
-import zipfile
 from pathlib import Path
 
-import PIL
-from PIL import Image
-from PIL.ExifTags import TAGS
 from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required
+from django.db import transaction
 from django.http import HttpRequest, HttpResponse, FileResponse, JsonResponse, \
-    HttpResponseServerError, HttpResponseRedirect
+    HttpResponseServerError, HttpResponseRedirect, StreamingHttpResponse
 from django.urls import reverse
-from django.utils import timezone
+from django.utils.http import content_disposition_header, quote_etag
 from django.views.decorators.cache import cache_control, never_cache
 from django.views.decorators.http import require_http_methods, condition, require_safe
 from django.views.decorators.vary import vary_on_headers
 
 from general import default_render, exception_to_response, UserError, get_mime_type
 from guenthner_xyz import settings
-from private.icons import img_file_icon
-from private.models import FilePacket, PermissionsRule
+from private import permissions, block_index, packet_gc, dedup, listing, fs_index, search, icons, archive, jobs, \
+    tasks, extract, exif
+from private.accel import accel_response
+from private.atomic import replacing
+from private.models import FilePacket, Job
+from private.paths import resolve
+from private.ranges import range_response
 
 log = logging.getLogger("my")
 
@@ -47,7 +50,7 @@ def view_index(request: HttpRequest):
 
 def require_path_exists(func):
     def wrapper(request: HttpRequest, path: Path):
-        if not (fs_root / path).exists():
+        if not resolve(request, path).exists:
             if request.method == "HEAD":
                 return HttpResponse(status=404, content_type="text/plain; charset=utf-8")
             return HttpResponse(f"File {path} does not exist", status=404,
@@ -63,38 +66,43 @@ def check_path(request: HttpRequest, path: Path):
 
 
 def check_permissions(request: HttpRequest, path: Path):
-    for rule in PermissionsRule.objects.all():
-        if not rule.user_allowed(path, str(request.user)):
-            return HttpResponse(f"You are not allowed to view this location.\n"
-                                f"You have been blocked by the rule:\n"
-                                f"{rule}", status=403, content_type="text/plain; charset=utf-8")
+    if (rule := permissions.get_engine().blocking_rule(path, str(request.user))) is not None:
+        return HttpResponse(f"You are not allowed to view this location.\n"
+                            f"You have been blocked by the rule:\n"
+                            f"{rule}", status=403, content_type="text/plain; charset=utf-8")
 
     return None
 
 
-def get_path_last_mod(request, path: Path):
-    full_path = fs_root / path
-    if not full_path.exists():
-        return None
-    return datetime.datetime.fromtimestamp(full_path.stat().st_mtime)
+def wants_async(request: HttpRequest) -> bool:
+    """
+    Whether the client asked to run the work as a job (and get its id) instead of waiting for it
+    """
+    return request.GET.get("async") in ("1", "true")
 
 
-def get_path_etag(request, path: Path):
-    full_path = fs_root / path
-
-    if not full_path.exists():
+def get_path_last_mod(request, path: Path):
+    if not (resolved := resolve(request, path)).exists:
         return None
+    return resolved.last_modified
 
+
+@functools.lru_cache(maxsize=4096)
+def _etag(device: int, inode: int, mtime_ns: int, size: int):
     hsh = hashlib.sha256()
+    hsh.update(f"{device}:{inode}:{mtime_ns}:{size}".encode())
+    return hsh.hexdigest()
 
-    if full_path.is_file():
-        hsh.update(str(full_path.stat().st_mtime).encode())
-        hsh.update(str(full_path.stat().st_size).encode())
-    else:
-        for f in full_path.iterdir():
-            hsh.update(f.name.encode())
 
-    return hsh.hexdigest()
+def get_path_etag(request, path: Path):
+    """
+    Changes whenever a file is modified, or a directory gets new, fewer or renamed entries
+    (both change the modification time), without having to look at the entries of directories
+    """
+    if (stat := resolve(request, path).stat) is None:
+        return None
+
+    return _etag(stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
 
 class MediaView:
@@ -119,14 +127,18 @@ media_views = list(map(MediaView, ["image", "video", "audio"]))
 @require_http_methods(["GET"])
 @condition(etag_func=get_path_etag, last_modified_func=get_path_last_mod)
 def api_files(request: HttpRequest, path: Path):
-    full_path = fs_root / path
+    resolved = resolve(request, path)
     extra_context = {}
 
-    if not full_path.exists():
+    if not resolved.exists:
         template_name = "file_404"
         title_msg = "does not exist"
-    elif full_path.is_file():
-        mime_type = get_mime_type(full_path)
+    elif resolved.is_file:
+        mime_type = None
+        if fs_index.enabled():
+            mime_type = fs_index.mime_for(path, resolved.stat)
+        if mime_type is None:
+            mime_type = get_mime_type(resolved.full_path, resolved.stat)
         if mime_type == "text/plain":
             return HttpResponseRedirect(reverse("private:api", kwargs={"api": "notepad", "path": path}))
 
@@ -138,8 +150,6 @@ def api_files(request: HttpRequest, path: Path):
     else:
         template_name = "files"
         title_msg = "Directory"
-        files = list(full_path.iterdir())
-        files.sort()
         extra_context = {"net_block_size": settings.FFS_NET_BLOCK_SIZE}
 
     return default_render(request, f"private/{template_name}.html", {
@@ -152,27 +162,97 @@ def api_files(request: HttpRequest, path: Path):
 @require_path_exists
 @condition(etag_func=get_path_etag, last_modified_func=get_path_last_mod)
 def api_icon(request: HttpRequest, path: Path):
+    size = icons.parse_size(request.GET.get("size"))
+    fmt = icons.parse_format(request.GET.get("format"))
+    content_type = icons.CONTENT_TYPES[fmt]
+
     try:
-        return FileResponse(open(img_file_icon(path), "rb"))
+        icon_file = icons.img_file_icon(path, size, fmt, resolve(request, path).stat)
+        if (response := accel_response(icon_file, content_type)) is not None:
+            return response
+        return FileResponse(open(icon_file, "rb"), content_type=content_type)
     except RuntimeError:
         return HttpResponse(status=500)
 
 
-def populate_info_dict(info, path: Path, level):
-    mime = get_mime_type(path)
+def get_sprite(request: HttpRequest, path: Path) -> tuple[Path, Path]:
+    """
+    The sprite and map file for the request, created once per request
+    """
+    if "_ffs_sprite" not in request.__dict__:
+        if not resolve(request, path).is_dir:
+            raise UserError(f"Sprites can only be made for directories, {path} is not one")
+        engine = permissions.get_engine()
+        user = str(request.user)
+        request._ffs_sprite = icons.sprite_files(path, icons.parse_size(request.GET.get("size")),
+                                                 icons.parse_format(request.GET.get("format")),
+                                                 listing.parse_count(request.GET, "offset", 0),
+                                                 listing.parse_count(request.GET, "limit"),
+                                                 allowed=lambda p: engine.blocking_rule(p, user) is None,
+                                                 user=user)
+    return request._ffs_sprite
 
-    info[str(path.relative_to(fs_root))] = {
-        "path": str(path.relative_to(fs_root)),
-        "name": path.name,
-        "size": path.stat().st_size,
-        "mime": mime
-    }
 
-    if level > 0 and path.is_dir():
-        for file in path.iterdir():
-            populate_info_dict(info, file, level - 1)
+@cache_control(no_cache=True)
+@require_http_methods(["GET"])
+@require_path_exists
+@condition(etag_func=lambda request, path: get_sprite(request, path)[1].stem)
+def api_sprite(request: HttpRequest, path: Path):
+    """
+    The icons of all images in a page of the directory listing (offset, limit like raw) as one image,
+    with map=1 where each icon is in it
+    """
+    content_type = icons.CONTENT_TYPES[icons.parse_format(request.GET.get("format"))]
 
-    return info
+    for retry in (True, False):
+        sprite_file, map_file = get_sprite(request, path)
+        try:
+            if request.GET.get("map"):
+                response = FileResponse(open(map_file, "rb"), content_type="application/json")
+            elif (response := accel_response(sprite_file, content_type)) is None:
+                response = FileResponse(open(sprite_file, "rb"), content_type=content_type)
+        except FileNotFoundError:
+            # A newer version of the page replaced it since get_sprite(); made again once
+            if not retry:
+                raise
+            del request._ffs_sprite
+            continue
+        response["ETag"] = quote_etag(map_file.stem)
+        return response
+
+
+def info_stream(request: HttpRequest, path: Path, level: int):
+    """
+    The entries as newline delimited JSON, produced while walking the tree.
+    With a limit, the last line contains the cursor to continue from.
+    """
+    resolved = resolve(request, path)
+    fields = listing.parse_fields(request.GET.get("fields"))
+    sort, descending = listing.parse_sort(request.GET.get("sort"))
+    limit = listing.parse_count(request.GET, "limit") or None
+    cursor = listing.decode_cursor(c) if (c := request.GET.get("cursor")) else None
+
+    engine = permissions.get_engine()
+    user = str(request.user)
+    walker = listing.Walker(fields, sort, descending, allowed=lambda p: engine.blocking_rule(p, user) is None)
+    entries = walker.walk(resolved.full_path, str(path), resolved.stat, level, cursor)
+
+    # Errors in the request (like outdated cursors) should happen before the response starts
+    first = next(entries, None)
+
+    def lines():
+        if first is None:
+            return
+        count = 0
+        for position, info in itertools.chain([first], entries):
+            if limit is not None and count >= limit:
+                yield json.dumps({"cursor": listing.encode_cursor(last)}) + "\n"
+                return
+            yield json.dumps(info) + "\n"
+            last = position
+            count += 1
+
+    return StreamingHttpResponse(lines(), content_type="application/x-ndjson")
 
 
 @cache_control(no_cache=True)
@@ -184,7 +264,44 @@ def api_info(request: HttpRequest, path: Path):
         return HttpResponse(status=200)
 
     level = int(request.GET.get("level", 0))
-    return JsonResponse(populate_info_dict({}, fs_root / path, level))
+
+    if request.GET.get("format") == "ndjson":
+        return info_stream(request, path, level)
+
+    if fs_index.enabled() and (info := fs_index.info(path, level)) is not None:
+        return JsonResponse(info)
+
+    resolved = resolve(request, path)
+    walker = listing.Walker(listing.DEFAULT_FIELDS)
+    return JsonResponse({info["path"]: info for _, info in walker.walk(resolved.full_path, str(path), resolved.stat,
+                                                                       level)})
+
+
+@cache_control(no_cache=True)
+@require_safe
+def api_search(request: HttpRequest, path: Path):
+    """
+    The indexed entries below the path that match the query, as newline delimited JSON
+    """
+    if not fs_index.enabled():
+        raise UserError("Searching needs the file system index, which is not enabled (FFS_FS_INDEX)")
+
+    query = search.parse_query(request.GET)
+    fields = listing.parse_fields(request.GET.get("fields"))
+    engine = permissions.get_engine()
+    user = str(request.user)
+
+    def lines():
+        count = 0
+        for entry in search.search(path, query):
+            if count >= query.limit:
+                return
+            if engine.blocking_rule(entry.path, user) is not None:
+                continue
+            yield json.dumps(search.entry_info(entry, fields)) + "\n"
+            count += 1
+
+    return StreamingHttpResponse(lines(), content_type="application/x-ndjson")
 
 
 @require_http_methods(["POST"])
@@ -195,47 +312,56 @@ def api_move(request: HttpRequest, src: Path):
     if (r := check_permissions(request, dst)) is not None:
         return r
 
-    full_src = fs_root / src
-    full_dst = fs_root / dst
-
-    if full_dst.exists():
+    if resolve(request, dst).exists:
         return HttpResponse(f"The file at {dst} already exists", status=400, content_type="text/plain;charset=utf-8")
 
-    full_dst.parent.mkdir(parents=True, exist_ok=True)
-    shutil.move(full_src, full_dst)
+    if wants_async(request):
+        return jobs.accepted(jobs.enqueue("move", request.user, src=str(src), dst=dst))
 
+    try:
+        tasks.move(jobs.NO_JOB, str(src), dst)
+    except jobs.JobFailed as e:
+        return HttpResponse(str(e), status=400, content_type="text/plain;charset=utf-8")
     return HttpResponse(status=200)
 
 
 @require_http_methods(["POST"])
 def api_new(request: HttpRequest, path: Path):
-    full_path = fs_root / path
+    resolved = resolve(request, path)
+    full_path = resolved.full_path
 
-    if full_path.exists():
+    if resolved.exists:
         return HttpResponse(f"The file at {path} already exists", status=400)
     else:
         full_path.parent.mkdir(parents=True, exist_ok=True)
         full_path.touch()
+        resolved.refresh()
+        fs_index.changed(path)
         return HttpResponse(status=201)
 
 
 @require_http_methods(["POST"])
 def api_mkdir(request: HttpRequest, path: Path):
-    full_path = fs_root / path
+    resolved = resolve(request, path)
 
-    if full_path.exists():
+    if resolved.exists:
         return HttpResponse(f"The file at {path} already exists", status=400)
     else:
-        full_path.mkdir(parents=True)
+        resolved.full_path.mkdir(parents=True)
+        resolved.refresh()
+        fs_index.changed(path)
         return HttpResponse(status=201)
 
 
 @require_http_methods(["POST"])
 @require_path_exists
 def api_rmdir(request: HttpRequest, path: Path):
-    full_path = fs_root / path
+    resolved = resolve(request, path)
 
-    full_path.rmdir()
+    resolved.full_path.rmdir()
+    resolved.refresh()
+    fs_index.changed(path)
+    icons.remove(path)
     return HttpResponse(status=200)
 
 
@@ -254,65 +380,43 @@ class api_class:
                 return HttpResponse(status=500)
 
 
-class FileHasher:
-    def __init__(self, path: Path, buffer_size: int = 2 ** 16):
-        self.path = path
-        self.buffer_size = buffer_size
-
-    def __enter__(self):
-        self.buffer = bytearray(self.buffer_size)
-        self.memory_view = memoryview(self.buffer)
-        self.fp = open(self.path, "rb", buffering=0)
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.fp.close()
-
-    def hash(self, start, length, debug=False):
-        if debug:
-            hsh = []
-        else:
-            hsh = hashlib.sha256()
-        self.fp.seek(start, os.SEEK_SET)
-
-        while n := self.fp.readinto(self.memory_view):
-            memory = self.memory_view[:min(length, n)]
-            if debug:
-                hsh.append(memory.tobytes().decode())
-            else:
-                hsh.update(memory)
-            length -= n
-
-        if debug:
-            return hsh
-        else:
-            return hsh.hexdigest()
-
-
 class api_raw(api_class):
     @classmethod
     def get_or_head(cls, request: HttpRequest, path: Path, is_get: bool):
-        full_path = fs_root / path
-
-        if full_path.is_file():
-            return FileResponse(open(full_path, "rb"), content_type=get_mime_type(full_path))
+        resolved = resolve(request, path)
+        full_path = resolved.full_path
+
+        if resolved.is_file:
+            mime_type = get_mime_type(full_path, resolved.stat)
+            if (response := accel_response(full_path, mime_type)) is not None:
+                return response
+            return range_response(request, full_path, resolved.size, mime_type,
+                                  get_path_etag(request, path), get_path_last_mod(request, path))
         else:
-            files = list(full_path.iterdir())
-            files.sort()
-            files = [*filter(lambda f: not f.is_file(), files),
-                     *filter(lambda f: f.is_file(), files)]
-            files = {p.name: str(p.relative_to(fs_root)) for p in files}
+            offset = listing.parse_count(request.GET, "offset", 0)
+            limit = listing.parse_count(request.GET, "limit")
+            entries = None
+            if fs_index.enabled():
+                entries = fs_index.list_directory(path, request.GET.get("prefix"), offset, limit)
+            if entries is None:
+                entries = listing.list_directory(full_path, request.GET.get("prefix"), offset, limit)
+            parent = str(path)
 
-            return JsonResponse(files)
+            return JsonResponse({e.name: listing.join(parent, e.name) for e in entries})
 
     @classmethod
     def post(cls, request: HttpRequest, path: Path):
-        full_path = fs_root / path
+        resolved = resolve(request, path)
+        full_path = resolved.full_path
 
-        if not full_path.is_file():
+        if not resolved.is_file:
             raise UserError(f"Cannot write to {path}; is a directory")
 
         full_path.write_bytes(request.body)
+        resolved.refresh()
+        block_index.invalidate(full_path)
+        dedup.release(full_path)
+        fs_index.changed(path)
 
         return HttpResponse(status=200)
 
@@ -329,9 +433,9 @@ class api_raw(api_class):
 class api_file_ledger(api_class):
     @classmethod
     def get_or_head(cls, request: HttpRequest, path: Path, is_get: bool):
-        full_path = fs_root / path
+        resolved = resolve(request, path)
 
-        if not full_path.is_file():
+        if not resolved.is_file:
             content = None
             if is_get:
                 content = f"The file at {path} is a folder"
@@ -341,13 +445,7 @@ class api_file_ledger(api_class):
         if not is_get:
             return HttpResponse(status=200)
 
-        size = full_path.stat().st_size
-        hashes = {}
-
-        with FileHasher(full_path) as hasher:
-            for offset in range(0, size, settings.FFS_NET_BLOCK_SIZE):
-                hsh = hasher.hash(offset, settings.FFS_NET_BLOCK_SIZE)
-                hashes[hsh] = FilePacket.status_for(hsh)
+        hashes = FilePacket.statuses_for(block_index.block_hashes(resolved.full_path, stat=resolved.stat))
 
         return JsonResponse(status=200, data={"hashes": hashes})
 
@@ -357,9 +455,10 @@ class api_file_ledger(api_class):
 
     @classmethod
     def post(cls, request: HttpRequest, path: Path):
-        full_path = fs_root / path
+        resolved = resolve(request, path)
+        full_path = resolved.full_path
 
-        if full_path.exists():
+        if resolved.exists:
             return HttpResponse(status=400, content_type="text/plain; charset=utf-8",
                                 content=f"The file at {path} already exists")
 
@@ -377,31 +476,20 @@ class api_file_ledger(api_class):
         full_path.parent.mkdir(parents=True, exist_ok=True)
         if len(hashes) == 0:
             full_path.touch()
+            fs_index.changed(path)
             return HttpResponse(status=200)
 
-        missing = []
-        packet_info = {}
-
-        for hsh in hashes:
-            status = FilePacket.status_for(hsh)
-            if status != FilePacket.STORED:
-                missing.append(hsh)
-            packet_info[hsh] = status
+        packet_info = FilePacket.statuses_for(hashes)
+        missing = [hsh for hsh, status in packet_info.items() if status != FilePacket.STORED]
 
         if len(missing) > 0:
             return cls.post_status_response(packet_info, False)
 
-        packets = [FilePacket.objects.get(hsh=hsh) for hsh in hashes]
-        files = [p.file for p in packets]
+        if wants_async(request):
+            return jobs.accepted(jobs.enqueue("assemble", request.user, path=str(path), hashes=hashes))
 
-        try:
-            with open(full_path, "wb") as dst:
-                for f in files:
-                    with open(file_packet_cache / f, "rb") as src:
-                        shutil.copyfileobj(src, dst)
-        except Exception as e:
-            full_path.unlink(missing_ok=True)
-            raise e
+        tasks.assemble_file(jobs.NO_JOB, str(path), hashes)
+        resolved.refresh()
 
         return cls.post_status_response(packet_info, True)
 
@@ -414,6 +502,10 @@ class api_file_ledger(api_class):
         return cls.dispatch(request, path)
 
 
+class _HashMismatch(Exception):
+    pass
+
+
 class api_file_packet(api_class):
     @classmethod
     def file_for_file_packet(cls, hsh: str):
@@ -444,6 +536,8 @@ class api_file_packet(api_class):
 
                 packet.save()
                 if is_get:
+                    if (response := accel_response(file, "application/octet-stream", headers)) is not None:
+                        return response
                     return FileResponse(open(file, "rb"), content_type="application/octet-stream", headers=headers)
                 else:
                     return HttpResponse(status=200, headers=headers)
@@ -453,28 +547,11 @@ class api_file_packet(api_class):
             content = f"File packet for hash {hsh} does not exist"
             return HttpResponse(status=404, content=content, content_type="text/plain;charset=utf-8", headers=headers)
 
-    @classmethod
-    def delete_old(cls, max_age=48):
-        to_delete = FilePacket.objects.filter(
-            last_used__lt=timezone.now() - datetime.timedelta(hours=max_age))
-
-        if len(to_delete) > 0:
-            log.info(f"Deleting {len(to_delete)} old file packets")
-
-        for p in to_delete:
-            if p.status == FilePacket.STORED:
-                file = file_packet_cache / p.file
-                if file.exists():
-                    file.unlink()
-                else:
-                    log.error(f"File packet for hash {p.hsh} is missing during automatic cleanup")
-            p.delete()
-
     @classmethod
     def post(cls, request: HttpRequest, hsh: str):
         def pre_return(_packet: FilePacket):
             _packet.save()
-            cls.delete_old()
+            transaction.on_commit(packet_gc.collect_in_background)
 
         hsh = str(hsh)
         packet, _ = FilePacket.objects.get_or_create(hsh=hsh)
@@ -491,25 +568,32 @@ class api_file_packet(api_class):
         packet.status = FilePacket.FAILED
         file = file_packet_cache / packet.file
         file.parent.mkdir(parents=True, exist_ok=True)
-        file.touch(exist_ok=True)
 
         CHUNK_SIZE = 64 * 1024
 
-        with open(file, "wb") as fp:
-            while True:
-                data = request.read(CHUNK_SIZE)
-                if len(data) == 0:
-                    break
-                fp.write(data)
+        # The packet only appears at its final path once its hash has been checked
+        hasher = hashlib.sha256()
+        size = 0
+        head = b""
 
-        with open(file, "rb") as fp:
-            check_hash = hashlib.file_digest(fp, "sha256").hexdigest()
-
-        if check_hash != hsh:
+        try:
+            with replacing(file) as tmp_file:
+                with open(tmp_file, "xb") as fp:
+                    while data := request.read(CHUNK_SIZE):
+                        hasher.update(data)
+                        fp.write(data)
+                        if size < 100:
+                            head += data[:100 - size]
+                        size += len(data)
+
+                check_hash = hasher.hexdigest()
+                if check_hash != hsh:
+                    raise _HashMismatch()
+        except _HashMismatch:
             pre_return(packet)
             content = f"Actual file hash:\n{check_hash} ({len(check_hash)})\ndoes not match specified hash:\n{hsh} ({len(str(hsh))})\n"
-            if file.stat().st_size < 100:
-                content += f"What you uploaded: {file.read_text()}\n"
+            if size < 100:
+                content += f"What you uploaded: {head.decode(errors='replace')}\n"
             return HttpResponse(status=400,
                                 content=content,
                                 content_type="text/plain;charset=utf-8",
@@ -528,6 +612,24 @@ class api_file_packet(api_class):
         return cls.dispatch(request, hsh)
 
 
+@never_cache
+@require_http_methods(["POST"])
+def api_file_packet_status(request: HttpRequest, path: Path):
+    try:
+        data = json.loads(request.body.decode())
+        hashes = data["hashes"]
+        if not isinstance(hashes, list):
+            raise TypeError()
+    except json.JSONDecodeError:
+        return HttpResponse(status=400, content_type="text/plain; charset=utf-8",
+                            content="The request was not valid JSON")
+    except (KeyError, TypeError):
+        return HttpResponse(status=400, content_type="text/plain; charset=utf-8",
+                            content="The request did not contain a list of hashes")
+
+    return JsonResponse({"hashes": FilePacket.statuses_for(hashes)})
+
+
 @require_safe
 @require_path_exists
 @condition(etag_func=get_path_etag, last_modified_func=get_path_last_mod)
@@ -548,33 +650,44 @@ def api_notepad(request: HttpRequest, path: Path):
         "parent": path.parent})
 
 
-@require_safe
-@require_path_exists
 @condition(etag_func=get_path_etag, last_modified_func=get_path_last_mod)
-def api_exif(request: HttpRequest, path: Path):
+def exif_file(request: HttpRequest, path: Path):
     if request.method == "HEAD":
         return HttpResponse(status=200)
 
-    full_path = fs_root / path
-
-    try:
-        img = Image.open(full_path)
-    except PIL.UnidentifiedImageError:
+    resolved = resolve(request, path)
+    if (data := exif.get(resolved.full_path, resolved.stat)) is None:
         return HttpResponse(f"The file {path} is not an image or does not have exif metadata", status=400,
                             content_type="text/plain;charset=utf-8")
 
-    exif = img.getexif()
-    data = {}
-    num = 0
+    return JsonResponse(data, status=200)
+
+
+@cache_control(no_cache=True)
+def exif_directory(request: HttpRequest, path: Path):
+    """
+    The EXIF data of all images in the directory, as newline delimited JSON
+    """
+    if request.method == "HEAD":
+        return HttpResponse(status=200)
 
-    for key, value in exif.items():
-        num += 1
-        name = TAGS[key]
-        data[name] = str(value)
+    engine = permissions.get_engine()
+    user = str(request.user)
 
-    data["Number of entries"] = num
+    def lines():
+        allowed = lambda name: engine.blocking_rule(path / name, user) is None
+        for name, data in exif.directory(fs_root / path, allowed):
+            yield json.dumps({"path": str(path / name), "exif": data}) + "\n"
 
-    return JsonResponse(data, status=200)
+    return StreamingHttpResponse(lines(), content_type="application/x-ndjson")
+
+
+@require_safe
+@require_path_exists
+def api_exif(request: HttpRequest, path: Path):
+    if resolve(request, path).is_dir:
+        return exif_directory(request, path)
+    return exif_file(request, path)
 
 
 @login_required
@@ -595,51 +708,50 @@ def view_ffs_info(request: HttpRequest):
     })
 
 
-def zip_file_errors(zip: zipfile.ZipFile) -> list:
+@never_cache
+@require_http_methods(["GET", "POST"])
+def api_archive(request: HttpRequest, path: Path):
     """
-    Reasons that a zip file might be dangerous (extract to locations other than current directory)
+    Streams a zip (or with format=tar a tar) file of the path, or with POST of the files in the body
+    (like zip), without ever storing it
     """
-    reasons = []
-
-    for file in zip.filelist:
-        if file.is_dir(): continue
-        path = Path(file.filename)
-        if path.is_absolute(): reasons.append(f"File {path} is an absolute")
-        if any(part == '..' for part in path.parts): reasons.append(f"File {path} contains ..")
-
-    return reasons
+    fmt = request.GET.get("format", "zip")
+    if fmt not in archive.FORMATS:
+        raise UserError(f"Unknown archive format {fmt}, the only options are {list(archive.FORMATS)}")
 
+    if request.method == "POST":
+        try:
+            files = [Path(file) for file in json.loads(request.body.decode())["files"]]
+        except json.JSONDecodeError:
+            return HttpResponse(status=400, content_type="text/plain; charset=utf-8",
+                                content="The request was not valid JSON")
+        except (KeyError, TypeError):
+            return HttpResponse(status=400, content_type="text/plain; charset=utf-8",
+                                content="The request did not contain the files key (or something related)")
+        for file in files:
+            check_path(request, file)
+            if (r := check_permissions(request, file)) is not None:
+                return r
+    else:
+        files = [path]
 
-def safe_extract(zip: zipfile.ZipFile, path: Path):
-    for file in zip.filelist:
-        if file.is_dir():
-            log.debug(f"Skipping directory {file.filename}")
-            continue
-        new_path = path / file.filename
-        if new_path.exists():
-            log.debug(f"Skipping file {new_path} as it already exists")
-            continue
-        new_path.parent.mkdir(parents=True, exist_ok=True)
-        zip.extract(file, path)
-        log.debug(f"Extracted file {file.filename} to {new_path}")
-
+    if non_existent := [file for file in files if not resolve(request, file).exists]:
+        return HttpResponse(f"The file(s) {", ".join(map(str, non_existent))} do not exist", status=400,
+                            content_type="text/plain; charset=utf-8")
 
-def add_file(zip: zipfile.ZipFile, root: Path, path: Path):
-    log.debug(f"Adding file {path}")
-    if path.is_dir():
-        zip.mkdir(str(path.relative_to(root)))
+    engine = permissions.get_engine()
+    user = str(request.user)
+    members = archive.members([fs_root / file for file in files],
+                              allowed=lambda p: engine.blocking_rule(p, user) is None)
 
-        for file in path.iterdir():
-            add_file(zip, root, file)
-    else:
-        zip.write(path, str(path.relative_to(root)), compress_type=zipfile.ZIP_LZMA)
+    name = path.name or "ffs"
+    return StreamingHttpResponse(archive.stream(fmt, members), content_type=archive.FORMATS[fmt],
+                                 headers={"Content-Disposition": content_disposition_header(True, f"{name}.{fmt}")})
 
 
 @require_http_methods(["POST"])
 def api_zip(request: HttpRequest, path: Path):
-    full_path = fs_root / path
-
-    if full_path.exists():
+    if resolve(request, path).exists:
         return HttpResponse(f"The file {path} already exists", status=400, content_type="text/plain;charset=utf-8")
 
     try:
@@ -652,32 +764,68 @@ def api_zip(request: HttpRequest, path: Path):
         return HttpResponse(status=400, content_type="text/plain; charset=utf-8",
                             content="The request did not contain the files key (or something related)")
 
-    files = [fs_root / file for file in files]
-    non_existent = [file for file in files if not file.exists()]
+    non_existent = [file for file in files if not resolve(request, Path(file)).exists]
 
     if len(non_existent) > 0:
         return HttpResponse(f"The file(s) {", ".join(map(str, non_existent))} do not exist", status=400,
                             content_type="text/plain; charset=utf-8", )
 
-    with zipfile.ZipFile(full_path, "w") as zip:
-        for file in files:
-            add_file(zip, file.parent, file)
+    if wants_async(request):
+        job = jobs.enqueue("zip", request.user, path=str(path), files=files, username=str(request.user))
+        return jobs.accepted(job)
 
+    result = tasks.zip_files(jobs.NO_JOB, str(path), files, str(request.user))
+    log.debug(f"Zipped {result["files"]} files into {path}, {result["bytes_in"]} -> {result["bytes_out"]} bytes")
     return HttpResponse(status=200)
 
 
 @require_http_methods(["POST"])
 @require_path_exists
 def api_unzip(request: HttpRequest, path: Path):
-    full_path = fs_root / path
+    if not extract.is_archive(fs_root / path):
+        return HttpResponse(f"{path} is not a zip or tar file", status=400, content_type="text/plain; charset=utf-8")
 
-    with zipfile.ZipFile(full_path, 'r') as zip:
-        errors = zip_file_errors(zip)
-        if len(errors) == 0:
-            safe_extract(zip, fs_root / path.parent)
-            return HttpResponse(status=200)
-        else:
-            return JsonResponse({"errors": errors}, status=400)
+    if wants_async(request):
+        return jobs.accepted(jobs.enqueue("unzip", request.user, path=str(path)))
+
+    try:
+        tasks.unzip(jobs.NO_JOB, str(path))
+    except jobs.JobFailed as e:
+        return JsonResponse(e.result, status=400)
+    return HttpResponse(status=200)
+
+
+@login_required
+@permission_required("private.ffs")
+@never_cache
+@require_safe
+@exception_to_response(UserError, 400)
+def view_jobs(request: HttpRequest):
+    """
+    The jobs of the user, newest first
+    """
+    limit = listing.parse_count(request.GET, "limit", 50)
+    user_jobs = Job.objects.filter(user=str(request.user)).order_by("-created")[:limit]
+    return JsonResponse({"jobs": [job.to_json() for job in user_jobs]})
+
+
+@login_required
+@permission_required("private.ffs")
+@never_cache
+@require_http_methods(["GET", "HEAD", "DELETE"])
+def view_job(request: HttpRequest, job_id: int):
+    """
+    The progress and result of the job; DELETE cancels it
+    """
+    try:
+        job = Job.objects.get(pk=job_id, user=str(request.user))
+    except Job.DoesNotExist:
+        return HttpResponse(f"There is no job {job_id}", status=404, content_type="text/plain; charset=utf-8")
+
+    if request.method == "DELETE":
+        jobs.cancel(job)
+
+    return JsonResponse(job.to_json())
 
 
 @login_required
@@ -685,8 +833,9 @@ def api_unzip(request: HttpRequest, path: Path):
 @cache_control(max_age=60 * 60)
 @exception_to_response(UserError, 400)
 def view_api(request: HttpRequest, api: str, path: Path = Path("")):
-    valid_apis = ["raw", "files", "info", "icon", "exif", "file-packet", "file-ledger", "move", "new", "mkdir", "rmdir",
-                  "cascade", "notepad", "zip", "unzip"]
+    valid_apis = ["raw", "files", "info", "icon", "exif", "file-packet", "file-packet-status", "file-ledger", "move",
+                  "new", "mkdir", "rmdir", "cascade", "notepad", "zip", "unzip", "search", "sprite",
+                  "archive"]
 
     if api not in valid_apis:
         raise UserError(f"The requested API does not exist: {api}, the only options are {valid_apis}")
@@ -710,6 +859,8 @@ def view_api(request: HttpRequest, api: str, path: Path = Path("")):
             return api_exif(request, path)
         case "file-packet":
             return api_file_packet.call(request, path)
+        case "file-packet-status":
+            return api_file_packet_status(request, path)
         case "file-ledger":
             return api_file_ledger.call(request, path)
         case "move":
@@ -728,5 +879,11 @@ def view_api(request: HttpRequest, api: str, path: Path = Path("")):
             return api_zip(request, path)
         case "unzip":
             return api_unzip(request, path)
+        case "search":
+            return api_search(request, path)
+        case "sprite":
+            return api_sprite(request, path)
+        case "archive":
+            return api_archive(request, path)
 
     return HttpResponseServerError("Did not configure my stuff correctly")
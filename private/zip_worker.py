@@ -0,0 +1,30 @@
+"""
+Compresses zip members. Runs in the worker processes of private.archive.build_zip, so it must not import Django.
+"""
+import zipfile
+import zlib
+
+CHUNK_SIZE = 2 ** 20
+
+
+def compress(path: str, compress_type: int, level: int | None) -> tuple[int, int, bytes]:
+    """
+    The CRC-32, the size and the compressed data of the file, exactly as they go into the zip file
+    """
+    # The same compressors that ZipFile.write() uses, LZMA needs its zip specific header
+    # (private API, see the comment on archive._write_compressed)
+    compressor = zipfile._get_compressor(compress_type, level)
+    crc = 0
+    size = 0
+    parts = []
+
+    with open(path, "rb") as file:
+        while data := file.read(CHUNK_SIZE):
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            parts.append(compressor.compress(data) if compressor is not None else data)
+
+    if compressor is not None:
+        parts.append(compressor.flush())
+
+    return crc, size, b"".join(parts)